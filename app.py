@@ -1,13 +1,19 @@
 import os
 import asyncio
-import threading
-from flask import Flask, request, redirect, url_for, abort
+import hmac
+from flask import Flask, request, redirect, url_for, abort, jsonify
 import uuid
 import requests
 
 from shared_resources import slack_app, logger, db
 from slack_bolt.adapter.flask import SlackRequestHandler
-from assistants import process_thread_with_assistant
+from query_router import query_router
+from metrics import metrics_snapshot
+from profiling import profile_request, handle_profile_command
+from token_cache import get_user_tokens, update_cached_tokens
+from prewarm import schedule_prewarm
+from task_dispatch import create_task_dispatch, verify_task_request, TASK_DISPATCH_MODE, TASK_ROUTE
+from home_view import HOME_SERVICES, build_home_view, home_view_hash, needs_publish, record_published
 
 # Initialize Flask app
 app = Flask(__name__)
@@ -24,6 +30,8 @@ MIRO_CLIENT_SECRET = os.environ.get("MIRO_CLIENT_SECRET")
 MIRO_REDIRECT_URI = os.environ.get("MIRO_REDIRECT_URI")
 
 AUTHORIZED_USER_IDS = os.environ.get("AUTHORIZED_USER_IDS", "")
+# /metrics reports per-user activity and spend, so it is only served when a bearer token is configured
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
 
 def is_authorized_user(user_id):
     authorized_ids = AUTHORIZED_USER_IDS.split(',')
@@ -59,11 +67,12 @@ def slack_events():
         if event.get('type') == 'app_home_opened':
             logger.info(f"Event type is 'app_home_opened'. User ID: {event.get('user')}")
             update_home_tab(slack_app.client, event, logger)
-            logger.info("Home tab updated successfully.")
+            logger.info("Home tab handled successfully.")
         
         elif event.get('type') == 'message':
-            # Process the message asynchronously to avoid blocking
-            threading.Thread(target=lambda: process_message(event)).start()
+            # Process the message after the ack, on a thread or through the task queue (TASK_DISPATCH_MODE)
+            task_id = data.get('event_id') or event.get('client_msg_id') or event.get('ts')
+            task_dispatch.enqueue(task_id, {"event": event, "event_id": data.get('event_id')})
         
         logger.info("Event callback processed successfully.")
         return '', 200
@@ -71,23 +80,67 @@ def slack_events():
     logger.warning("Received bad request. Data type is not handled: " + str(data.get('type')))
     return '', 400  # Bad request response
 
-def process_message(event):
+def metrics():
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {METRICS_TOKEN}"):
+        abort(403)
+    return jsonify(metrics_snapshot())
+
+if METRICS_TOKEN:
+    app.add_url_rule('/metrics', view_func=metrics, methods=['GET'])
+else:
+    logger.info("METRICS_TOKEN is not set; the /metrics endpoint is disabled.")
+
+def process_message_task():
+    # Tasks are processed inside this request so Cloud Run keeps the CPU allocated until the reply is sent
+    if not verify_task_request(request.headers):
+        logger.warning("Rejected unauthenticated task request.")
+        abort(403)
+    payload = request.json or {}
+    user_id = (payload.get('event') or {}).get('user')
+    if not is_authorized_user(user_id):
+        logger.warning(f"Unauthorized task for user ID: {user_id}")
+        abort(403)
+    return '', task_dispatch.run(payload)
+
+# In thread mode messages never go through the task route, so it is not exposed at all
+if TASK_DISPATCH_MODE != "thread":
+    app.add_url_rule(TASK_ROUTE, view_func=process_message_task, methods=['POST'])
+
+def process_message(event, event_id=None, thread_ts=None):
     user_id = event['user']
     text = event['text']
     channel = event['channel']
-    # Assuming process_thread_with_assistant is adapted to handle these parameters
+
+    profile_reply = handle_profile_command(user_id, text)
+    if profile_reply:
+        slack_app.client.chat_postMessage(channel=channel, text=profile_reply, thread_ts=thread_ts)
+        return
+
+    # The message creates its own thread right away; warm only the tokens and connections alongside it
+    schedule_prewarm(user_id, "first message", create_thread=False)
+
+    # Simple lookups are answered directly; everything else goes to the assistant
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
-    response = loop.run_until_complete(process_thread_with_assistant(text, os.getenv('ASSISTANT_ID'), from_user=user_id))
+    with profile_request(event_id or event.get('client_msg_id') or event.get('ts')):
+        response = loop.run_until_complete(query_router.answer(text, os.getenv('ASSISTANT_ID'), from_user=user_id))
     if response:
         for text in response.get("text", []):
             slack_app.client.chat_postMessage(
                 channel=channel,
                 text=text,
-                mrkdwn=True
+                mrkdwn=True,
+                thread_ts=thread_ts  # Replies to threaded intake go in the same thread
             )
+    elif thread_ts:
+        slack_app.client.chat_postMessage(channel=channel, text="Sorry, I couldn't process your request.", thread_ts=thread_ts)
     loop.close()
 
+def handle_message_task(payload):
+    process_message(payload['event'], payload.get('event_id'), payload.get('thread_ts'))
+
+task_dispatch = create_task_dispatch(handle_message_task)
+
 @slack_app.message("")
 def message_handler(message, say, ack):
     ack()
@@ -98,82 +151,58 @@ def message_handler(message, say, ack):
         return  # Simply return without processing the message
 
     logger.debug(f"Received message from user: {user_id}")
-    user_query = message['text']
-    assistant_id = os.environ.get('ASSISTANT_ID')
-    from_user = message['user']
     thread_ts = message['ts']  # Get the timestamp of the user's message to use as thread_ts
-    logger.debug(f"Authorized user {from_user} sent a query: {user_query}")
-
-    def process_and_respond():
-        try:
-            loop = asyncio.get_event_loop()
-        except RuntimeError:
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-        logger.debug("Event loop set for async processing.")
-
-        async def async_process_and_respond():
-            response = await process_thread_with_assistant(user_query, assistant_id, from_user=from_user)
-            if response:
-                for text in response.get("text", []):
-                    slack_app.client.chat_postMessage(
-                        channel=message['channel'],
-                        text=text,
-                        mrkdwn=True,
-                        thread_ts=thread_ts  # Post the response in the same thread
-                    )
-            else:
-                say("Sorry, I couldn't process your request.", thread_ts=thread_ts)
-            logger.info("Response processed and sent to user.")
-
-        loop.run_until_complete(async_process_and_respond())
-
-    threading.Thread(target=process_and_respond).start()
-    logger.debug("Processing user query in a separate thread.")
+    logger.debug(f"Authorized user {user_id} sent a query: {message['text']}")
+
+    profile_reply = handle_profile_command(user_id, message['text'])
+    if profile_reply:
+        say(profile_reply, thread_ts=thread_ts)
+        return
+
+    task_dispatch.enqueue(message.get('client_msg_id') or thread_ts, {"event": message, "thread_ts": thread_ts})
+    logger.debug("Processing user query after the ack.")
 
 @slack_app.event("app_home_opened")
 def update_home_tab(client, event, logger):
-    user_id = event['user']
-    client.views_publish(
-        user_id=user_id,
-        view={
-            "type": "home",
-            "blocks": [
-                {
-                    "type": "section",
-                    "text": {
-                        "type": "mrkdwn",
-                        "text": "Welcome to the Slack Integration! Please authenticate with the services you need:"
-                    }
-                },
-                {
-                    "type": "actions",
-                    "elements": [
-                        {
-                            "type": "button",
-                            "text": {
-                                "type": "plain_text",
-                                "text": "Authenticate with Miro"
-                            },
-                            "value": "miro_auth",
-                            "action_id": "miro_auth",
-                            "url": url_for('auth_miro', user_id=user_id, _external=True)
-                        },
-                        {
-                            "type": "button",
-                            "text": {
-                                "type": "plain_text",
-                                "text": "Authenticate with Jira"
-                            },
-                            "value": "jira_auth",
-                            "action_id": "jira_auth",
-                            "url": url_for('auth_jira', user_id=user_id, _external=True)
-                        }
-                    ]
-                }
-            ]
+    # Slack echoes the published view back; its private_metadata carries the hash we rendered it with
+    published_hash = (event.get('view') or {}).get('private_metadata')
+    publish_home_view(client, event['user'], published_hash)
+    # Opening Home usually precedes a first message; get its tokens, connections and thread ready
+    schedule_prewarm(event['user'], "app_home_opened")
+
+def retrieve_auth_status(user_id):
+    """
+    Returns whether the user has tokens stored for each Home tab service. A service missing from the
+    cached token document is re-read from Firestore once its cached miss expires, so a connection made
+    through another instance soon shows up; the OAuth callbacks clear the misses on this instance.
+    """
+    tokens = get_user_tokens(user_id, required_services=[service for service, _ in HOME_SERVICES]) or {}
+    return {service: bool((tokens.get(service) or {}).get('access_token')) for service, _ in HOME_SERVICES}
+
+def publish_home_view(client, user_id, published_hash=None):
+    """
+    Renders the user's Home tab and publishes it only if it differs from the version already shown.
+    """
+    view = build_home_view(
+        retrieve_auth_status(user_id),
+        {
+            'miro': url_for('auth_miro', user_id=user_id, _external=True),
+            'jira': url_for('auth_jira', user_id=user_id, _external=True)
         }
     )
+    view_hash = home_view_hash(view)
+    if not needs_publish(user_id, view_hash, published_hash):
+        logger.debug(f"Home tab for user {user_id} is unchanged; skipping views_publish.")
+        return
+    view["private_metadata"] = view_hash
+    try:
+        client.views_publish(user_id=user_id, view=view)
+    except Exception as e:
+        logger.error(f"Failed to publish Home tab for user {user_id}: {str(e)}")
+        return
+    record_published(user_id, view_hash)
+    logger.info(f"Home tab published for user {user_id}.")
+
 def store_tokens(user_id, access_token, refresh_token, service):
     """
     Stores access and refresh tokens in Firestore under the user's document.
@@ -187,6 +216,7 @@ def store_tokens(user_id, access_token, refresh_token, service):
             u'refresh_token': refresh_token
         }
         doc_ref.set(tokens)
+        update_cached_tokens(user_id, tokens)
         logger.info(f"Tokens for {service} stored successfully for user {user_id}.")
     except Exception as e:
         logger.error(f"Failed to store tokens for {service} for user {user_id}: {str(e)}")
@@ -195,18 +225,12 @@ def retrieve_tokens(user_id, service):
     """
     Retrieves the access and refresh tokens for a specific service for the given user.
     """
-    doc_ref = db.collection(u'users').document(user_id)
-    try:
-        user_data = doc_ref.get()
-        if user_data.exists:
-            service_tokens = user_data.to_dict().get(service, {})
-            return service_tokens.get('access_token'), service_tokens.get('refresh_token')
-        else:
-            logger.warning(f"No data found for user {user_id}.")
-            return None, None
-    except Exception as e:
-        logger.error(f"Failed to retrieve tokens for user {user_id}: {str(e)}")
+    user_tokens = get_user_tokens(user_id, required_services=(service,))
+    if not user_tokens:
+        logger.warning(f"No data found for user {user_id}.")
         return None, None
+    service_tokens = user_tokens.get(service, {})
+    return service_tokens.get('access_token'), service_tokens.get('refresh_token')
 
 def store_state_in_storage(state, key, user_id):
     """
@@ -325,6 +349,7 @@ def miro_callback():
         if access_token:
             # Store the tokens securely using Firestore
             store_tokens(user_id, access_token, refresh_token, 'miro')
+            publish_home_view(slack_app.client, user_id)
             logger.info("Authorization successful. Tokens stored.")
             return "Authorization successful. You may close this window."
         else:
@@ -406,6 +431,7 @@ def jira_callback():
     if access_token:
         # Store the tokens securely using Firestore
         store_tokens(user_id, access_token, refresh_token, 'jira')
+        publish_home_view(slack_app.client, user_id)
         return "Jira OAuth flow completed successfully.", 200
     else:
         return "Failed to obtain Jira access token.", 400
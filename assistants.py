@@ -1,209 +1,276 @@
 import asyncio
 import json
 import os
+import threading
 
 
 from openai import AsyncOpenAI
-from shared_resources import slack_app, logger, db
-from miro_data_assistant import analyze_miro_board_data
-from jira_board_info import retrieve_jira_issue, update_issue_summary_and_description, get_issues_for_epic, create_new_jira_issue
+from shared_resources import logger, db
+from tool_registry import registry as tool_registry
+from run_scheduler import ThreadRunScheduler
+from run_leases import ThreadLeaseManager, RUN_LEASES_ENABLED
+from metrics import register_metrics
+from upstream_governor import call_openai, upstream_user
+from thread_context import ThreadContextManager
+from usage_accounting import usage_ledger, current_conversation
+from profiling import profiled
 
 # Load environment variables
 
+# Initialize OpenAI API client
+# Retries are left to the upstream governor so they are not doubled up
+client = AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY"), max_retries=0)
+ASSISTANT_MODEL = os.environ.get("ASSISTANT_MODEL", "gpt-4-turbo-2024-04-09")
+
 # Global variables
-global_thread_id = None
+# Maps a conversation (the Slack user unless the caller says otherwise) to its OpenAI thread
+conversation_threads = {}
+conversation_threads_lock = threading.Lock()
+# With leases enabled, instances share the conversation mapping in Firestore and only the lease holder drives a thread
+thread_leases = ThreadLeaseManager(db) if RUN_LEASES_ENABLED else None
+run_scheduler = ThreadRunScheduler(leases=thread_leases)
+register_metrics("run_scheduler", lambda: dict(run_scheduler.stats))
+thread_context = ThreadContextManager(client)
+register_metrics("thread_context", thread_context.metrics)
 
-# Initialize OpenAI API client
-client = AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+@profiled("execute_function")
+async def execute_function(function_name, arguments, from_user):
+    """
+    Runs one tool call through the tool registry and returns its raw output.
+    """
+    return await tool_registry.dispatch(function_name, arguments, from_user)
 
-def retrieve_tokens(user_id, service):
+def _load_shared_thread_id(conversation_id):
+    doc = db.collection(u'conversation_threads').document(conversation_id).get()
+    return doc.to_dict().get('thread_id') if doc.exists else None
+
+def _store_shared_thread_id(conversation_id, thread_id):
     """
-    Retrieves access tokens for a specified service from Firestore.
+    Records the conversation's thread unless another instance got there first; returns the winner.
     """
+    doc_ref = db.collection(u'conversation_threads').document(conversation_id)
     try:
-        doc_ref = db.collection(u'users').document(user_id)
-        user_doc = doc_ref.get()
-        if user_doc.exists:
-            service_tokens = user_doc.to_dict().get(service, {})
-            return service_tokens
-        else:
-            logger.info(f"No token found for {service} for user {user_id}.")
-            return None
-    except Exception as e:
-        logger.error(f"Failed to retrieve tokens for {service} for user {user_id}: {str(e)}")
-        return None
+        doc_ref.create({u'thread_id': thread_id})
+        return thread_id
+    except Exception:
+        return _load_shared_thread_id(conversation_id) or thread_id
 
-async def execute_function(function_name, arguments, from_user):
-    # Retrieve tokens for both Miro and Jira using the user ID
-    miro_tokens = retrieve_tokens(from_user, 'miro')
-    jira_tokens = retrieve_tokens(from_user, 'jira')
-
-    miro_token = miro_tokens.get('access_token') if miro_tokens else None
-    jira_token = jira_tokens.get('access_token') if jira_tokens else None
-
-    if function_name == "get_miro_board_content":
-        if not miro_token:
-            logger.info("No Miro access token found. Prompting user to authenticate with Miro.")
-            slack_app.client.chat_postMessage(
-                channel=from_user,
-                text="Please authenticate with Miro to continue. Click on the button in the Home tab."
-            )
-            return {"status": "error", "message": "Miro authentication required."}
-        
-        board_id = arguments.get("board_id")
-        insights = await analyze_miro_board_data(board_id, miro_token)
-        return insights
-
-    elif function_name in ['get_jiraissue', 'update_jiraissue', 'get_issues_for_epic', 'create_new_jira_issue']:
-        if not jira_token:
-            logger.info("No Jira access token found. Prompting user to authenticate with Jira.")
-            slack_app.client.chat_postMessage(
-                channel=from_user,
-                text="Please authenticate with Jira to continue. Click on the button in the Home tab."
-            )
-            return {"status": "error", "message": "Jira authentication required."}
-
-        if function_name == 'get_jiraissue':
-            issue_id = arguments.get("issue_id")
-            return await retrieve_jira_issue(issue_id, jira_token)
-        elif function_name == 'update_jiraissue':
-            issue_id = arguments.get("issue_id")
-            summary = arguments.get("summary")
-            description = arguments.get("description")
-            return await update_issue_summary_and_description(jira_token, issue_id, summary, description)
-        elif function_name == "get_issues_for_epic":
-            epic_id = arguments.get("epic_id")
-            return await get_issues_for_epic(jira_token, epic_id)
-        elif function_name == "create_new_jira_issue":
-            summary = arguments.get("summary")
-            description = arguments.get("description")
-            project_id = arguments.get("project_id")
-            issue_type_id = arguments.get("issue_type_id")
-            return await create_new_jira_issue(jira_token, summary, description, project_id, issue_type_id)
+def replace_conversation_thread(conversation_id, thread_id):
+    """
+    Points the conversation at a new thread after a rollover.
+    """
+    with conversation_threads_lock:
+        conversation_threads[conversation_id] = thread_id
+    if thread_leases:
+        db.collection(u'conversation_threads').document(conversation_id).set({u'thread_id': thread_id})
+
+async def get_conversation_thread_id(conversation_id):
+    """
+    Returns the OpenAI thread for a conversation, creating it on first use.
+    """
+    if thread_leases:
+        thread_id = await asyncio.to_thread(_load_shared_thread_id, conversation_id)
     else:
-        return {"status": "error", "message": "Function not recognized"}
+        with conversation_threads_lock:
+            thread_id = conversation_threads.get(conversation_id)
+    if thread_id:
+        return thread_id
 
+    logger.debug(f"Creating a new thread for conversation {conversation_id}...")
+    thread = await call_openai(client.beta.threads.create)
+    if thread_leases:
+        thread_id = await asyncio.to_thread(_store_shared_thread_id, conversation_id, thread.id)
+    else:
+        with conversation_threads_lock:
+            thread_id = conversation_threads.setdefault(conversation_id, thread.id)
+    logger.debug(f"Conversation {conversation_id} is using thread ID: {thread_id}")
+    return thread_id
 
-async def process_thread_with_assistant(query, assistant_id, model="gpt-4-turbo-2024-04-09", from_user=None):
-    global global_thread_id
+@profiled("collect_assistant_response")
+async def collect_assistant_response(thread_id):
+    """
+    Fetches the latest assistant message on the thread and resolves its citations and files.
+    """
     response_texts = []
     response_files = []
     in_memory_files = []
-    try:
-        if not global_thread_id:
-            logger.debug("Creating a new thread for the user query...")
-            thread = await client.beta.threads.create()
-            global_thread_id = thread.id
-            logger.debug(f"New thread created with ID: {global_thread_id}")
-        
-        logger.debug("Adding the user query as a message to the thread...")
-        await client.beta.threads.messages.create(
-            thread_id=global_thread_id,
+
+    logger.debug("Fetching the latest message added by the assistant...")
+    messages = await call_openai(
+        client.beta.threads.messages.list,
+        thread_id=thread_id,
+        order="desc"
+    )
+
+    latest_assistant_message = next((message for message in messages.data if message.role == "assistant"), None)
+
+    if latest_assistant_message:
+        for content in latest_assistant_message.content:
+            if content.type == "text":
+                text_value = content.text.value
+                for annotation in content.text.annotations:
+                    if annotation.type == "file_citation":
+                        cited_file = await call_openai(client.files.retrieve, annotation.file_citation.file_id)
+                        citation_text = f"[Cited from {cited_file.filename}]"
+                        text_value = text_value.replace(annotation.text, citation_text)
+                    elif annotation.type == "file_path":
+                        file_info = await call_openai(client.files.retrieve, annotation.file_path.file_id)
+                        download_link = f"<https://platform.openai.com/files/{file_info.id}|Download {file_info.filename}>"
+                        text_value = text_value.replace(annotation.text, download_link)
+                response_texts.append(text_value)
+            elif content.type == "file":
+                file_id = content.file.file_id
+                file_mime_type = content.file.mime_type
+                response_files.append((file_id, file_mime_type))
+
+        for file_id, mime_type in response_files:
+            try:
+                logger.debug(f"Retrieving content for file ID: {file_id} with MIME type: {mime_type}")
+                file_response = await call_openai(client.files.content, file_id)
+                file_content = file_response.content if hasattr(file_response, 'content') else file_response
+
+                extensions = {
+                    "text/x-c": ".c", "text/x-csharp": ".cs", "text/x-c++": ".cpp",
+                    "application/msword": ".doc", "application/vnd.openxmlformats-officedocument.wordprocessingml.document": ".docx",
+                    "text/html": ".html", "text/x-java": ".java", "application/json": ".json",
+                    "text/markdown": ".md", "application/pdf": ".pdf", "text/x-php": ".php",
+                    "application/vnd.openxmlformats-officedocument.presentationml.presentation": ".pptx",
+                    "text/x-python": ".py", "text/x-script.python": ".py", "text/x-ruby": ".rb",
+                    "text/x-tex": ".tex", "text/plain": ".txt", "text/css": ".css",
+                    "text/javascript": ".js", "application/x-sh": ".sh", "application/typescript": ".ts",
+                    "application/csv": ".csv", "image/jpeg": ".jpeg", "image/gif": ".gif",
+                    "image/png": ".png", "application/x-tar": ".tar",
+                    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet": ".xlsx",
+                    "application/xml": "text/xml", "application/zip": ".zip"
+                }
+                file_extension = extensions.get(mime_type, ".bin")
+
+                local_file_path = f"./downloaded_file_{file_id}{file_extension}"
+                with open(local_file_path, "wb") as local_file:
+                    local_file.write(file_content)
+                logger.debug(f"File saved locally at {local_file_path}")
+
+            except Exception as e:
+                logger.error(f"Failed to retrieve content for file ID: {file_id}. Error: {e}")
+
+    return {"text": response_texts, "in_memory_files": in_memory_files}
+
+async def run_queries_on_thread(thread_id, queries, assistant_id, model, from_user, should_cancel=None, conversation_id=None):
+    """
+    Adds the queued user messages to the thread and drives a single run over them. A thread that
+    has grown too large is first rolled over to a fresh, summarized thread.
+
+    Returns:
+        dict: The assistant's response, or None if the run was cancelled because should_cancel() became true.
+    """
+    if conversation_id and thread_context.needs_rollover(thread_id):
+        new_thread_id = await thread_context.rollover(thread_id)
+        if new_thread_id != thread_id:
+            await asyncio.to_thread(run_scheduler.rekey, thread_id, new_thread_id)
+            await asyncio.to_thread(replace_conversation_thread, conversation_id, new_thread_id)
+            thread_id = new_thread_id
+
+    logger.debug(f"Adding {len(queries)} user message(s) to thread {thread_id}...")
+    for query in queries:
+        await call_openai(
+            client.beta.threads.messages.create,
+            thread_id=thread_id,
             role="user",
             content=query
         )
-        logger.debug("User query added to the thread.")
+    logger.debug("User messages added to the thread.")
 
-        logger.debug("Creating a run to process the thread with the assistant...")
-        run = await client.beta.threads.runs.create(
-            thread_id=global_thread_id,
-            assistant_id=assistant_id,
-            model=model
+    # Past the user's daily budget the run degrades to a smaller model and a shorter context instead of failing
+    model, run_options = await asyncio.to_thread(usage_ledger.apply_budget, from_user, model, thread_context.run_options(thread_id))
+
+    logger.debug("Creating a run to process the thread with the assistant...")
+    run = await call_openai(
+        client.beta.threads.runs.create,
+        thread_id=thread_id,
+        assistant_id=assistant_id,
+        model=model,
+        **run_options
+    )
+    logger.debug(f"Run created with ID: {run.id}")
+
+    cancel_requested = False
+    model_steps = 1
+    while True:
+        logger.debug("Checking the status of the run...")
+        run_status = await call_openai(
+            client.beta.threads.runs.retrieve,
+            thread_id=thread_id,
+            run_id=run.id
         )
-        logger.debug(f"Run created with ID: {run.id}")
+        logger.debug(f"Current status of the run: {run_status.status}")
 
-        while True:
-            logger.debug("Checking the status of the run...")
-            run_status = await client.beta.threads.runs.retrieve(
-                thread_id=global_thread_id,
-                run_id=run.id
-            )
-            logger.debug(f"Current status of the run: {run_status.status}")
+        if run_status.status in ["completed", "failed", "cancelled", "expired", "incomplete"]:
+            thread_context.record_usage(thread_id, run_status.usage, model_steps)
+            usage_ledger.record(model, run_status.usage, tool="assistant_run")
+            if run_status.status == "cancelled" and cancel_requested:
+                logger.debug(f"Superseded run {run.id} cancelled.")
+                return None
+            return await collect_assistant_response(thread_id)
 
-            if run_status.status == "requires_action":
-                logger.debug("Run requires action. Executing specified function...")
-                tool_call = run_status.required_action.submit_tool_outputs.tool_calls[0]
+        if should_cancel and should_cancel() and not cancel_requested:
+            logger.debug(f"Newer messages queued for thread {thread_id}; cancelling run {run.id}.")
+            try:
+                await call_openai(client.beta.threads.runs.cancel, thread_id=thread_id, run_id=run.id)
+                cancel_requested = True
+            except Exception as e:
+                logger.warning(f"Failed to cancel superseded run {run.id}: {e}")
+        elif run_status.status == "requires_action" and not cancel_requested:
+            tool_calls = run_status.required_action.submit_tool_outputs.tool_calls
+            logger.debug(f"Run requires action. Executing {len(tool_calls)} tool call(s)...")
+
+            async def run_tool_call(tool_call):
                 function_name = tool_call.function.name
-                arguments = json.loads(tool_call.function.arguments)
-
-                function_output = await execute_function(function_name, arguments, from_user)
-                function_output_str = json.dumps(function_output)
-
-                logger.debug("Submitting tool outputs...")
-                await client.beta.threads.runs.submit_tool_outputs(
-                    thread_id=global_thread_id,
-                    run_id=run.id,
-                    tool_outputs=[{
-                        "tool_call_id": tool_call.id,
-                        "output": function_output_str
-                    }]
-                )
-                logger.debug("Tool outputs submitted.")
-
-            elif run_status.status in ["completed", "failed", "cancelled"]:
-                logger.debug("Fetching the latest message added by the assistant...")
-                messages = await client.beta.threads.messages.list(
-                    thread_id=global_thread_id,
-                    order="desc"
-                )
-                
-                latest_assistant_message = next((message for message in messages.data if message.role == "assistant"), None)
-
-                if latest_assistant_message:
-                    for content in latest_assistant_message.content:
-                        if content.type == "text":
-                            text_value = content.text.value
-                            for annotation in content.text.annotations:
-                                if annotation.type == "file_citation":
-                                    cited_file = await client.files.retrieve(annotation.file_citation.file_id)
-                                    citation_text = f"[Cited from {cited_file.filename}]"
-                                    text_value = text_value.replace(annotation.text, citation_text)
-                                elif annotation.type == "file_path":
-                                    file_info = await client.files.retrieve(annotation.file_path.file_id)
-                                    download_link = f"<https://platform.openai.com/files/{file_info.id}|Download {file_info.filename}>"
-                                    text_value = text_value.replace(annotation.text, download_link)
-                            response_texts.append(text_value)
-                        elif content.type == "file":
-                            file_id = content.file.file_id
-                            file_mime_type = content.file.mime_type
-                            response_files.append((file_id, mime_type))
-
-                    for file_id, mime_type in response_files:
-                        try:
-                            logger.debug(f"Retrieving content for file ID: {file_id} with MIME type: {mime_type}")
-                            file_response = await client.files.content(file_id)
-                            file_content = file_response.content if hasattr(file_response, 'content') else file_response
-
-                            extensions = {
-                                "text/x-c": ".c", "text/x-csharp": ".cs", "text/x-c++": ".cpp",
-                                "application/msword": ".doc", "application/vnd.openxmlformats-officedocument.wordprocessingml.document": ".docx",
-                                "text/html": ".html", "text/x-java": ".java", "application/json": ".json",
-                                "text/markdown": ".md", "application/pdf": ".pdf", "text/x-php": ".php",
-                                "application/vnd.openxmlformats-officedocument.presentationml.presentation": ".pptx",
-                                "text/x-python": ".py", "text/x-script.python": ".py", "text/x-ruby": ".rb",
-                                "text/x-tex": ".tex", "text/plain": ".txt", "text/css": ".css",
-                                "text/javascript": ".js", "application/x-sh": ".sh", "application/typescript": ".ts",
-                                "application/csv": ".csv", "image/jpeg": ".jpeg", "image/gif": ".gif",
-                                "image/png": ".png", "application/x-tar": ".tar",
-                                "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet": ".xlsx",
-                                "application/xml": "text/xml", "application/zip": ".zip"
-                            }
-                            file_extension = extensions.get(mime_type, ".bin")
-
-                            local_file_path = f"./downloaded_file_{file_id}{file_extension}"
-                            with open(local_file_path, "wb") as local_file:
-                                local_file.write(file_content)
-                            logger.debug(f"File saved locally at {local_file_path}")
-
-                        except Exception as e:
-                            logger.error(f"Failed to retrieve content for file ID: {file_id}. Error: {e}")
-
-                break
-            await asyncio.sleep(1)
-
-        return {"text": response_texts, "in_memory_files": in_memory_files}
+                try:
+                    arguments = json.loads(tool_call.function.arguments or "{}")
+                except json.JSONDecodeError as e:
+                    function_output = {"status": "error", "message": f"Arguments are not valid JSON: {e}"}
+                else:
+                    function_output = await execute_function(function_name, arguments, from_user)
+                function_output_str, projection_report = tool_registry.project(function_name, function_output)
+                logger.debug(f"Tool output projection for {function_name}: {projection_report}")
+                return {"tool_call_id": tool_call.id, "output": function_output_str}
+
+            # Parallel tool calls all need an output before the run can continue
+            tool_outputs = await asyncio.gather(*(run_tool_call(tool_call) for tool_call in tool_calls))
+
+            logger.debug("Submitting tool outputs...")
+            await call_openai(
+                client.beta.threads.runs.submit_tool_outputs,
+                thread_id=thread_id,
+                run_id=run.id,
+                tool_outputs=list(tool_outputs)
+            )
+            logger.debug("Tool outputs submitted.")
+            model_steps += 1
+            continue
+
+        await asyncio.sleep(1)
+
+@profiled("process_thread_with_assistant")
+async def process_thread_with_assistant(query, assistant_id, model=None, from_user=None, conversation_id=None):
+    """
+    Sends a user query to the conversation's thread and returns the assistant's reply.
+
+    Queries arriving while a run is active on the same thread are coalesced into one follow-up run
+    by the run scheduler; callers whose query was folded into a later reply get COALESCED_RESPONSE.
+    """
+    conversation_id = conversation_id or from_user
+    model = model or ASSISTANT_MODEL
+    upstream_user.set(from_user)
+    current_conversation.set(conversation_id)
+    try:
+        thread_id = await get_conversation_thread_id(conversation_id)
+
+        async def run_batch(batch_thread_id, queries, should_cancel):
+            return await run_queries_on_thread(batch_thread_id, queries, assistant_id, model, from_user, should_cancel, conversation_id)
+
+        return await run_scheduler.submit(thread_id, query, run_batch)
 
     except Exception as e:
         logger.error(f"An error occurred: {e}")
         return {"text": [], "in_memory_files": []}
-    
\ No newline at end of file
@@ -0,0 +1,58 @@
+"""
+Measures tool output sizes before and after projection for representative Jira payloads.
+
+Usage: python benchmark_tool_outputs.py
+"""
+from tool_outputs import project_tool_output
+
+def _sample_raw_issue(index):
+    description = {
+        "type": "doc", "version": 1,
+        "content": [
+            {"type": "paragraph", "content": [{"type": "text", "text": f"Step {n} of the onboarding flow for issue {index}."}]}
+            for n in range(20)
+        ]
+    }
+    return {
+        "id": str(10000 + index),
+        "key": f"PROJ-{index}",
+        "self": f"https://example.atlassian.net/rest/api/2/issue/{10000 + index}",
+        "expand": "renderedFields,names,schema,operations,editmeta,changelog,versionedRepresentations",
+        "fields": {
+            "summary": f"Onboarding task {index}",
+            "description": description,
+            "issuetype": {"id": "10001", "name": "Task", "iconUrl": "https://example.com/icon.png", "subtask": False},
+            "status": {"id": "3", "name": "In Progress", "statusCategory": {"id": 4, "key": "indeterminate", "colorName": "yellow"}},
+            "assignee": {"accountId": "abc", "displayName": "Dana Lee", "avatarUrls": {size: f"https://example.com/{size}.png" for size in ("16x16", "24x24", "32x32", "48x48")}},
+            "reporter": {"accountId": "def", "displayName": "Sam Park", "avatarUrls": {size: f"https://example.com/{size}.png" for size in ("16x16", "24x24", "32x32", "48x48")}},
+            "priority": {"id": "3", "name": "Medium", "iconUrl": "https://example.com/medium.svg"},
+            "labels": ["onboarding"],
+            **{f"customfield_{10000 + n}": None for n in range(60)}
+        },
+        "renderedFields": {"description": "<p>" + "Rendered onboarding description. " * 40 + "</p>"},
+        "names": {f"customfield_{10000 + n}": f"Custom field {n}" for n in range(60)},
+        "schema": {f"customfield_{10000 + n}": {"type": "string", "custom": "com.atlassian.jira.plugin.system.customfieldtypes:textfield", "customId": 10000 + n} for n in range(60)},
+    }
+
+def benchmark_projection():
+    """
+    Measures output size before and after projection for representative tool payloads.
+    """
+    samples = {
+        "get_jiraissue": {"issue_details": _sample_raw_issue(1)},
+        "get_issues_for_epic": {
+            "EpicDetails": {"Key": "PROJ-1", "Summary": "Onboarding", "Description": "Epic description"},
+            "ChildIssues": [_sample_raw_issue(n) for n in range(2, 42)]
+        },
+    }
+    results = {}
+    for function_name, output in samples.items():
+        _, report = project_tool_output(function_name, output)
+        results[function_name] = report
+    return results
+
+if __name__ == "__main__":
+    for function_name, report in benchmark_projection().items():
+        print(f"{function_name}: {report['original_bytes']} -> {report['projected_bytes']} bytes "
+              f"(~{report['approx_tokens_saved']} tokens saved, {report['items_dropped']} items dropped, "
+              f"{report['strings_truncated']} strings truncated)")
@@ -0,0 +1,9 @@
+import os
+
+# Loaded automatically by gunicorn from the working directory.
+# With TASK_DISPATCH_MODE=cloud_tasks a whole message is processed inside the task request, so the
+# worker timeout must outlast TASK_DISPATCH_DEADLINE_SECONDS (see task_dispatch.py); the default
+# of 30s would kill the worker mid-run and make Cloud Tasks retry the message.
+bind = f"0.0.0.0:{os.environ.get('PORT', 8080)}"
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 660))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", 30))
@@ -0,0 +1,76 @@
+import hashlib
+import json
+import threading
+
+# Services shown on the Home tab, in display order: (token store key, display name)
+HOME_SERVICES = [('miro', 'Miro'), ('jira', 'Jira')]
+
+# Hash of the last view published per user by this instance
+_published_hashes = {}
+_published_hashes_lock = threading.Lock()
+
+def build_home_view(auth_status, auth_urls):
+    """
+    Builds the Home tab view.
+
+    Args:
+        auth_status (dict): Whether the user is connected, keyed by service ('miro', 'jira').
+        auth_urls (dict): Authentication URL per service.
+    """
+    status_lines = [
+        f"{':white_check_mark:' if auth_status.get(service) else ':white_circle:'} *{name}*: {'connected' if auth_status.get(service) else 'not connected'}"
+        for service, name in HOME_SERVICES
+    ]
+    buttons = [
+        {
+            "type": "button",
+            "text": {
+                "type": "plain_text",
+                "text": f"Reconnect {name}" if auth_status.get(service) else f"Authenticate with {name}"
+            },
+            "value": f"{service}_auth",
+            "action_id": f"{service}_auth",
+            "url": auth_urls[service]
+        }
+        for service, name in HOME_SERVICES
+    ]
+    return {
+        "type": "home",
+        "blocks": [
+            {
+                "type": "section",
+                "text": {
+                    "type": "mrkdwn",
+                    "text": "Welcome to the Slack Integration! Please authenticate with the services you need:"
+                }
+            },
+            {
+                "type": "section",
+                "text": {
+                    "type": "mrkdwn",
+                    "text": "\n".join(status_lines)
+                }
+            },
+            {
+                "type": "actions",
+                "elements": buttons
+            }
+        ]
+    }
+
+def home_view_hash(view):
+    return hashlib.sha256(json.dumps(view, sort_keys=True).encode('utf-8')).hexdigest()
+
+def needs_publish(user_id, view_hash, slack_view_metadata=None):
+    """
+    True unless this exact view is already on the user's Home tab, as known from this instance's
+    last publish or from the hash stored in the published view's private_metadata.
+    """
+    if slack_view_metadata == view_hash:
+        return False
+    with _published_hashes_lock:
+        return _published_hashes.get(user_id) != view_hash or slack_view_metadata not in (None, view_hash)
+
+def record_published(user_id, view_hash):
+    with _published_hashes_lock:
+        _published_hashes[user_id] = view_hash
@@ -1,14 +1,46 @@
 from http.server import BaseHTTPRequestHandler
 from urllib.parse import urlparse, parse_qs
 from logger_config import setup_logger
+from upstream_governor import upstream, JIRA_HOST, CircuitOpenError
 import requests
+import aiohttp
+import asyncio
 import json
 import os
+from profiling import profiled
 
 
 logger = setup_logger()
 
 CLOUD_ID = os.getenv("CLOUD_ID")
+JIRA_POOL_SIZE = int(os.getenv("JIRA_POOL_SIZE", 8))
+# Per-attempt timeout of Jira API requests, in seconds
+JIRA_REQUEST_TIMEOUT_SECONDS = float(os.getenv("JIRA_REQUEST_TIMEOUT_SECONDS", 10))
+# Retrying these cannot repeat a side effect; other methods are only retried when Jira throttled them
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+
+# Shared keep-alive session so Jira calls reuse TLS connections instead of opening one per request
+jira_session = requests.Session()
+jira_session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=JIRA_POOL_SIZE))
+
+def jira_request(method, url, idempotent=None, **kwargs):
+    """
+    Sends a Jira API request through the shared upstream governor (rate limits, retries, circuit breaker).
+    Pass idempotent=True for a POST that only reads, such as a JQL search, so transient failures are retried.
+    """
+    if idempotent is None:
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+    kwargs.setdefault("timeout", JIRA_REQUEST_TIMEOUT_SECONDS)
+    return upstream.call(JIRA_HOST, lambda: jira_session.request(method, url, **kwargs), idempotent=idempotent)
+
+def warm_jira_connection():
+    """
+    Opens a pooled connection to the Jira API host so the user's first real call skips the TLS handshake.
+    """
+    try:
+        jira_session.head(f"https://{JIRA_HOST}/", timeout=5)
+    except requests.RequestException as e:
+        logger.debug(f"Jira connection warm-up failed: {e}")
 
 class JiraOAuthHandler(BaseHTTPRequestHandler):
     def do_GET(self):
@@ -27,7 +59,8 @@ class JiraOAuthHandler(BaseHTTPRequestHandler):
             self.wfile.write(b'Authorization failed.')
             logger.warning("Authorization failed, no code found in request.")
             
-async def create_new_jira_issue(token, summary, description, project_id, issue_type_id):
+@profiled("jira.create_new_jira_issue")
+def create_new_jira_issue(token, summary, description, project_id, issue_type_id):
     if not token:
         error_response = {
             "errorMessages": ["No access token provided. Please authenticate."],
@@ -67,7 +100,7 @@ async def create_new_jira_issue(token, summary, description, project_id, issue_t
     })
 
     try:
-        response = requests.post(url, headers=headers, data=payload)
+        response = jira_request("POST", url, headers=headers, data=payload)
         if response.status_code == 201:
             logger.success("Issue created successfully.", extra={"response": response.json(), "status": response.status_code})
             return response.json()
@@ -87,15 +120,16 @@ async def create_new_jira_issue(token, summary, description, project_id, issue_t
         }
         logger.exception("Error making API request.", exception=e)
         return error_response
-def update_issue_summary_and_description(token, issue_id_or_key, summary, description):
+@profiled("jira.update_issue")
+def update_issue_summary_and_description(token, issue_id_or_key, summary=None, description=None):
     """
-    Updates the summary and description of a given issue.
+    Updates the summary and/or description of a given issue; a field passed as None is left unchanged.
 
     Args:
         token (str): The access token for Jira API.
         issue_id_or_key (str): The ID or key of the issue to update.
-        summary (str): The new summary for the issue.
-        description (str): The new description for the issue.
+        summary (str): The new summary for the issue, or None.
+        description (str): The new description for the issue, or None.
 
     Returns:
         bool: True if the update was successful, False otherwise.
@@ -104,21 +138,21 @@ def update_issue_summary_and_description(token, issue_id_or_key, summary, descri
         logger.error("No access token provided. User needs to authenticate.", extra={"token": token})
         return False
 
+    fields = {name: value for name, value in (("summary", summary), ("description", description)) if value is not None}
+    if not fields:
+        logger.error("No fields to update.", extra={"issue_id": issue_id_or_key})
+        return False
+
     cloud_id = CLOUD_ID
     url = f"https://api.atlassian.com/ex/jira/{cloud_id}/rest/api/2/issue/{issue_id_or_key}"
     headers = {
         "Authorization": f"Bearer {token}",
         "Content-Type": "application/json"
     }
-    payload = {
-        "fields": {
-            "summary": summary,
-            "description": description
-        }
-    }
+    payload = {"fields": fields}
 
     try:
-        response = requests.put(url, headers=headers, json=payload)
+        response = jira_request("PUT", url, headers=headers, json=payload)
         if response.status_code == 204:
             logger.success("Issue updated successfully.", extra={"issue_id": issue_id_or_key, "status": response.status_code})
             return True
@@ -130,6 +164,7 @@ def update_issue_summary_and_description(token, issue_id_or_key, summary, descri
         return False
 
 
+@profiled("jira.get_issue_details")
 def get_issue_details(token, cloud_id, issue_id_or_key, fields=None, fields_by_keys=False, expand=None, properties=None, update_history=False):
     url = f"https://api.atlassian.com/ex/jira/{cloud_id}/rest/api/2/issue/{issue_id_or_key}"
     logger.trace("Fetching issue details.", extra={"issue_id": issue_id_or_key, "cloud_id": cloud_id})
@@ -150,7 +185,7 @@ def get_issue_details(token, cloud_id, issue_id_or_key, fields=None, fields_by_k
     logger.debug("Authorization headers set.", extra={"token": token[:10]})
 
     try:
-        response = requests.get(url, headers=headers, params=params)
+        response = jira_request("GET", url, headers=headers, params=params)
         if response.status_code == 200:
             response_json = response.json()
             logger.success("Issue details fetched successfully.", extra={"response_size": len(str(response_json)), "status": response.status_code})
@@ -162,7 +197,8 @@ def get_issue_details(token, cloud_id, issue_id_or_key, fields=None, fields_by_k
         logger.exception("Network error occurred while fetching issue details.", exception=e)
         return None
     
-async def retrieve_jira_issue(issue_key, token):
+@profiled("jira.retrieve_jira_issue")
+def retrieve_jira_issue(issue_key, token):
     logger.trace("Entering retrieve_jira_issue function with issue_key: {}", issue_key)
     if not issue_key:
         logger.warning("No Jira Issue Key provided. Operation aborted.")
@@ -182,6 +218,7 @@ async def retrieve_jira_issue(issue_key, token):
         logger.error("Error retrieving issue from Jira: {}", e)
         return None
 
+@profiled("jira.get_epic_details")
 def get_epic_details(epic_id_or_key, token):
     logger.trace("Entering get_epic_details function with epic_id_or_key: {}", epic_id_or_key)
     if not token:
@@ -196,7 +233,7 @@ def get_epic_details(epic_id_or_key, token):
     url = f"https://api.atlassian.com/ex/jira/{cloud_id}/rest/api/2/issue/{epic_id_or_key}"
 
     try:
-        response = requests.get(url, headers=headers)
+        response = jira_request("GET", url, headers=headers)
         if response.status_code == 200:
             epic_details = response.json()
             logger.success("Epic details retrieved successfully for {}", epic_id_or_key)
@@ -211,10 +248,11 @@ def get_epic_details(epic_id_or_key, token):
     except requests.exceptions.RequestException as e:
         logger.exception("Network error occurred while retrieving epic details: {}", e)
         return None
-def get_issues_for_epic(epic_id_or_key):
+@profiled("jira.get_issues_for_epic")
+def get_issues_for_epic(token, epic_id_or_key):
     logger.trace("Entering get_issues_for_epic function with epic_id_or_key: {}", epic_id_or_key)
-    epic_details = get_epic_details(epic_id_or_key)
-    child_issues = get_child_issues_for_epic(epic_id_or_key)
+    epic_details = get_epic_details(epic_id_or_key, token)
+    child_issues = get_child_issues_for_epic(epic_id_or_key, token)
     combined_details = {
         "EpicDetails": epic_details,
         "ChildIssues": child_issues
@@ -222,6 +260,7 @@ def get_issues_for_epic(epic_id_or_key):
     logger.debug("Combined epic and child issues details: {}", combined_details)
     return combined_details
 
+@profiled("jira.get_child_issues_for_epic")
 def get_child_issues_for_epic(epic_id_or_key, token):
     logger.trace("Entering get_child_issues_for_epic function with epic_id_or_key: {}", epic_id_or_key)
     if not token:
@@ -243,7 +282,7 @@ def get_child_issues_for_epic(epic_id_or_key, token):
     }
 
     try:
-        response = requests.post(url, headers=headers, json=payload)
+        response = jira_request("POST", url, headers=headers, json=payload, idempotent=True)
         if response.status_code == 200:
             issues = response.json().get('issues', [])
             logger.success("Child issues retrieved successfully for epic {}", epic_id_or_key)
@@ -302,3 +341,167 @@ def format_jira_issue(raw_issue_details):
     }
     logger.debug("Formatted Jira issue: {}", formatted_issue)
     return formatted_issue
+
+# Jira Cloud is retiring POST /rest/api/2/search (startAt paging, reports a total) in favour of
+# POST /rest/api/2/search/jql (nextPageToken paging, no total). "start_at" targets the old endpoint and
+# fetches pages concurrently; "token" targets the new one, whose pages can only be fetched in sequence.
+JIRA_SEARCH_PAGING = os.getenv("JIRA_SEARCH_PAGING", "start_at")
+SEARCH_PAGE_SIZE = 100
+SEARCH_MAX_CONCURRENCY = 4
+# Upper bound on issues a single search returns, whatever max_results the caller asks for
+SEARCH_MAX_RESULTS = 1000
+SEARCH_DEFAULT_FIELDS = ["summary", "status", "assignee", "issuetype", "priority"]
+
+def _compact_field_value(value, max_chars=200):
+    """
+    Collapses a Jira field value (user, status, option, list...) into a short string for tabular output.
+    """
+    if value is None:
+        return None
+    if isinstance(value, dict):
+        for attr in ('displayName', 'name', 'value', 'key'):
+            if value.get(attr) is not None:
+                return str(value[attr])[:max_chars]
+        return json.dumps(value)[:max_chars]
+    if isinstance(value, list):
+        return ", ".join(filter(None, (_compact_field_value(item, max_chars) for item in value)))[:max_chars]
+    return str(value)[:max_chars]
+
+def compact_issue_rows(issues, fields):
+    """
+    Converts raw search results into rows of compact values, one row per issue, with the key first.
+    """
+    rows = []
+    for issue in issues:
+        issue_fields = issue.get('fields', {})
+        rows.append([issue.get('key')] + [_compact_field_value(issue_fields.get(field)) for field in fields])
+    return rows
+
+async def _fetch_search_page(session, url, headers, payload):
+    async def post_page():
+        async with session.post(url, headers=headers, json=payload) as response:
+            if response.status == 429 or response.status >= 500:
+                # Raise so the governor backs off and retries throttled or transient failures
+                response.raise_for_status()
+            if response.status != 200:
+                text = await response.text()
+                logger.error("JQL search page failed. Status code: {}, Response: {}", response.status, text[:200])
+                return None
+            return await response.json()
+
+    # The search POST only reads, so it is safe to retry
+    return await upstream.call_async(JIRA_HOST, post_page, idempotent=True)
+
+async def _search_by_start_at(session, headers, jql, fields, max_results):
+    """
+    Pages POST /rest/api/2/search by startAt: the first page gives the total, the rest are fetched concurrently.
+
+    Returns:
+        tuple: (issues, total), or None if the first page failed.
+    """
+    url = f"https://api.atlassian.com/ex/jira/{CLOUD_ID}/rest/api/2/search"
+
+    def page(start_at, size):
+        return _fetch_search_page(session, url, headers, {"jql": jql, "startAt": start_at, "maxResults": size, "fields": fields})
+
+    first_page = await page(0, min(SEARCH_PAGE_SIZE, max_results))
+    if first_page is None:
+        return None
+
+    issues = first_page.get('issues', [])
+    total = first_page.get('total', len(issues))
+    limit = min(total, max_results)
+    # Jira may cap maxResults below what was asked for; page by what it actually returned
+    page_size = max(1, min(first_page.get('maxResults') or SEARCH_PAGE_SIZE, SEARCH_PAGE_SIZE))
+
+    semaphore = asyncio.Semaphore(SEARCH_MAX_CONCURRENCY)
+
+    async def fetch(start_at):
+        async with semaphore:
+            return await page(start_at, min(page_size, limit - start_at))
+
+    pages = await asyncio.gather(*(fetch(start_at) for start_at in range(len(issues), limit, page_size)))
+    for result in pages:
+        if result is None:
+            logger.warning("A JQL search page failed; returning partial results.")
+            continue
+        issues.extend(result.get('issues', []))
+    return issues, total
+
+async def _search_by_token(session, headers, jql, fields, max_results):
+    """
+    Pages POST /rest/api/2/search/jql by nextPageToken, one page after another. The endpoint reports
+    no total, so it is the number of issues when every page was read and None otherwise.
+
+    Returns:
+        tuple: (issues, total), or None if the first page failed.
+    """
+    url = f"https://api.atlassian.com/ex/jira/{CLOUD_ID}/rest/api/2/search/jql"
+    issues = []
+    next_page_token = None
+    while len(issues) < max_results:
+        payload = {"jql": jql, "maxResults": min(SEARCH_PAGE_SIZE, max_results - len(issues)), "fields": fields}
+        if next_page_token:
+            payload["nextPageToken"] = next_page_token
+        result = await _fetch_search_page(session, url, headers, payload)
+        if result is None:
+            if not issues:
+                return None
+            logger.warning("A JQL search page failed; returning partial results.")
+            return issues, None
+        issues.extend(result.get('issues', []))
+        next_page_token = result.get('nextPageToken')
+        if result.get('isLast') or not next_page_token:
+            return issues, len(issues)
+    return issues, None
+
+@profiled("jira.search_jira_issues")
+async def search_jira_issues(token, jql, fields=None, max_results=200):
+    """
+    Runs a JQL search and returns the matching issues as compact rows. JIRA_SEARCH_PAGING selects
+    the search endpoint and how it is paged.
+
+    Args:
+        token (str): The access token for Jira API.
+        jql (str): The JQL query to run.
+        fields (list): The fields to return for each issue. Defaults to SEARCH_DEFAULT_FIELDS.
+        max_results (int): The maximum number of issues to return, at most SEARCH_MAX_RESULTS.
+
+    Returns:
+        dict: The column names, one row per issue, the total match count (None if the endpoint
+            did not report it) and whether rows were cut off.
+    """
+    logger.trace("Entering search_jira_issues with jql: {}", jql)
+    if not token:
+        logger.error("No access token provided. User needs to authenticate.")
+        return {"status": "error", "message": "No access token provided. Please authenticate."}
+    if not jql:
+        logger.warning("No JQL provided. Operation aborted.")
+        return {"status": "error", "message": "A JQL query is required."}
+
+    fields = [field for field in (fields or SEARCH_DEFAULT_FIELDS) if field and field != 'key']
+    max_results = min(max(1, int(max_results)), SEARCH_MAX_RESULTS)
+    headers = {
+        "Authorization": f"Bearer {token}",
+        "Content-Type": "application/json"
+    }
+    pager = _search_by_token if JIRA_SEARCH_PAGING == "token" else _search_by_start_at
+
+    try:
+        async with aiohttp.ClientSession() as session:
+            result = await pager(session, headers, jql, fields, max_results)
+            if result is None:
+                return {"status": "error", "message": "JQL search failed."}
+            issues, total = result
+    except (aiohttp.ClientError, CircuitOpenError) as e:
+        logger.exception("Network error occurred while searching issues: {}", e)
+        return {"status": "error", "message": f"Network error: {e}"}
+
+    issues = issues[:max_results]
+    logger.success("JQL search returned {} of {} issues.", len(issues), total)
+    return {
+        "columns": ["key"] + fields,
+        "rows": compact_issue_rows(issues, fields),
+        "total": total,
+        "truncated": total is None or total > len(issues)
+    }
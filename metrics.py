@@ -0,0 +1,25 @@
+from logger_config import setup_logger
+
+logger = setup_logger()
+
+# Metric sources by name; each is a callable returning a JSON-serializable dict
+_metric_sources = {}
+
+def register_metrics(name, collect):
+    """
+    Registers a callable whose dict output is reported under name by metrics_snapshot.
+    """
+    _metric_sources[name] = collect
+
+def metrics_snapshot():
+    """
+    Collects the current value of every registered metric source.
+    """
+    snapshot = {}
+    for name, collect in list(_metric_sources.items()):
+        try:
+            snapshot[name] = collect()
+        except Exception as e:
+            logger.error(f"Failed to collect metrics for {name}: {e}")
+            snapshot[name] = {"error": str(e)}
+    return snapshot
@@ -0,0 +1,110 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from logger_config import setup_logger
+
+logger = setup_logger()
+
+MIRO_ANALYSIS_CACHE_SIZE = int(os.environ.get("MIRO_ANALYSIS_CACHE_SIZE", 128))
+MIRO_ANALYSIS_CACHE_TTL_SECONDS = float(os.environ.get("MIRO_ANALYSIS_CACHE_TTL_SECONDS", 3600))
+MIRO_ANALYSIS_CACHE_FIRESTORE = os.environ.get("MIRO_ANALYSIS_CACHE_FIRESTORE", "false").lower() == "true"
+MIRO_ANALYSIS_CACHE_COLLECTION = 'miro_analysis_cache'
+
+# Fields that change without the board's content changing (edit metadata, pagination, API links)
+VOLATILE_FIELDS = {'createdAt', 'createdBy', 'modifiedAt', 'modifiedBy', 'links', 'cursor', 'lastOpenedAt', 'lastOpenedBy'}
+
+def normalize_board_content(value):
+    """
+    Strips volatile fields and orders items by ID, so unchanged boards normalize identically.
+    """
+    if isinstance(value, dict):
+        normalized = {key: normalize_board_content(item) for key, item in value.items() if key not in VOLATILE_FIELDS}
+        for key in ('items', 'connectors'):
+            if isinstance(normalized.get(key), list):
+                normalized[key] = sorted(normalized[key], key=lambda item: str(item.get('id')) if isinstance(item, dict) else str(item))
+        return normalized
+    if isinstance(value, list):
+        return [normalize_board_content(item) for item in value]
+    return value
+
+def analysis_cache_key(board_content, prompt, model):
+    """
+    Content address of an analysis: the normalized board together with the prompt and model.
+    """
+    digest = hashlib.sha256()
+    digest.update(model.encode('utf-8'))
+    digest.update(b'\0')
+    digest.update(prompt.encode('utf-8'))
+    digest.update(b'\0')
+    digest.update(json.dumps(normalize_board_content(board_content), sort_keys=True, separators=(',', ':'), default=str).encode('utf-8'))
+    return digest.hexdigest()
+
+class AnalysisCache:
+    """
+    LRU cache with TTL expiry for Miro analyses, optionally backed by a Firestore collection so
+    other instances can reuse results.
+    """
+
+    def __init__(self, max_entries=MIRO_ANALYSIS_CACHE_SIZE, ttl=MIRO_ANALYSIS_CACHE_TTL_SECONDS, db=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.db = db
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "firestore_hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry[1]
+            if entry:
+                del self._entries[key]
+
+        if self.db is not None:
+            try:
+                doc = self.db.collection(MIRO_ANALYSIS_CACHE_COLLECTION).document(key).get()
+                if doc.exists and doc.to_dict().get('expires_at', 0) > now:
+                    value = doc.to_dict().get('analysis')
+                    self._store_local(key, value, doc.to_dict()['expires_at'])
+                    with self._lock:
+                        self.stats["firestore_hits"] += 1
+                    return value
+            except Exception as e:
+                logger.error(f"Failed to read cached Miro analysis {key[:12]}: {e}")
+
+        with self._lock:
+            self.stats["misses"] += 1
+        return None
+
+    def put(self, key, value):
+        expires_at = time.time() + self.ttl
+        self._store_local(key, value, expires_at)
+        if self.db is not None:
+            try:
+                self.db.collection(MIRO_ANALYSIS_CACHE_COLLECTION).document(key).set({'analysis': value, 'expires_at': expires_at})
+            except Exception as e:
+                logger.error(f"Failed to store Miro analysis {key[:12]} in Firestore: {e}")
+
+    def _store_local(self, key, value, expires_at):
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def metrics(self):
+        with self._lock:
+            lookups = self.stats["hits"] + self.stats["firestore_hits"] + self.stats["misses"]
+            return {
+                **self.stats,
+                "entries": len(self._entries),
+                "hit_rate": (self.stats["hits"] + self.stats["firestore_hits"]) / lookups if lookups else 0.0
+            }
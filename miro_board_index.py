@@ -0,0 +1,223 @@
+import html
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+from miro_board_info import get_miro_board_content
+from logger_config import setup_logger
+
+logger = setup_logger()
+
+GRID_CELL_SIZE = 1000
+MIRO_INDEX_TTL_SECONDS = float(os.environ.get("MIRO_INDEX_TTL_SECONDS", 120))
+FRAME_CONTENT_MAX_ITEMS = 200
+
+_TAG_PATTERN = re.compile(r"<[^>]+>")
+
+def item_text(item):
+    """
+    Returns the visible text of a Miro item (content, title or text) without HTML markup.
+    """
+    data = item.get('data') or {}
+    parts = [data.get(field) for field in ('title', 'content', 'text') if data.get(field)]
+    text = " ".join(str(part) for part in parts)
+    text = re.sub(r"</p>|<br\s*/?>", "\n", text)
+    return html.unescape(_TAG_PATTERN.sub("", text)).strip()
+
+def compact_item(item):
+    compact = {"id": item.get('id'), "type": item.get('type')}
+    text = item_text(item)
+    if text:
+        compact["text"] = text
+    if (item.get('style') or {}).get('fillColor'):
+        compact["color"] = item['style']['fillColor']
+    return compact
+
+class MiroBoardIndex:
+    """
+    Index over a board's items: parent frame membership, a uniform grid over absolute item
+    bounding boxes, and buckets by item type.
+    """
+
+    def __init__(self, items, cell_size=GRID_CELL_SIZE):
+        self.cell_size = cell_size
+        self.by_id = {item['id']: item for item in items if item.get('id')}
+        self.children = defaultdict(list)
+        self.by_type = defaultdict(list)
+        self.frames_by_title = defaultdict(list)
+        self.grid = defaultdict(set)
+        self.bounds = {}
+
+        for item_id, item in self.by_id.items():
+            self.by_type[item.get('type')].append(item_id)
+            parent_id = (item.get('parent') or {}).get('id')
+            if parent_id:
+                self.children[parent_id].append(item_id)
+            if item.get('type') == 'frame':
+                self.frames_by_title[item_text(item).lower()].append(item_id)
+
+        for item_id in self.by_id:
+            box = self._absolute_bounds(item_id)
+            if box is None:
+                continue
+            for cell in self._cells(box):
+                self.grid[cell].add(item_id)
+
+    def _absolute_bounds(self, item_id, depth=0):
+        if item_id in self.bounds:
+            return self.bounds[item_id]
+        item = self.by_id.get(item_id)
+        position = (item or {}).get('position')
+        if not position or 'x' not in position or 'y' not in position or depth > 10:
+            return None
+        geometry = item.get('geometry') or {}
+        width = geometry.get('width') or 0
+        height = geometry.get('height') or width
+        x, y = position['x'], position['y']
+
+        # Children are positioned relative to their parent's top-left corner
+        if position.get('relativeTo') == 'parent_top_left':
+            parent_box = self._absolute_bounds((item.get('parent') or {}).get('id'), depth + 1)
+            if parent_box is None:
+                return None
+            x += parent_box[0]
+            y += parent_box[1]
+
+        if position.get('origin', 'center') == 'center':
+            box = (x - width / 2, y - height / 2, x + width / 2, y + height / 2)
+        else:
+            box = (x, y, x + width, y + height)
+        self.bounds[item_id] = box
+        return box
+
+    def _cells(self, box):
+        x0, y0, x1, y1 = (int(coordinate // self.cell_size) for coordinate in box)
+        return ((cx, cy) for cx in range(x0, x1 + 1) for cy in range(y0, y1 + 1))
+
+    def find_frames(self, title):
+        """
+        Frames whose title matches exactly (case-insensitive), falling back to substring matches.
+        """
+        title = (title or "").strip().lower()
+        if title in self.frames_by_title:
+            return list(self.frames_by_title[title])
+        return [frame_id for frame_title, frame_ids in self.frames_by_title.items() if title and title in frame_title for frame_id in frame_ids]
+
+    def frame_titles(self):
+        return sorted(item_text(self.by_id[frame_id]) for frame_id in self.by_type.get('frame', []))
+
+    def query_area(self, x0, y0, x1, y1, item_types=None):
+        """
+        IDs of items whose bounding box intersects the given canvas rectangle.
+        """
+        cx0, cy0, cx1, cy1 = (int(coordinate // self.cell_size) for coordinate in (x0, y0, x1, y1))
+        if (cx1 - cx0 + 1) * (cy1 - cy0 + 1) > len(self.grid):
+            # Area covers more cells than are occupied; scanning the boxes directly is cheaper
+            candidates = self.bounds.keys()
+        else:
+            candidates = set()
+            for cell in self._cells((x0, y0, x1, y1)):
+                candidates |= self.grid.get(cell, set())
+        matches = []
+        for item_id in candidates:
+            bx0, by0, bx1, by1 = self.bounds[item_id]
+            if bx1 < x0 or bx0 > x1 or by1 < y0 or by0 > y1:
+                continue
+            if item_types and self.by_id[item_id].get('type') not in item_types:
+                continue
+            matches.append(item_id)
+        return matches
+
+    def frame_items(self, frame_id, item_types=None):
+        """
+        IDs of a frame's children plus unparented items lying entirely inside it.
+        """
+        members = list(self.children.get(frame_id, []))
+        box = self.bounds.get(frame_id)
+        if box:
+            seen = set(members)
+            for item_id in self.query_area(*box):
+                if item_id in seen or item_id == frame_id or (self.by_id[item_id].get('parent') or {}).get('id'):
+                    continue
+                ix0, iy0, ix1, iy1 = self.bounds[item_id]
+                if ix0 >= box[0] and iy0 >= box[1] and ix1 <= box[2] and iy1 <= box[3]:
+                    members.append(item_id)
+        if item_types:
+            members = [item_id for item_id in members if self.by_id[item_id].get('type') in item_types]
+        return members
+
+    def order_by_position(self, item_ids):
+        """
+        Sorts items top-to-bottom, then left-to-right, which is the usual reading order on a board.
+        """
+        return sorted(item_ids, key=lambda item_id: (self.bounds.get(item_id, (0, 0))[1], self.bounds.get(item_id, (0, 0))[0]))
+
+# Recently built indexes by (board ID, token), so follow-up questions about other frames skip the
+# crawl without letting one user read a board through another user's fetch
+_index_cache = {}
+_index_cache_lock = threading.Lock()
+
+async def get_board_index(board_id, access_token):
+    cache_key = (board_id, access_token)
+    with _index_cache_lock:
+        cached = _index_cache.get(cache_key)
+    if cached and cached[0] > time.time():
+        return cached[1], cached[2]
+
+    board_content = await get_miro_board_content(board_id, access_token)
+    if "error" in board_content:
+        return None, board_content
+    index = MiroBoardIndex(board_content.get('items', []))
+    logger.debug(f"Indexed {len(index.by_id)} items for Miro board {board_id}.")
+    now = time.time()
+    with _index_cache_lock:
+        for key in [key for key, entry in _index_cache.items() if entry[0] <= now]:
+            del _index_cache[key]
+        _index_cache[cache_key] = (now + MIRO_INDEX_TTL_SECONDS, index, board_content)
+    return index, board_content
+
+async def get_miro_frame_content(board_id, access_token, frame_title=None, area=None, item_types=None, max_items=FRAME_CONTENT_MAX_ITEMS):
+    """
+    Returns only the items inside a named frame, or inside a canvas area, of a Miro board.
+
+    Args:
+        board_id (str): The Miro board ID.
+        access_token (str): The user's Miro access token.
+        frame_title (str): Title of the frame to return.
+        area (dict): Canvas rectangle as {"x", "y", "width", "height"}, x/y being the top-left corner.
+        item_types (list): Optional item types to keep (e.g. ["sticky_note", "text"]).
+        max_items (int): The maximum number of items to return.
+
+    Returns:
+        dict: The matched frame or area and its items in reading order.
+    """
+    index, board_content = await get_board_index(board_id, access_token)
+    if index is None:
+        return board_content
+
+    if frame_title:
+        frame_ids = index.find_frames(frame_title)
+        if not frame_ids:
+            return {"status": "error", "message": f"No frame titled '{frame_title}'.", "frames": index.frame_titles()}
+        item_ids = []
+        for frame_id in frame_ids:
+            item_ids.extend(index.frame_items(frame_id, item_types))
+        scope = {"frames": [compact_item(index.by_id[frame_id]) for frame_id in frame_ids]}
+    elif area:
+        x0, y0 = area.get('x', 0), area.get('y', 0)
+        item_ids = index.query_area(x0, y0, x0 + area.get('width', 0), y0 + area.get('height', 0), item_types)
+        scope = {"area": area}
+    else:
+        return {"status": "error", "message": "Provide a frame_title or an area.", "frames": index.frame_titles()}
+
+    item_ids = index.order_by_position(item_ids)
+    result = {
+        "board": board_content.get('name'),
+        **scope,
+        "item_count": len(item_ids),
+        "items": [compact_item(index.by_id[item_id]) for item_id in item_ids[:max_items]]
+    }
+    if len(item_ids) > max_items:
+        result["truncated"] = True
+    return result
@@ -1,11 +1,44 @@
+import asyncio
 import aiohttp
 from logger_config import setup_logger
+from upstream_governor import upstream, MIRO_HOST, CircuitOpenError
+from profiling import profiled
 
 logger = setup_logger()
 
-async def get_miro_board_content(board_id, access_token):
+async def _get_json(session, url, headers, params=None):
+    """
+    GETs a Miro API URL through the shared upstream governor, which retries 429s and transient errors.
+    """
+    async def get():
+        async with session.get(url, headers=headers, params=params) as response:
+            response.raise_for_status()
+            return await response.json()
+
+    return await upstream.call_async(MIRO_HOST, get, idempotent=True)
+
+async def _fetch_all_pages(session, url, headers):
+    """
+    Follows Miro's cursor-based pagination and returns every record from the endpoint.
+    """
+    records = []
+    cursor = None
+    while True:
+        params = {}
+        if cursor:
+            params['cursor'] = cursor
+        page = await _get_json(session, url, headers, params)
+        records.extend(page.get('data', []))
+        cursor = page.get('cursor')
+        if not cursor:
+            logger.debug(f"All records fetched from {url}, no more cursor found.")
+            return records
+
+@profiled("miro.get_miro_board_content")
+async def get_miro_board_content(board_id, access_token, include_connectors=False):
     base_url = f"https://api.miro.com/v2/boards/{board_id}"
     items_url = f"{base_url}/items"
+    connectors_url = f"{base_url}/connectors"
 
     headers = {
         "Authorization": f"Bearer {access_token}",
@@ -16,34 +49,22 @@ async def get_miro_board_content(board_id, access_token):
         try:
             logger.debug(f"Attempting to fetch board details for board ID: {board_id}")
             # Get board details
-            async with session.get(base_url, headers=headers) as response:
-                response.raise_for_status()
-                board_content = await response.json()
-                logger.debug("Board details fetched successfully.")
-
-            # Initialize items collection
-            board_content['items'] = []
-            cursor = None
+            board_content = await _get_json(session, base_url, headers)
+            logger.debug("Board details fetched successfully.")
 
             logger.debug("Starting to fetch items with cursor-based pagination.")
-            # Fetch items with cursor-based pagination
-            while True:
-                params = {}
-                if cursor:
-                    params['cursor'] = cursor
-                async with session.get(items_url, headers=headers, params=params) as response:
-                    response.raise_for_status()
-                    items_data = await response.json()
-                    board_content['items'].extend(items_data.get('data', []))
-                    cursor = items_data.get('cursor')
-                    if not cursor:
-                        logger.debug("All items fetched, no more cursor found.")
-                        break
+            if include_connectors:
+                # Items and connectors are paginated independently, so crawl them side by side
+                board_content['items'], board_content['connectors'] = await asyncio.gather(
+                    _fetch_all_pages(session, items_url, headers),
+                    _fetch_all_pages(session, connectors_url, headers)
+                )
+            else:
+                board_content['items'] = await _fetch_all_pages(session, items_url, headers)
 
             logger.info("Successfully fetched all content for the board.")
             return board_content
 
-        except aiohttp.ClientError as e:
+        except (aiohttp.ClientError, CircuitOpenError) as e:
             logger.error(f"Failed to fetch board content: {e}")
             return {"error": str(e)}
-
@@ -1,17 +1,86 @@
-import json
 from miro_board_info import get_miro_board_content
+from miro_board_index import MiroBoardIndex, item_text
+from miro_flow_graph import build_flow_outline
+from miro_analysis_cache import AnalysisCache, analysis_cache_key, MIRO_ANALYSIS_CACHE_FIRESTORE
+from metrics import register_metrics
+from upstream_governor import call_openai, upstream_user
+from semantic_index import index_board_in_background
+from usage_accounting import usage_ledger
 from openai import AsyncOpenAI
+import asyncio
 import os
 from logger_config import setup_logger
+from profiling import profiled
 
 logger = setup_logger()
 
 # Load your OpenAI API key from an environment variable or other secure location
-client = AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+# Retries are left to the upstream governor so they are not doubled up
+client = AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY"), max_retries=0)
 
-async def analyze_miro_board_data(board_id):
-    board_data = await get_miro_board_content(board_id)
-    formatted_board_data = json.dumps(board_data, indent=4)
+MIRO_ANALYSIS_MODEL = os.environ.get("MIRO_ANALYSIS_MODEL", "gpt-4-turbo-2024-04-09")
+SYSTEM_PROMPT = "You are a helpful assistant tasked with extracting information from a miro board in a structured, readable way."
+USER_PROMPT = ("Analyze this Miro board and format the details on the following (important text cards, process flows, frame titles, etc.). "
+               "Items are grouped by frame in reading order; process flows were precomputed from the board's connectors: ")
+
+if MIRO_ANALYSIS_CACHE_FIRESTORE:
+    from shared_resources import db
+    analysis_cache = AnalysisCache(db=db)
+else:
+    analysis_cache = AnalysisCache()
+register_metrics("miro_analysis_cache", analysis_cache.metrics)
+
+def format_board_for_analysis(board_data):
+    """
+    Renders the board as plain text: item text grouped by frame, followed by the connector flow outline.
+    """
+    items = board_data.get('items', [])
+    index = MiroBoardIndex(items)
+    lines = [f"Board: {board_data.get('name', '')}"]
+    if board_data.get('description'):
+        lines.append(f"Description: {board_data['description']}")
+
+    framed = set()
+    for frame_id in index.order_by_position(index.by_type.get('frame', [])):
+        lines.append(f"\nFrame: {item_text(index.by_id[frame_id]) or frame_id}")
+        for item_id in index.order_by_position(index.frame_items(frame_id)):
+            framed.add(item_id)
+            text = " ".join(item_text(index.by_id[item_id]).split())
+            if text:
+                lines.append(f"- ({index.by_id[item_id].get('type')}) {text}")
+
+    loose = [item_id for item_id in index.order_by_position(list(index.by_id)) if item_id not in framed and index.by_id[item_id].get('type') != 'frame']
+    if loose:
+        lines.append("\nOutside frames:")
+        for item_id in loose:
+            text = " ".join(item_text(index.by_id[item_id]).split())
+            if text:
+                lines.append(f"- ({index.by_id[item_id].get('type')}) {text}")
+
+    outline = build_flow_outline(items, board_data.get('connectors', []))
+    if outline:
+        lines.append("\nProcess flows:")
+        lines.append(outline)
+    return "\n".join(lines)
+
+@profiled("miro.analyze_miro_board_data")
+async def analyze_miro_board_data(board_id, access_token):
+    board_data = await get_miro_board_content(board_id, access_token, include_connectors=True)
+    if "error" in board_data:
+        return board_data
+    index_board_in_background(board_id, board_data.get('items', []), upstream_user.get())
+    # Users past their daily budget get the analysis from the smaller fallback model
+    model, _ = await asyncio.to_thread(usage_ledger.apply_budget, upstream_user.get(), MIRO_ANALYSIS_MODEL)
+
+    # Identical board content, prompt and model give an identical analysis; skip the completion
+    cache_key = analysis_cache_key(board_data, SYSTEM_PROMPT + USER_PROMPT, model)
+    # The cache may read Firestore; keep blocking calls off the event loop
+    cached_analysis = await asyncio.to_thread(analysis_cache.get, cache_key)
+    if cached_analysis is not None:
+        logger.info(f"Returning cached analysis for Miro board {board_id}.")
+        return cached_analysis
+
+    formatted_board_data = format_board_for_analysis(board_data)
     
     # Set a maximum character limit for the data sent to the model
     max_char_limit = 450000  # Adjust based on experimentation and buffer for system/user messages
@@ -20,14 +89,18 @@ async def analyze_miro_board_data(board_id):
         formatted_board_data = formatted_board_data[:max_char_limit] + "\n... [Content truncated due to length]"
     
     conversation = [
-        {"role": "system", "content": "You are a helpful assistant tasked with extracting information from a miro board api call in a structured, readable way."},
-        {"role": "user", "content": f"Analyze this Miro board api call and format the details on the following (important text cards, process flows, frame titles, etc.): {formatted_board_data}"}
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": f"{USER_PROMPT}{formatted_board_data}"}
     ]
     
-    response = await client.chat.completions.create(
-        model="gpt-4-turbo-2024-04-09",
+    response = await call_openai(
+        client.chat.completions.create,
+        idempotent=True,
+        model=model,
         messages=conversation
     )
-    
+    usage_ledger.record(model, response.usage)
+
     assistant_response = response.choices[0].message.content
-    return assistant_response
\ No newline at end of file
+    await asyncio.to_thread(analysis_cache.put, cache_key, assistant_response)
+    return assistant_response
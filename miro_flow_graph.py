@@ -0,0 +1,206 @@
+from collections import defaultdict, deque
+from miro_board_index import item_text
+from logger_config import setup_logger
+
+logger = setup_logger()
+
+LABEL_MAX_CHARS = 80
+
+def _label(items_by_id, item_id):
+    item = items_by_id.get(item_id)
+    if not item:
+        return f"[missing {item_id}]"
+    text = " ".join(item_text(item).split())
+    if not text:
+        return f"[{item.get('type', 'item')} {item_id}]"
+    return text if len(text) <= LABEL_MAX_CHARS else text[:LABEL_MAX_CHARS] + "…"
+
+def _caption(connector):
+    captions = connector.get('captions') or []
+    return " / ".join(filter(None, (item_text({"data": {"content": caption.get('content')}}) for caption in captions)))
+
+class FlowGraph:
+    """
+    Directed graph of board items joined by Miro connectors (startItem -> endItem).
+    """
+
+    def __init__(self, items, connectors):
+        self.items_by_id = {item['id']: item for item in items if item.get('id')}
+        self.edges = defaultdict(list)
+        self.in_degree = defaultdict(int)
+        self.nodes = set()
+        for connector in connectors:
+            start = (connector.get('startItem') or {}).get('id')
+            end = (connector.get('endItem') or {}).get('id')
+            if not start or not end:
+                continue
+            self.edges[start].append((end, _caption(connector)))
+            self.in_degree[end] += 1
+            self.nodes.update((start, end))
+
+    def flows(self):
+        """
+        Weakly connected components, each one a separate flow, largest first.
+        """
+        neighbours = defaultdict(set)
+        for start, targets in self.edges.items():
+            for end, _ in targets:
+                neighbours[start].add(end)
+                neighbours[end].add(start)
+        seen = set()
+        components = []
+        for node in sorted(self.nodes):
+            if node in seen:
+                continue
+            component = []
+            queue = deque([node])
+            seen.add(node)
+            while queue:
+                current = queue.popleft()
+                component.append(current)
+                for neighbour in neighbours[current]:
+                    if neighbour not in seen:
+                        seen.add(neighbour)
+                        queue.append(neighbour)
+            components.append(component)
+        return sorted(components, key=len, reverse=True)
+
+    def strongly_connected_components(self, nodes):
+        """
+        Tarjan's algorithm, iterative so long flows do not hit the recursion limit.
+        """
+        nodes = set(nodes)
+        index_of, lowlink, on_stack = {}, {}, set()
+        stack, components = [], []
+        counter = 0
+        for root in sorted(nodes):
+            if root in index_of:
+                continue
+            work = [(root, iter(self.edges.get(root, [])))]
+            index_of[root] = lowlink[root] = counter
+            counter += 1
+            stack.append(root)
+            on_stack.add(root)
+            while work:
+                node, targets = work[-1]
+                advanced = False
+                for end, _ in targets:
+                    if end not in nodes:
+                        continue
+                    if end not in index_of:
+                        index_of[end] = lowlink[end] = counter
+                        counter += 1
+                        stack.append(end)
+                        on_stack.add(end)
+                        work.append((end, iter(self.edges.get(end, []))))
+                        advanced = True
+                        break
+                    if end in on_stack:
+                        lowlink[node] = min(lowlink[node], index_of[end])
+                if advanced:
+                    continue
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index_of[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(component)
+        return components
+
+    def ordered_flow(self, nodes):
+        """
+        Topologically orders a flow. Cycles are collapsed into single steps of the condensation
+        graph, so the order is defined even for looping processes.
+
+        Returns:
+            tuple: The nodes in flow order, and the cycles found (each a list of nodes).
+        """
+        components = self.strongly_connected_components(nodes)
+        component_of = {node: position for position, component in enumerate(components) for node in component}
+        cycles = [component for component in components if len(component) > 1 or any(end == component[0] for end, _ in self.edges.get(component[0], []))]
+
+        successors = defaultdict(set)
+        indegree = defaultdict(int)
+        for node in nodes:
+            for end, _ in self.edges.get(node, []):
+                source, target = component_of[node], component_of.get(end)
+                if target is not None and source != target and target not in successors[source]:
+                    successors[source].add(target)
+                    indegree[target] += 1
+
+        # Kahn's algorithm; ties broken by reading position so the outline is stable
+        ready = sorted((position for position in range(len(components)) if not indegree[position]), key=lambda position: self._position_key(components[position]))
+        ordered = []
+        while ready:
+            position = ready.pop(0)
+            ordered.extend(sorted(components[position], key=lambda node: self._position_key([node])))
+            for target in sorted(successors[position], key=lambda target: self._position_key(components[target])):
+                indegree[target] -= 1
+                if not indegree[target]:
+                    ready.append(target)
+        return ordered, cycles
+
+    def order_cycle(self, cycle):
+        """
+        Walks a strongly connected component along its edges so the cycle reads in flow order.
+        """
+        members = set(cycle)
+        start = min(cycle, key=lambda node: self._position_key([node]))
+        ordered, seen, node = [], set(), start
+        while node is not None and node not in seen:
+            ordered.append(node)
+            seen.add(node)
+            node = next((end for end, _ in self.edges.get(node, []) if end in members and end not in seen), None)
+        return ordered + [node for node in cycle if node not in seen]
+
+    def _position_key(self, nodes):
+        positions = [(self.items_by_id.get(node, {}).get('position') or {}) for node in nodes]
+        return min((position.get('y', 0), position.get('x', 0)) for position in positions)
+
+    def outline(self, max_flows=20):
+        """
+        Compact textual outline of every flow: steps in order, branches and cycles.
+        """
+        lines = []
+        flows = self.flows()
+        for number, flow in enumerate(flows[:max_flows], start=1):
+            ordered, cycles = self.ordered_flow(flow)
+            starts = [node for node in ordered if not self.in_degree.get(node)]
+            ends = [node for node in ordered if not self.edges.get(node)]
+            header = f"Flow {number} ({len(ordered)} steps"
+            if starts:
+                header += f", starts at \"{_label(self.items_by_id, starts[0])}\""
+            lines.append(header + "):")
+            for step, node in enumerate(ordered, start=1):
+                targets = self.edges.get(node, [])
+                label = _label(self.items_by_id, node)
+                if not targets:
+                    lines.append(f"  {step}. {label} (end)" if node in ends and len(ordered) > 1 else f"  {step}. {label}")
+                    continue
+                rendered = [f"[{caption}] {_label(self.items_by_id, end)}" if caption else _label(self.items_by_id, end) for end, caption in targets]
+                if len(targets) > 1:
+                    lines.append(f"  {step}. {label} -> branches: " + " | ".join(rendered))
+                else:
+                    lines.append(f"  {step}. {label} -> {rendered[0]}")
+            for cycle in cycles:
+                lines.append("  Cycle through: " + ", ".join(_label(self.items_by_id, node) for node in self.order_cycle(cycle)))
+        if len(flows) > max_flows:
+            lines.append(f"... {len(flows) - max_flows} smaller flows omitted")
+        return "\n".join(lines)
+
+def build_flow_outline(items, connectors):
+    """
+    Builds the flow outline for a board's items and connectors; empty if the board has no connectors.
+    """
+    if not connectors:
+        return ""
+    graph = FlowGraph(items, connectors)
+    logger.debug(f"Built flow graph with {len(graph.nodes)} nodes from {len(connectors)} connectors.")
+    return graph.outline()
@@ -0,0 +1,63 @@
+import asyncio
+import os
+import threading
+import time
+from shared_resources import logger
+from token_cache import get_user_tokens
+from jira_board_info import warm_jira_connection
+from assistants import get_conversation_thread_id
+from upstream_governor import upstream_user
+
+# Minimum time between two prewarms of the same user, so repeated Home opens cost nothing extra
+PREWARM_DEBOUNCE_SECONDS = float(os.environ.get("PREWARM_DEBOUNCE_SECONDS", 300))
+PREWARM_ENABLED = os.environ.get("PREWARM_ENABLED", "true").lower() == "true"
+
+_last_prewarm = {}
+_last_prewarm_lock = threading.Lock()
+
+def _has_token(user_tokens, service):
+    return bool((user_tokens.get(service) or {}).get('access_token'))
+
+def prewarm_user(user_id, create_thread):
+    """
+    Loads the user's tokens into the token cache, opens pooled connections to the services the user
+    has authenticated with and, if asked, creates the conversation's OpenAI thread ahead of time.
+    """
+    started = time.perf_counter()
+    upstream_user.set(user_id)
+    user_tokens = get_user_tokens(user_id) or {}
+    if _has_token(user_tokens, 'jira'):
+        warm_jira_connection()
+    # Miro calls use an aiohttp session bound to each message's own event loop, so there is no
+    # process-wide pool to warm; the cached token already removes the Firestore read from its path.
+    if create_thread:
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(get_conversation_thread_id(user_id))
+        finally:
+            loop.close()
+    logger.debug(f"Prewarmed user {user_id} in {time.perf_counter() - started:.2f}s.")
+
+def schedule_prewarm(user_id, reason, create_thread=True):
+    """
+    Prewarms the user in a background thread unless they were prewarmed in the last
+    PREWARM_DEBOUNCE_SECONDS. Returns whether a prewarm was started.
+    """
+    if not PREWARM_ENABLED or not user_id:
+        return False
+    now = time.monotonic()
+    with _last_prewarm_lock:
+        last = _last_prewarm.get(user_id)
+        if last is not None and now - last < PREWARM_DEBOUNCE_SECONDS:
+            return False
+        _last_prewarm[user_id] = now
+
+    def run():
+        try:
+            prewarm_user(user_id, create_thread)
+        except Exception as e:
+            logger.warning(f"Prewarm ({reason}) failed for user {user_id}: {e}")
+
+    logger.debug(f"Prewarming user {user_id} ({reason}).")
+    threading.Thread(target=run, name=f"prewarm-{user_id}", daemon=True).start()
+    return True
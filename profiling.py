@@ -0,0 +1,220 @@
+import asyncio
+import contextlib
+import contextvars
+import functools
+import itertools
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from logger_config import setup_logger
+
+logger = setup_logger()
+
+# Fraction of requests profiled without being asked to; 0 leaves profiling off
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))
+PROFILE_INTERVAL_SECONDS = float(os.environ.get("PROFILE_INTERVAL_MS", 5)) / 1000
+PROFILE_OUTPUT_DIR = os.environ.get("PROFILE_OUTPUT_DIR", "/tmp/profiles")
+PROFILE_MAX_DEPTH = 64
+ADMIN_USER_IDS = os.environ.get("ADMIN_USER_IDS", "")
+
+# Frames of an event loop with nothing to run; samples ending here are time spent awaiting I/O
+_IDLE_FUNCTIONS = {"select", "poll", "epoll", "_run_once", "wait"}
+
+current_profile = contextvars.ContextVar("current_profile", default=None)
+_section_path = contextvars.ContextVar("profile_section_path", default=())
+
+# Requests the admin command has armed for profiling; "always" profiles every request until turned off
+_armed = {"remaining": 0, "always": False}
+_armed_lock = threading.Lock()
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name}@{os.path.basename(code.co_filename)}"
+
+class SamplingProfiler:
+    """
+    Samples the Python stacks of the threads serving one request and aggregates them as folded
+    stacks ("a;b;c count"), the input format of flamegraph.pl and speedscope.
+
+    Samples are prefixed with the innermost active section (see profiled) so time spent awaiting
+    I/O on the event loop is still attributed to the pipeline stage that is waiting.
+    """
+
+    def __init__(self, event_id, interval=PROFILE_INTERVAL_SECONDS):
+        self.event_id = event_id
+        self.interval = interval
+        self.samples = Counter()
+        self._sections = {}
+        self._tokens = itertools.count()
+        self._threads = Counter()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = None
+        self.started_at = None
+
+    def add_thread(self, thread_id):
+        with self._lock:
+            self._threads[thread_id] += 1
+
+    def remove_thread(self, thread_id):
+        with self._lock:
+            self._threads[thread_id] -= 1
+            if self._threads[thread_id] <= 0:
+                del self._threads[thread_id]
+
+    def enter(self, name):
+        path = _section_path.get() + (name,)
+        thread_id = threading.get_ident()
+        token = next(self._tokens)
+        with self._lock:
+            self._sections[token] = (thread_id, path)
+            self._threads[thread_id] += 1
+        return token, _section_path.set(path)
+
+    def exit(self, entered):
+        token, path_token = entered
+        _section_path.reset(path_token)
+        with self._lock:
+            thread_id, _ = self._sections.pop(token)
+        self.remove_thread(thread_id)
+
+    def start(self):
+        self.started_at = time.perf_counter()
+        self._sampler = threading.Thread(target=self._run, name=f"profiler-{self.event_id}", daemon=True)
+        self._sampler.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._sampler:
+            self._sampler.join()
+        return self.write()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            with self._lock:
+                threads = list(self._threads)
+                sections = {}
+                for token, (thread_id, path) in self._sections.items():
+                    # Innermost (most recently entered) section per thread
+                    if token >= sections.get(thread_id, (-1, ()))[0]:
+                        sections[thread_id] = (token, path)
+            for thread_id in threads:
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < PROFILE_MAX_DEPTH:
+                    stack.append(frame)
+                    frame = frame.f_back
+                labels = [_frame_label(frame) for frame in reversed(stack)]
+                if stack and stack[0].f_code.co_name in _IDLE_FUNCTIONS:
+                    labels = ["[awaiting io]"]
+                prefix = list(sections.get(thread_id, (0, ("request",)))[1])
+                self.samples[";".join(prefix + labels)] += 1
+
+    def write(self):
+        """
+        Writes the folded stacks to PROFILE_OUTPUT_DIR/<event_id>.folded and returns the path.
+        """
+        os.makedirs(PROFILE_OUTPUT_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_OUTPUT_DIR, f"{self.event_id}.folded")
+        with open(path, "w") as output:
+            for stack, count in self.samples.most_common():
+                output.write(f"{stack} {count}\n")
+        elapsed = time.perf_counter() - (self.started_at or time.perf_counter())
+        logger.info(f"Profile for event {self.event_id}: {sum(self.samples.values())} samples over {elapsed:.2f}s written to {path}")
+        return path
+
+def _should_profile():
+    with _armed_lock:
+        if _armed["always"]:
+            return True
+        if _armed["remaining"] > 0:
+            _armed["remaining"] -= 1
+            return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+@contextlib.contextmanager
+def profile_request(event_id):
+    """
+    Profiles the enclosed request if it was picked by PROFILE_SAMPLE_RATE or armed by an admin.
+    The calling thread is sampled; threads entering profiled sections are added as they go.
+    """
+    if current_profile.get() is not None or not _should_profile():
+        yield None
+        return
+    profiler = SamplingProfiler(event_id or f"request-{int(time.time() * 1000)}")
+    profiler.add_thread(threading.get_ident())
+    token = current_profile.set(profiler)
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        current_profile.reset(token)
+        try:
+            profiler.stop()
+        except Exception as e:
+            logger.error(f"Failed to write profile for event {event_id}: {e}")
+
+def profiled(name):
+    """
+    Marks a function as a pipeline section. Free when no profile is active; otherwise samples taken
+    while it runs are labelled with the section, and its thread (e.g. a to_thread worker) is sampled.
+    """
+    def decorator(fn):
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                profiler = current_profile.get()
+                if profiler is None:
+                    return await fn(*args, **kwargs)
+                entered = profiler.enter(name)
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    profiler.exit(entered)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            profiler = current_profile.get()
+            if profiler is None:
+                return fn(*args, **kwargs)
+            entered = profiler.enter(name)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                profiler.exit(entered)
+        return wrapper
+    return decorator
+
+def handle_profile_command(user_id, text):
+    """
+    Handles "!profile next [n]", "!profile on" and "!profile off" from admins.
+
+    Returns:
+        str: The reply to post, or None if the message is not a profile command.
+    """
+    words = (text or "").strip().split()
+    if not words or words[0] != "!profile":
+        return None
+    if user_id not in ADMIN_USER_IDS.split(','):
+        return "Profiling commands are limited to admins."
+    action = words[1] if len(words) > 1 else "next"
+    with _armed_lock:
+        if action == "on":
+            _armed["always"] = True
+            return f"Profiling every request until `!profile off`. Output goes to {PROFILE_OUTPUT_DIR}."
+        if action == "off":
+            _armed["always"] = False
+            _armed["remaining"] = 0
+            return "Profiling off."
+        if action == "next":
+            count = int(words[2]) if len(words) > 2 and words[2].isdigit() else 1
+            _armed["remaining"] += count
+            return f"Profiling the next {count} request(s). Output goes to {PROFILE_OUTPUT_DIR}."
+    return "Usage: `!profile next [n]`, `!profile on` or `!profile off`."
@@ -0,0 +1,260 @@
+import asyncio
+import json
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+from assistants import process_thread_with_assistant, get_conversation_thread_id, client
+from tool_registry import registry as tool_registry
+from jira_board_info import format_jira_issue
+from tool_outputs import adf_to_text
+from token_cache import get_user_tokens
+from metrics import register_metrics
+from upstream_governor import call_openai, upstream_user
+from usage_accounting import usage_ledger, current_conversation
+from logger_config import setup_logger
+from profiling import profiled
+
+logger = setup_logger()
+
+# Ask a small model to classify queries the heuristics cannot place; off keeps routing free and local
+ROUTER_MODEL_CLASSIFICATION = os.environ.get("ROUTER_MODEL_CLASSIFICATION", "false").lower() == "true"
+ROUTER_MODEL = os.environ.get("ROUTER_MODEL", "gpt-4o-mini")
+# JSONL file receiving routing decisions (metadata only, never the query text); unset disables it
+ROUTER_DECISION_LOG = os.environ.get("ROUTER_DECISION_LOG")
+ROUTER_LOG_FIRESTORE = os.environ.get("ROUTER_LOG_FIRESTORE", "false").lower() == "true"
+ROUTER_DECISION_COLLECTION = 'routing_decisions'
+# Longer queries are treated as open-ended even if they mention a single issue
+ROUTER_MAX_LOOKUP_CHARS = 160
+FAST_PATH_DESCRIPTION_MAX_CHARS = 500
+FAST_PATH_MAX_CHILDREN = 50
+# Appending a fast-path exchange is rejected while a run is active on the thread; it is retried this many
+# times with doubling waits, all within the request that answered (about 7s at most)
+RECORD_ATTEMPTS = 4
+RECORD_RETRY_SECONDS = 1.0
+
+ROUTE_ASSISTANT = "assistant"
+ROUTE_ISSUE_LOOKUP = "issue_lookup"
+ROUTE_EPIC_CHILDREN = "epic_children"
+
+# Jira project keys are upper case; matching only those keeps tokens like "gpt-4" from looking like issues
+ISSUE_KEY_PATTERN = re.compile(r"\b([A-Z][A-Z0-9]{1,9}-\d+)\b")
+ACTIVE_RUN_ERROR = re.compile(r"while a run \S+ is active", re.I)
+# Anything that changes Jira or asks for reasoning needs the full assistant
+ASSISTANT_WORDS = re.compile(r"\b(update|change|edit|create|add|set|move|assign|close|rename|delete|why|compare|plan|suggest|summari[sz]e|write|draft|miro|board)\b", re.I)
+EPIC_WORDS = re.compile(r"\b(children|child issues|child tickets|issues (in|under|of)|tickets (in|under|of)|stories (in|under|of)|subtasks|what'?s in)\b", re.I)
+LOOKUP_WORDS = re.compile(r"\b(status|state|what is|what's|show|details|info|look ?up|get|who is assigned|assignee|describe|tell me about|progress)\b", re.I)
+
+CLASSIFIER_PROMPT = ("Classify the user's message to a Jira/Miro assistant. Reply with JSON {\"route\": R} where R is "
+                     "\"issue_lookup\" if it only asks for the details or status of the one issue mentioned, "
+                     "\"epic_children\" if it only asks which issues belong to the epic mentioned, "
+                     "or \"assistant\" for anything else.")
+
+def classify_heuristically(query):
+    """
+    Returns (route, issue_key, reason); route is None when the heuristics are not confident.
+    """
+    text = (query or "").strip()
+    keys = set(ISSUE_KEY_PATTERN.findall(text))
+    if len(keys) != 1:
+        return ROUTE_ASSISTANT, None, "no single issue key"
+    issue_key = keys.pop()
+    if len(text) > ROUTER_MAX_LOOKUP_CHARS:
+        return ROUTE_ASSISTANT, issue_key, "long query"
+    if ASSISTANT_WORDS.search(text):
+        return ROUTE_ASSISTANT, issue_key, "action or open-ended wording"
+    if EPIC_WORDS.search(text):
+        return ROUTE_EPIC_CHILDREN, issue_key, "epic children wording"
+    if ISSUE_KEY_PATTERN.sub("", text).strip(" ?.!") == "" or LOOKUP_WORDS.search(text):
+        return ROUTE_ISSUE_LOOKUP, issue_key, "lookup wording"
+    return None, issue_key, "uncertain"
+
+async def classify_with_model(query):
+    response = await call_openai(
+        client.chat.completions.create,
+        idempotent=True,
+        model=ROUTER_MODEL,
+        response_format={"type": "json_object"},
+        messages=[
+            {"role": "system", "content": CLASSIFIER_PROMPT},
+            {"role": "user", "content": query}
+        ]
+    )
+    usage_ledger.record(ROUTER_MODEL, response.usage, tool="query_router")
+    route = json.loads(response.choices[0].message.content or "{}").get("route")
+    return route if route in (ROUTE_ISSUE_LOOKUP, ROUTE_EPIC_CHILDREN) else ROUTE_ASSISTANT
+
+def _issue_line(key, raw_issue):
+    formatted = format_jira_issue(raw_issue)
+    fields = raw_issue.get('fields') or {}
+    line = f"*{key}* {formatted['Summary']} — {formatted['Status']}"
+    assignee = (fields.get('assignee') or {}).get('displayName')
+    if assignee:
+        line += f" ({assignee})"
+    return line
+
+def format_issue_answer(raw_issue):
+    formatted = format_jira_issue(raw_issue)
+    fields = raw_issue.get('fields') or {}
+    lines = [f"*{raw_issue.get('key')}*: {formatted['Summary']}",
+             f"Type: {formatted['Issue Type']} | Status: {formatted['Status']}"]
+    details = []
+    for label, field in (("Assignee", 'assignee'), ("Reporter", 'reporter')):
+        name = (fields.get(field) or {}).get('displayName')
+        if name:
+            details.append(f"{label}: {name}")
+    if (fields.get('priority') or {}).get('name'):
+        details.append(f"Priority: {fields['priority']['name']}")
+    if details:
+        lines.append(" | ".join(details))
+    description = adf_to_text(formatted['Description']).strip()
+    if description:
+        if len(description) > FAST_PATH_DESCRIPTION_MAX_CHARS:
+            description = description[:FAST_PATH_DESCRIPTION_MAX_CHARS] + "…"
+        lines.append(f"\n{description}")
+    return "\n".join(lines)
+
+def format_epic_answer(epic_key, output):
+    epic = output.get('EpicDetails') or {}
+    children = output.get('ChildIssues') or []
+    lines = [f"*{epic.get('Key') or epic_key}*: {epic.get('Summary', '')} has {len(children)} child issue(s)" + (":" if children else ".")]
+    for child in children[:FAST_PATH_MAX_CHILDREN]:
+        lines.append(f"• {_issue_line(child.get('key'), child)}")
+    if len(children) > FAST_PATH_MAX_CHILDREN:
+        lines.append(f"…and {len(children) - FAST_PATH_MAX_CHILDREN} more.")
+    return "\n".join(lines)
+
+class QueryRouter:
+    """
+    Routing stage ahead of the assistant: direct lookups of one issue or of an epic's children
+    are answered by calling Jira and formatting the result locally; everything else, and any
+    lookup that fails, goes to the full assistant run. Decisions are counted, and can be logged
+    (ROUTER_DECISION_LOG or ROUTER_LOG_FIRESTORE) for offline evaluation of the routing rules.
+    """
+
+    def __init__(self, db=None):
+        self.db = db
+        self._lock = threading.Lock()
+        self.stats = defaultdict(int)
+
+    async def _fast_path(self, route, issue_key, user_id):
+        """
+        Returns the reply text, or None if the lookup failed and the assistant should answer instead.
+        """
+        if route == ROUTE_ISSUE_LOOKUP:
+            output = await tool_registry.dispatch("get_jiraissue", {"issue_id": issue_key}, user_id)
+            raw_issue = (output or {}).get('issue_details')
+            return format_issue_answer(raw_issue) if raw_issue else None
+        output = await tool_registry.dispatch("get_issues_for_epic", {"epic_id": issue_key}, user_id)
+        if not isinstance(output, dict) or not output.get('EpicDetails'):
+            return None
+        return format_epic_answer(issue_key, output)
+
+    async def _record_in_thread(self, conversation_id, query, answer):
+        """
+        Adds the exchange to the conversation's thread so follow-up questions keep their context.
+        While a run is active on the thread (here or on another instance) the append is rejected,
+        so only that rejection is retried, with backoff.
+        """
+        thread_id = await get_conversation_thread_id(conversation_id)
+        messages = [("user", query), ("assistant", answer)]
+        for attempt in range(RECORD_ATTEMPTS):
+            try:
+                while messages:
+                    role, content = messages[0]
+                    await call_openai(client.beta.threads.messages.create, thread_id=thread_id, role=role, content=content)
+                    messages.pop(0)
+                return
+            except Exception as e:
+                if not ACTIVE_RUN_ERROR.search(str(e)) or attempt == RECORD_ATTEMPTS - 1:
+                    raise
+                await asyncio.sleep(RECORD_RETRY_SECONDS * 2 ** attempt)
+
+    async def _record_exchange(self, conversation_id, query, answer):
+        """
+        Records a fast-path exchange before the reply is returned, so the work finishes inside the
+        request (or Cloud Task) that answered; a failure only costs the thread that context.
+        """
+        try:
+            await self._record_in_thread(conversation_id, query, answer)
+        except Exception as e:
+            with self._lock:
+                self.stats["record_failures"] += 1
+            logger.warning(f"Failed to add fast-path answer to the thread of {conversation_id}: {e}")
+
+    def _log_decision(self, decision):
+        with self._lock:
+            self.stats[f"route_{decision['route']}"] += 1
+            self.stats[f"outcome_{decision['outcome']}"] += 1
+        try:
+            if ROUTER_LOG_FIRESTORE and self.db:
+                self.db.collection(ROUTER_DECISION_COLLECTION).add(decision)
+            elif ROUTER_DECISION_LOG:
+                with open(ROUTER_DECISION_LOG, "a") as log_file:
+                    log_file.write(json.dumps(decision) + "\n")
+        except Exception as e:
+            logger.warning(f"Failed to record routing decision: {e}")
+
+    @profiled("route_query")
+    async def answer(self, query, assistant_id, from_user=None, conversation_id=None):
+        """
+        Answers a query through the fast path or the assistant; returns process_thread_with_assistant's response shape.
+        """
+        started = time.perf_counter()
+        conversation_id = conversation_id or from_user
+        upstream_user.set(from_user)
+        current_conversation.set(conversation_id)
+
+        route, issue_key, reason = classify_heuristically(query)
+        classifier = "heuristic"
+        if route is None:
+            route, reason = ROUTE_ASSISTANT, "uncertain, no classifier"
+            if ROUTER_MODEL_CLASSIFICATION:
+                try:
+                    route, classifier, reason = await classify_with_model(query), "model", "model"
+                except Exception as e:
+                    logger.warning(f"Query classification failed; using the assistant: {e}")
+
+        outcome = "assistant"
+        response = None
+        if route != ROUTE_ASSISTANT:
+            user_tokens = await asyncio.to_thread(get_user_tokens, from_user, ('jira',))
+            if not ((user_tokens or {}).get('jira') or {}).get('access_token'):
+                # The assistant knows how to walk the user through authenticating
+                outcome = "fallback_no_token"
+            else:
+                answer = await self._fast_path(route, issue_key, from_user)
+                if answer:
+                    outcome = "fast_path"
+                    response = {"text": [answer], "in_memory_files": []}
+                    await self._record_exchange(conversation_id, query, answer)
+                else:
+                    outcome = "fallback_lookup_failed"
+
+        if response is None:
+            response = await process_thread_with_assistant(query, assistant_id, from_user=from_user, conversation_id=conversation_id)
+
+        self._log_decision({
+            "ts": time.time(),
+            "user": from_user,
+            "query_chars": len(query or ""),
+            "route": route,
+            "issue_key": issue_key,
+            "classifier": classifier,
+            "reason": reason,
+            "outcome": outcome,
+            "latency_ms": round((time.perf_counter() - started) * 1000, 1)
+        })
+        return response
+
+    def metrics(self):
+        with self._lock:
+            return dict(self.stats)
+
+if ROUTER_LOG_FIRESTORE:
+    from shared_resources import db
+    query_router = QueryRouter(db=db)
+else:
+    query_router = QueryRouter()
+register_metrics("query_router", query_router.metrics)
@@ -0,0 +1,252 @@
+import os
+import threading
+import time
+import uuid
+from firebase_admin import firestore
+from logger_config import setup_logger
+
+logger = setup_logger()
+
+RUN_LEASES_ENABLED = os.environ.get("RUN_LEASES_ENABLED", "false").lower() == "true"
+LEASE_TTL_SECONDS = float(os.environ.get("RUN_LEASE_TTL_SECONDS", 30))
+LEASE_COLLECTION = 'run_leases'
+PENDING_COLLECTION = 'pending'
+
+# Unique per process; Cloud Run sets K_REVISION, the suffix tells instances of one revision apart
+INSTANCE_ID = f"{os.environ.get('K_REVISION', 'local')}-{uuid.uuid4().hex[:8]}"
+
+@firestore.transactional
+def _acquire_in_transaction(transaction, lease_ref, instance_id, ttl):
+    snapshot = lease_ref.get(transaction=transaction)
+    lease = snapshot.to_dict() if snapshot.exists else {}
+    now = time.time()
+    if lease.get('redirect_to'):
+        # The conversation rolled over to another thread; nobody drives this one any more
+        return False
+    if lease.get('holder') not in (None, instance_id) and lease.get('expires_at', 0) > now:
+        return False
+    transaction.set(lease_ref, {'holder': instance_id, 'expires_at': now + ttl})
+    return True
+
+@firestore.transactional
+def _renew_in_transaction(transaction, lease_ref, instance_id, ttl):
+    snapshot = lease_ref.get(transaction=transaction)
+    if not snapshot.exists or snapshot.to_dict().get('holder') != instance_id:
+        return False
+    transaction.update(lease_ref, {'expires_at': time.time() + ttl})
+    return True
+
+@firestore.transactional
+def _release_in_transaction(transaction, lease_ref, instance_id):
+    snapshot = lease_ref.get(transaction=transaction)
+    if snapshot.exists and snapshot.to_dict().get('holder') == instance_id:
+        transaction.update(lease_ref, {'holder': None, 'expires_at': 0})
+
+@firestore.transactional
+def _requeue_in_transaction(transaction, message_ref, instance_id):
+    snapshot = message_ref.get(transaction=transaction)
+    message = snapshot.to_dict() if snapshot.exists else {}
+    if message.get('status') == 'claimed' and message.get('claimed_by') == instance_id:
+        transaction.update(message_ref, {'status': 'queued', 'claimed_by': None})
+
+class ThreadLeaseManager:
+    """
+    Firestore-backed leases that let only one instance drive runs on an OpenAI thread at a time.
+
+    Layout:
+        run_leases/{thread_id}                      {holder, expires_at, redirect_to}
+        run_leases/{thread_id}/pending/{message_id} {query, status, created_at, response}
+
+    Instances that do not hold a thread's lease enqueue their messages under the lease document;
+    the holder claims them into its next run and publishes the reply back onto the message.
+    After a rollover the old thread's lease records redirect_to, so no instance acquires it again
+    and its forwarded messages follow the conversation to the new thread.
+    """
+
+    def __init__(self, db, instance_id=INSTANCE_ID, ttl=LEASE_TTL_SECONDS):
+        self.db = db
+        self.instance_id = instance_id
+        self.ttl = ttl
+        self._heartbeats = {}
+
+    def _lease_ref(self, thread_id):
+        return self.db.collection(LEASE_COLLECTION).document(thread_id)
+
+    def _pending_ref(self, thread_id):
+        return self._lease_ref(thread_id).collection(PENDING_COLLECTION)
+
+    def try_acquire(self, thread_id):
+        try:
+            acquired = _acquire_in_transaction(self.db.transaction(), self._lease_ref(thread_id), self.instance_id, self.ttl)
+        except Exception as e:
+            logger.error(f"Failed to acquire run lease for thread {thread_id}: {e}")
+            return False
+        if acquired:
+            logger.debug(f"Instance {self.instance_id} holds the run lease for thread {thread_id}.")
+        return acquired
+
+    def renew(self, thread_id):
+        try:
+            return _renew_in_transaction(self.db.transaction(), self._lease_ref(thread_id), self.instance_id, self.ttl)
+        except Exception as e:
+            logger.error(f"Failed to renew run lease for thread {thread_id}: {e}")
+            return False
+
+    def release(self, thread_id):
+        self.stop_heartbeat(thread_id)
+        try:
+            _release_in_transaction(self.db.transaction(), self._lease_ref(thread_id), self.instance_id)
+            logger.debug(f"Released run lease for thread {thread_id}.")
+        except Exception as e:
+            logger.error(f"Failed to release run lease for thread {thread_id}: {e}")
+
+    def redirect(self, old_thread_id, new_thread_id):
+        """
+        Records that old_thread_id rolled over to new_thread_id and moves its forwarded messages
+        there, keeping their IDs so the instances waiting on them find their replies.
+        """
+        try:
+            self._lease_ref(old_thread_id).set({'redirect_to': new_thread_id}, merge=True)
+        except Exception as e:
+            logger.error(f"Failed to record the rollover of thread {old_thread_id} to {new_thread_id}: {e}")
+        self.move_pending(old_thread_id, new_thread_id)
+
+    def redirect_of(self, thread_id):
+        """
+        Returns the thread this thread rolled over to, or None.
+        """
+        try:
+            doc = self._lease_ref(thread_id).get()
+            return doc.to_dict().get('redirect_to') if doc.exists else None
+        except Exception as e:
+            logger.error(f"Failed to read the run lease of thread {thread_id}: {e}")
+            return None
+
+    def move_pending(self, old_thread_id, new_thread_id):
+        try:
+            docs = list(self._pending_ref(old_thread_id).stream())
+            if not docs:
+                return
+            batch = self.db.batch()
+            for doc in docs:
+                batch.set(self._pending_ref(new_thread_id).document(doc.id), doc.to_dict())
+                batch.delete(doc.reference)
+            batch.commit()
+            logger.debug(f"Moved {len(docs)} forwarded message(s) from thread {old_thread_id} to {new_thread_id}.")
+        except Exception as e:
+            logger.error(f"Failed to move forwarded messages from thread {old_thread_id} to {new_thread_id}: {e}")
+
+    def start_heartbeat(self, thread_id, on_pending=None, on_lost=None):
+        """
+        Renews the lease every third of its TTL until released. on_pending is called when other
+        instances have queued messages, so the holder can cut its current run short; on_lost is
+        called if a renewal fails, after which another instance may hold the lease.
+        """
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(self.ttl / 3):
+                if not self.renew(thread_id):
+                    logger.warning(f"Lost the run lease for thread {thread_id}.")
+                    if self._heartbeats.get(thread_id) is stop:
+                        self._heartbeats.pop(thread_id, None)
+                    if on_lost:
+                        on_lost()
+                    return
+                if on_pending and self.has_queued(thread_id):
+                    on_pending()
+
+        self.stop_heartbeat(thread_id)
+        self._heartbeats[thread_id] = stop
+        threading.Thread(target=beat, daemon=True).start()
+
+    def stop_heartbeat(self, thread_id):
+        stop = self._heartbeats.pop(thread_id, None)
+        if stop:
+            stop.set()
+
+    def enqueue(self, thread_id, query):
+        doc_ref = self._pending_ref(thread_id).document()
+        doc_ref.set({
+            'query': query,
+            'status': 'queued',
+            'created_at': time.time(),
+            'enqueued_by': self.instance_id
+        })
+        logger.debug(f"Forwarded message {doc_ref.id} to the lease holder of thread {thread_id}.")
+        return doc_ref.id
+
+    def has_queued(self, thread_id):
+        try:
+            return any(True for _ in self._pending_ref(thread_id).where('status', '==', 'queued').limit(1).stream())
+        except Exception as e:
+            logger.error(f"Failed to check queued messages for thread {thread_id}: {e}")
+            return False
+
+    def claim_pending(self, thread_id):
+        """
+        Claims queued messages, plus messages claimed by a previous holder that never answered them.
+
+        Returns:
+            list: (message_id, query) tuples in arrival order.
+        """
+        claimed = []
+        try:
+            docs = self._pending_ref(thread_id).where('status', 'in', ['queued', 'claimed']).stream()
+            docs = [doc for doc in docs if doc.to_dict().get('claimed_by') != self.instance_id]
+            if not docs:
+                return claimed
+            batch = self.db.batch()
+            for doc in sorted(docs, key=lambda doc: doc.to_dict().get('created_at', 0)):
+                batch.update(doc.reference, {'status': 'claimed', 'claimed_by': self.instance_id})
+                claimed.append((doc.id, doc.to_dict().get('query')))
+            batch.commit()
+        except Exception as e:
+            logger.error(f"Failed to claim forwarded messages for thread {thread_id}: {e}")
+            return []
+        logger.debug(f"Claimed {len(claimed)} forwarded message(s) for thread {thread_id}.")
+        return claimed
+
+    def requeue(self, thread_id, message_ids):
+        """
+        Returns forwarded messages this instance claimed but will not answer (it lost the lease) to
+        the queue, so whoever holds the lease next claims them, this instance included.
+        """
+        for message_id in message_ids:
+            try:
+                _requeue_in_transaction(self.db.transaction(), self._pending_ref(thread_id).document(message_id), self.instance_id)
+            except Exception as e:
+                logger.error(f"Failed to requeue forwarded message {message_id}: {e}")
+        logger.debug(f"Requeued {len(message_ids)} forwarded message(s) for thread {thread_id}.")
+
+    def publish_result(self, thread_id, message_id, response):
+        try:
+            self._pending_ref(thread_id).document(message_id).update({'status': 'done', 'response': response})
+        except Exception as e:
+            logger.error(f"Failed to publish the reply for forwarded message {message_id}: {e}")
+
+    def discard(self, thread_id, message_id):
+        """
+        Deletes a forwarded message that was answered locally, after this instance took over the lease.
+        """
+        try:
+            self._pending_ref(thread_id).document(message_id).delete()
+        except Exception as e:
+            logger.error(f"Failed to delete forwarded message {message_id}: {e}")
+
+    def fetch_results(self, thread_id, message_ids):
+        """
+        Returns the replies published so far for the given messages, keyed by message ID, and
+        deletes the answered message documents.
+        """
+        results = {}
+        for message_id in message_ids:
+            doc_ref = self._pending_ref(thread_id).document(message_id)
+            try:
+                doc = doc_ref.get()
+                if doc.exists and doc.to_dict().get('status') == 'done':
+                    results[message_id] = doc.to_dict().get('response')
+                    doc_ref.delete()
+            except Exception as e:
+                logger.error(f"Failed to read the reply for forwarded message {message_id}: {e}")
+        return results
@@ -0,0 +1,326 @@
+import asyncio
+import concurrent.futures
+import os
+import threading
+import time
+from logger_config import setup_logger
+
+logger = setup_logger()
+
+# Returned to callers whose message was folded into a later run; the reply goes to the newest message
+COALESCED_RESPONSE = {"text": [], "in_memory_files": [], "coalesced": True}
+
+REMOTE_POLL_SECONDS = float(os.environ.get("RUN_LEASE_POLL_SECONDS", 1))
+REMOTE_RESULT_TIMEOUT_SECONDS = float(os.environ.get("RUN_LEASE_RESULT_TIMEOUT_SECONDS", 600))
+
+class _ThreadState:
+    def __init__(self, thread_id):
+        self.thread_id = thread_id
+        self.active = False
+        self.superseded = False
+        self.pending = []
+        self.lease_held = False
+        # Set by the heartbeat when a renewal failed; the driver must stop and win the lease again
+        self.lease_lost = False
+        # Messages forwarded to another instance's lease, by forwarded message ID
+        self.remote_waiters = {}
+        # Recipients of a superseded run; their messages are on the thread and the next run answers them
+        self.carried = []
+        self.lost_at = None
+        # Local callers waiting on this thread, by result waiter; setting the turn future makes that caller the driver
+        self.turns = {}
+
+class ThreadRunScheduler:
+    """
+    Serializes assistant runs per OpenAI thread.
+
+    The first message for an idle thread drives its run. Messages that arrive while a run is
+    active are queued, the active run is flagged as superseded (so the driver can cancel it), and
+    everything queued is sent in one follow-up run. Only the newest message of a run receives its
+    response; the others receive COALESCED_RESPONSE. Once the driver's own message is answered it
+    hands driving to a caller that is still waiting and returns.
+
+    Callers may live on different event loops (each Slack message gets its own), so state is
+    guarded by a threading lock and waiters use concurrent futures.
+
+    With a ThreadLeaseManager, the driver must also hold the thread's cross-instance lease. If
+    another instance holds it, messages are forwarded to that instance and their replies awaited.
+    """
+
+    def __init__(self, leases=None):
+        self._leases = leases
+        self._lock = threading.Lock()
+        self._states = {}
+        # Threads a conversation has rolled over from, so late submits land on the current thread;
+        # with leases they are also recorded on the old thread's lease for other instances
+        self._redirects = {}
+        self.stats = {"submitted": 0, "runs": 0, "coalesced": 0, "superseded": 0, "forwarded": 0, "claimed": 0, "leases_lost": 0}
+
+    async def submit(self, thread_id, query, run_batch):
+        """
+        Queues a message for the thread and waits for the response of the run that includes it.
+
+        Args:
+            thread_id (str): The OpenAI thread the message belongs to.
+            query (str): The user's message.
+            run_batch: Async callable (thread_id, queries, should_cancel) that adds the queries to
+                the thread, runs the assistant and returns the response, or None if the run was
+                cancelled because should_cancel() became true.
+        """
+        waiter = concurrent.futures.Future()
+        with self._lock:
+            self.stats["submitted"] += 1
+            while thread_id in self._redirects:
+                thread_id = self._redirects[thread_id]
+            state = self._states.get(thread_id)
+            if state is None:
+                state = self._states[thread_id] = _ThreadState(thread_id)
+            state.pending.append((query, waiter))
+            if state.active:
+                state.superseded = True
+                turn = state.turns[waiter] = concurrent.futures.Future()
+                logger.debug(f"Run active on thread {thread_id}; queued message behind it.")
+            else:
+                state.active = True
+                turn = None
+
+        if turn is None:
+            await self._drive(state, run_batch, waiter)
+        else:
+            await self._wait_for_turn(state, run_batch, waiter, turn)
+        return await asyncio.wrap_future(waiter)
+
+    async def _wait_for_turn(self, state, run_batch, waiter, turn):
+        """
+        Waits until the caller's message is answered, or until the driver hands driving to this caller.
+        """
+        answered, handed_over = asyncio.wrap_future(waiter), asyncio.wrap_future(turn)
+        await asyncio.wait({answered, handed_over}, return_when=asyncio.FIRST_COMPLETED)
+        with self._lock:
+            state.turns.pop(waiter, None)
+        if turn.done():
+            await self._drive(state, run_batch, waiter)
+        else:
+            handed_over.cancel()
+
+    def _hand_off(self, state, stop=False):
+        """
+        Makes the longest-waiting local caller the driver. Returns True if one took over, or if
+        there is none and stop is set, in which case the thread goes idle.
+        """
+        with self._lock:
+            for waiter, turn in list(state.turns.items()):
+                if not waiter.done():
+                    del state.turns[waiter]
+                    turn.set_result(True)
+                    return True
+            if stop:
+                state.active = False
+                self._states.pop(state.thread_id, None)
+            return stop
+
+    def _move_state(self, old_thread_id, new_thread_id):
+        with self._lock:
+            self._redirects[old_thread_id] = new_thread_id
+            state = self._states.pop(old_thread_id, None)
+            if state is not None:
+                state.thread_id = new_thread_id
+                self._states[new_thread_id] = state
+        return state
+
+    def rekey(self, old_thread_id, new_thread_id):
+        """
+        Moves a thread's queue to a new thread ID, e.g. after the conversation rolled over to a fresh thread.
+        """
+        state = self._move_state(old_thread_id, new_thread_id)
+        if self._leases and state is not None and state.lease_held:
+            # Blocking Firestore calls; callers on an event loop should run this in a worker thread
+            if self._leases.try_acquire(new_thread_id):
+                self._start_heartbeat(state)
+            else:
+                self._mark_lease_lost(state)
+            # Recorded before the old lease is released, so no other instance can acquire it and run on the stale thread
+            self._leases.redirect(old_thread_id, new_thread_id)
+            self._leases.release(old_thread_id)
+
+    async def _follow_redirect(self, state):
+        """
+        Moves the state to the thread its conversation rolled over to on another instance. Returns
+        True if the thread had been rolled over.
+        """
+        new_thread_id = await asyncio.to_thread(self._leases.redirect_of, state.thread_id)
+        if not new_thread_id:
+            return False
+        old_thread_id = state.thread_id
+        # Messages forwarded after the holder moved the queue are still under the old thread
+        await asyncio.to_thread(self._leases.move_pending, old_thread_id, new_thread_id)
+        self._move_state(old_thread_id, new_thread_id)
+        logger.info(f"Thread {old_thread_id} was rolled over to {new_thread_id}; following it.")
+        return True
+
+    def _mark_superseded(self, state):
+        with self._lock:
+            state.superseded = True
+
+    def _mark_lease_lost(self, state):
+        """
+        Called when the thread's lease could not be renewed: the active run is cancelled and the
+        driver goes back through acquiring the lease or forwarding to the new holder.
+        """
+        with self._lock:
+            state.lease_lost = True
+            state.superseded = True
+
+    def _start_heartbeat(self, state):
+        self._leases.start_heartbeat(
+            state.thread_id,
+            on_pending=lambda: self._mark_superseded(state),
+            on_lost=lambda: self._mark_lease_lost(state)
+        )
+
+    def _next_batch(self, state, keep_active):
+        with self._lock:
+            batch, state.pending = state.pending, []
+            state.superseded = False
+            if not batch and not keep_active and not state.remote_waiters:
+                state.active = False
+                self._states.pop(state.thread_id, None)
+            return batch
+
+    def _deliver(self, state, recipients, response):
+        for index, (waiter, message_id) in enumerate(recipients):
+            result = response if index == len(recipients) - 1 else COALESCED_RESPONSE
+            if message_id in state.remote_waiters:
+                # Our own forwarded message, claimed after we took over the lease
+                self._leases.discard(state.thread_id, message_id)
+                waiter = state.remote_waiters.pop(message_id)
+            elif message_id is not None:
+                self._leases.publish_result(state.thread_id, message_id, result)
+            if waiter is not None:
+                waiter.set_result(result)
+        self.stats["coalesced"] += len(recipients) - 1
+
+    async def _acquire_lease(self, state):
+        while not await asyncio.to_thread(self._leases.try_acquire, state.thread_id):
+            if not await self._follow_redirect(state):
+                return False
+        with self._lock:
+            state.lease_held = True
+            state.lease_lost = False
+        self._start_heartbeat(state)
+        return True
+
+    async def _forward(self, state, batch, own):
+        """
+        Sends messages to the instance holding the thread's lease and waits for its replies. Returns
+        early if the driver's own message (own) is answered, the lease becomes free (we then drive
+        the thread ourselves) or new local messages arrive.
+        """
+        for query, waiter in batch:
+            message_id = await asyncio.to_thread(self._leases.enqueue, state.thread_id, query)
+            state.remote_waiters[message_id] = waiter
+            self.stats["forwarded"] += 1
+
+        deadline = time.monotonic() + REMOTE_RESULT_TIMEOUT_SECONDS
+        while state.remote_waiters:
+            await asyncio.sleep(REMOTE_POLL_SECONDS)
+            results = await asyncio.to_thread(self._leases.fetch_results, state.thread_id, list(state.remote_waiters))
+            for message_id, response in results.items():
+                state.remote_waiters.pop(message_id).set_result(response)
+            if not state.remote_waiters or own.done() or await self._acquire_lease(state) or state.pending:
+                return
+            if time.monotonic() > deadline:
+                logger.error(f"Timed out waiting for the lease holder of thread {state.thread_id}.")
+                for waiter in state.remote_waiters.values():
+                    waiter.set_exception(TimeoutError("No reply from the instance driving this thread."))
+                state.remote_waiters.clear()
+
+    async def _drive(self, state, run_batch, own):
+        """
+        Runs the thread's queued messages until the driver's own message (own) is answered, then
+        hands driving on. The lease is kept across a hand-off and released when driving stops.
+        """
+        handed_off = False
+        try:
+            while True:
+                if own.done():
+                    if self._hand_off(state):
+                        handed_off = True
+                        return
+                    # Claimed forwarded messages already on the thread still need the run we owe them
+                    if not any(message_id is not None for _, message_id in state.carried):
+                        # Released before going idle, so a new local driver cannot have its lease released
+                        # under it; messages other instances forwarded stay queued for whoever acquires it next
+                        if state.lease_held:
+                            state.lease_held = False
+                            await asyncio.to_thread(self._leases.release, state.thread_id)
+                        self._hand_off(state, stop=True)
+                        return
+
+                if state.lease_lost:
+                    with self._lock:
+                        state.lease_held = False
+                        state.lease_lost = False
+                    self.stats["leases_lost"] += 1
+                    state.lost_at = time.monotonic()
+                    # Forwarded messages we had claimed go back to the queue for the next holder (claim_pending
+                    # skips our own claims); our own are already on the thread and only need a run once we hold the lease again
+                    dropped = [message_id for _, message_id in state.carried if message_id is not None]
+                    if dropped:
+                        await asyncio.to_thread(self._leases.requeue, state.thread_id, dropped)
+                    state.carried = [(waiter, message_id) for waiter, message_id in state.carried if message_id is None]
+                    logger.warning(f"Stopped driving thread {state.thread_id} after losing its run lease.")
+
+                if self._leases and not state.lease_held and not await self._acquire_lease(state):
+                    batch = self._next_batch(state, keep_active=bool(state.carried))
+                    if not batch and not state.remote_waiters and not state.carried:
+                        return
+                    if batch or state.remote_waiters:
+                        await self._forward(state, batch, own)
+                    elif time.monotonic() - state.lost_at > REMOTE_RESULT_TIMEOUT_SECONDS:
+                        logger.error(f"Timed out waiting to win back the run lease of thread {state.thread_id}.")
+                        for waiter, _ in state.carried:
+                            waiter.set_exception(TimeoutError("Lost the run lease for this thread."))
+                        state.carried = []
+                    else:
+                        await asyncio.sleep(REMOTE_POLL_SECONDS)
+                    continue
+
+                remote = await asyncio.to_thread(self._leases.claim_pending, state.thread_id) if self._leases else []
+                self.stats["claimed"] += len(remote)
+                batch = self._next_batch(state, keep_active=bool(state.carried or remote))
+                if not batch and not state.carried and not remote:
+                    return
+
+                # Each recipient is (local waiter, forwarded message ID); the newest one gets the reply
+                recipients = state.carried + [(None, message_id) for message_id, _ in remote] + [(waiter, None) for _, waiter in batch]
+                queries = [query for _, query in remote] + [query for query, _ in batch]
+                state.carried = []
+                self.stats["runs"] += 1
+
+                try:
+                    response = await run_batch(state.thread_id, queries, lambda: state.superseded or state.lease_lost)
+                except Exception as e:
+                    logger.error(f"Run on thread {state.thread_id} failed: {e}")
+                    for waiter, message_id in recipients:
+                        if message_id in state.remote_waiters:
+                            self._leases.discard(state.thread_id, message_id)
+                            waiter = state.remote_waiters.pop(message_id)
+                        elif message_id is not None:
+                            self._leases.publish_result(state.thread_id, message_id, {"text": [], "in_memory_files": [], "error": str(e)})
+                        if waiter is not None:
+                            waiter.set_exception(e)
+                    continue
+
+                if response is None:
+                    # Superseded and cancelled: these messages are already on the thread, so the
+                    # follow-up run answers them together with the newly queued ones
+                    self.stats["superseded"] += 1
+                    state.carried = recipients
+                    continue
+
+                self._deliver(state, recipients, response)
+        finally:
+            if state.lease_held and not handed_off:
+                state.lease_held = False
+                await asyncio.to_thread(self._leases.release, state.thread_id)
@@ -0,0 +1,472 @@
+import asyncio
+import atexit
+import contextvars
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from openai import OpenAI
+from jira_board_info import search_jira_issues
+from miro_board_index import get_board_index, item_text, compact_item
+from tool_outputs import adf_to_text
+from metrics import register_metrics
+from upstream_governor import upstream, OPENAI_HOST
+from usage_accounting import usage_ledger
+from logger_config import setup_logger
+from profiling import profiled
+
+logger = setup_logger()
+
+SEMANTIC_INDEX_DIR = os.environ.get("SEMANTIC_INDEX_DIR", "/tmp/semantic_index")
+# "openai" for hosted embeddings, "hashing" for the offline backend (tests, local runs without a key)
+SEMANTIC_EMBEDDING_BACKEND = os.environ.get("SEMANTIC_EMBEDDING_BACKEND", "openai")
+SEMANTIC_EMBEDDING_MODEL = os.environ.get("SEMANTIC_EMBEDDING_MODEL", "text-embedding-3-small")
+SEMANTIC_EMBEDDING_DIMENSIONS = int(os.environ.get("SEMANTIC_EMBEDDING_DIMENSIONS", 512))
+EMBED_BATCH_SIZE = int(os.environ.get("SEMANTIC_EMBED_BATCH_SIZE", 64))
+DOCUMENT_MAX_CHARS = 2000
+INITIAL_CAPACITY = 1024
+# The metadata JSON is rewritten at most this often; writes in between are flushed by a timer and at exit
+SEMANTIC_PERSIST_INTERVAL_SECONDS = float(os.environ.get("SEMANTIC_PERSIST_INTERVAL_SECONDS", 5))
+SEMANTIC_DEFAULT_TOP_K = 10
+SEMANTIC_MAX_TOP_K = 50
+# Issues pulled in (and embedded) when semantic_search is scoped by a JQL query
+SEMANTIC_JQL_MAX_RESULTS = 500
+SEMANTIC_JIRA_FIELDS = ["summary", "description", "status", "issuetype"]
+
+# How complete a document's text is; a lower-fidelity copy never replaces a higher one (see SemanticIndex.upsert)
+FIDELITY_ROW = 1
+FIDELITY_FULL = 2
+
+_WORD_PATTERN = re.compile(r"\w+")
+
+class HashingEmbeddingBackend:
+    """
+    Offline embedding: hashed bag of words and word bigrams. Only lexical overlap is captured,
+    but it needs no network access, which makes it suitable for tests and local runs.
+    """
+
+    def __init__(self, dimensions=256):
+        self.name = f"hashing:{dimensions}"
+        self.dimensions = dimensions
+
+    def embed(self, texts):
+        vectors = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            words = _WORD_PATTERN.findall(text.lower())
+            for feature in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+                digest = hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest()
+                bucket = int.from_bytes(digest[:4], 'little') % self.dimensions
+                vectors[row, bucket] += 1.0 if digest[4] & 1 else -1.0
+        return vectors
+
+class OpenAIEmbeddingBackend:
+    def __init__(self, model=SEMANTIC_EMBEDDING_MODEL, dimensions=SEMANTIC_EMBEDDING_DIMENSIONS, client=None):
+        self.name = f"openai:{model}:{dimensions}"
+        self.model = model
+        self.dimensions = dimensions
+        # Blocking client: embeddings are computed on the index's worker thread or via to_thread
+        self.client = client or OpenAI(api_key=os.environ.get("OPENAI_API_KEY"), max_retries=0)
+
+    def embed(self, texts):
+        response = upstream.call(OPENAI_HOST, lambda: self.client.embeddings.create(
+            model=self.model, input=texts, dimensions=self.dimensions
+        ), idempotent=True)
+        usage_ledger.record(self.model, response.usage)
+        return np.array([item.embedding for item in sorted(response.data, key=lambda item: item.index)], dtype=np.float32)
+
+def default_backend():
+    if SEMANTIC_EMBEDDING_BACKEND == "hashing":
+        return HashingEmbeddingBackend()
+    return OpenAIEmbeddingBackend()
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+def _text_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+class SemanticIndex:
+    """
+    Embedding index over Jira issues and Miro items. Vectors live in a memory-mapped .npy matrix
+    (one unit-length row per document) next to a JSON file describing each row, so the index
+    survives restarts without being re-embedded. Documents are only re-embedded when their text
+    changes, and each row remembers which Slack users fetched it so search never returns content
+    a user has not been able to read themselves.
+
+    Writes are expected to come from a single thread (_sync_executor); the lock only keeps
+    searches consistent while they happen.
+    """
+
+    def __init__(self, directory, backend):
+        self.directory = directory
+        self.backend = backend
+        self.vectors_path = os.path.join(directory, "vectors.npy")
+        self.meta_path = os.path.join(directory, "index.json")
+        self.vectors = None
+        self.rows = []
+        self.row_of = {}
+        self.free_rows = []
+        self.stats = {"embedded": 0, "embedding_batches": 0, "unchanged": 0, "lower_fidelity": 0, "removed": 0, "searches": 0, "persists": 0}
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._persisted_at = 0.0
+        self._flush_timer = None
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.meta_path) or not os.path.exists(self.vectors_path):
+            return
+        try:
+            with open(self.meta_path) as meta_file:
+                meta = json.load(meta_file)
+            if meta.get("backend") != self.backend.name:
+                logger.info(f"Semantic index at {self.directory} was built with {meta.get('backend')}; starting over with {self.backend.name}.")
+                return
+            self.vectors = np.load(self.vectors_path, mmap_mode='r+')
+            for row, entry in enumerate(meta["rows"]):
+                if entry is None:
+                    self.free_rows.append(row)
+                else:
+                    entry["users"] = set(entry["users"])
+                    self.row_of[entry["id"]] = row
+                self.rows.append(entry)
+            logger.info(f"Loaded semantic index with {len(self.row_of)} documents from {self.directory}.")
+        except (OSError, ValueError, KeyError) as e:
+            logger.error(f"Failed to load semantic index from {self.directory}; starting over: {e}")
+            self.vectors, self.rows, self.row_of, self.free_rows = None, [], {}, []
+
+    def _ensure_capacity(self, rows_needed, dimensions):
+        """
+        Grows the memory-mapped matrix (doubling) so it holds at least rows_needed rows.
+        """
+        capacity = 0 if self.vectors is None else self.vectors.shape[0]
+        if rows_needed <= capacity:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        new_capacity = max(rows_needed, capacity * 2, INITIAL_CAPACITY)
+        temp_path = self.vectors_path + ".tmp"
+        grown = np.lib.format.open_memmap(temp_path, mode='w+', dtype=np.float32, shape=(new_capacity, dimensions))
+        if capacity:
+            grown[:capacity] = self.vectors[:capacity]
+        grown.flush()
+        del grown
+        os.replace(temp_path, self.vectors_path)
+        self.vectors = np.load(self.vectors_path, mmap_mode='r+')
+
+    def _persist(self):
+        """
+        Marks the index changed and writes it out if the last write is SEMANTIC_PERSIST_INTERVAL_SECONDS
+        old, else leaves it to the flush timer. Called with the lock held.
+        """
+        self._dirty = True
+        wait = self._persisted_at + SEMANTIC_PERSIST_INTERVAL_SECONDS - time.monotonic()
+        if wait <= 0:
+            self._write()
+        elif self._flush_timer is None:
+            self._flush_timer = threading.Timer(wait, self.flush)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+
+    def _write(self):
+        # If the process dies before the metadata catches up, rows it does not describe are unused
+        # and rows whose vector changed carry the old hash, so they are simply re-embedded
+        self.vectors.flush()
+        rows = [None if entry is None else {**entry, "users": sorted(entry["users"])} for entry in self.rows]
+        temp_path = self.meta_path + ".tmp"
+        with open(temp_path, "w") as meta_file:
+            json.dump({"backend": self.backend.name, "rows": rows}, meta_file)
+        os.replace(temp_path, self.meta_path)
+        self._dirty = False
+        self._persisted_at = time.monotonic()
+        self.stats["persists"] += 1
+
+    def flush(self):
+        """
+        Writes out changes still waiting for the persist interval.
+        """
+        with self._lock:
+            self._flush_timer = None
+            if self._dirty:
+                self._write()
+
+    def _embed(self, texts):
+        batches = []
+        for start in range(0, len(texts), EMBED_BATCH_SIZE):
+            batches.append(self.backend.embed(texts[start:start + EMBED_BATCH_SIZE]))
+            self.stats["embedding_batches"] += 1
+        return _normalize(np.vstack(batches))
+
+    def upsert(self, documents, user_id):
+        """
+        Adds or refreshes documents ({"id", "source", "scope", "text", "doc"}, optionally "fidelity")
+        fetched by user_id. Only new documents and documents whose text changed are embedded, in
+        batches. A document with lower fidelity than the indexed copy (e.g. a search row with a
+        truncated description, after the full issue) only adds the user and refreshes "doc".
+
+        Returns:
+            int: The number of documents embedded.
+        """
+        documents = list({document["id"]: document for document in documents if document.get("text")}.values())
+        with self._lock:
+            changed = []
+            for document in documents:
+                text = document["text"][:DOCUMENT_MAX_CHARS]
+                row = self.row_of.get(document["id"])
+                if row is not None and self.rows[row]["hash"] == _text_hash(text):
+                    self.rows[row]["users"].add(user_id)
+                    self.rows[row]["doc"] = document["doc"]
+                    self.stats["unchanged"] += 1
+                elif row is not None and self.rows[row].get("fidelity", 0) > document.get("fidelity", 0):
+                    self.rows[row]["users"].add(user_id)
+                    self.rows[row]["doc"] = {**self.rows[row]["doc"], **document["doc"]}
+                    self.stats["lower_fidelity"] += 1
+                else:
+                    changed.append((document, text))
+            if not changed:
+                if documents:
+                    self._persist()
+                return 0
+
+        # Embedding is a network round trip; keep it outside the lock so searches are not blocked
+        vectors = self._embed([text for _, text in changed])
+
+        with self._lock:
+            new_rows = sum(1 for document, _ in changed if document["id"] not in self.row_of)
+            self._ensure_capacity(len(self.rows) + max(new_rows - len(self.free_rows), 0), vectors.shape[1])
+            for (document, text), vector in zip(changed, vectors):
+                row = self.row_of.get(document["id"])
+                users = {user_id}
+                if row is None:
+                    row = self.free_rows.pop() if self.free_rows else len(self.rows)
+                    if row == len(self.rows):
+                        self.rows.append(None)
+                else:
+                    users |= self.rows[row]["users"]
+                self.vectors[row] = vector
+                self.rows[row] = {
+                    "id": document["id"], "source": document["source"], "scope": document["scope"],
+                    "hash": _text_hash(text), "fidelity": document.get("fidelity", 0), "users": users, "doc": document["doc"]
+                }
+                self.row_of[document["id"]] = row
+            self.stats["embedded"] += len(changed)
+            self._persist()
+        logger.debug(f"Embedded {len(changed)} of {len(documents)} documents for the semantic index.")
+        return len(changed)
+
+    def remove_missing(self, source, scope, keep_ids):
+        """
+        Drops documents of a fully re-fetched scope (e.g. a Miro board) that are no longer in it.
+        """
+        with self._lock:
+            removed = 0
+            for row, entry in enumerate(self.rows):
+                if entry and entry["source"] == source and entry["scope"] == scope and entry["id"] not in keep_ids:
+                    del self.row_of[entry["id"]]
+                    self.rows[row] = None
+                    self.vectors[row] = 0
+                    self.free_rows.append(row)
+                    removed += 1
+            if removed:
+                self.stats["removed"] += removed
+                self._persist()
+        return removed
+
+    def search(self, query_vector, user_id, top_k=SEMANTIC_DEFAULT_TOP_K, include=None):
+        """
+        Returns up to top_k (score, entry) pairs by cosine similarity among the documents user_id
+        has fetched, optionally narrowed by an include(entry) predicate.
+        """
+        query_vector = _normalize(np.asarray(query_vector, dtype=np.float32).reshape(1, -1))[0]
+        with self._lock:
+            self.stats["searches"] += 1
+            if not self.row_of:
+                return []
+            candidates = np.array([
+                entry is not None and user_id in entry["users"] and (include is None or include(entry))
+                for entry in self.rows
+            ])
+            if not candidates.any():
+                return []
+            scores = np.where(candidates, self.vectors[:len(self.rows)] @ query_vector, -np.inf)
+            top_k = min(top_k, int(candidates.sum()))
+            top_rows = np.argpartition(-scores, top_k - 1)[:top_k]
+            top_rows = top_rows[np.argsort(-scores[top_rows])]
+            return [(float(scores[row]), self.rows[row]) for row in top_rows]
+
+    def metrics(self):
+        with self._lock:
+            return {**self.stats, "documents": len(self.row_of), "backend": self.backend.name}
+
+def _jira_text(key, summary, description):
+    """
+    The indexed text of an issue; both Jira document builders use it so the same issue hashes the same.
+    """
+    return f"{key} {summary}\n{description}".strip()
+
+def jira_documents(issues):
+    """
+    Turns raw Jira issues (with 'fields') into index documents.
+    """
+    documents = []
+    for issue in issues or []:
+        key = issue.get('key')
+        fields = issue.get('fields') or {}
+        if not key:
+            continue
+        summary = fields.get('summary') or ''
+        description = adf_to_text(fields.get('description')).strip()
+        doc = {"key": key, "summary": summary}
+        for label, field in (("status", 'status'), ("type", 'issuetype')):
+            if isinstance(fields.get(field), dict) and fields[field].get('name'):
+                doc[label] = fields[field]['name']
+        documents.append({"id": f"jira:{key}", "source": "jira", "scope": key.split('-')[0],
+                          "text": _jira_text(key, summary, description), "fidelity": FIDELITY_FULL, "doc": doc})
+    return documents
+
+def jira_row_documents(search_result):
+    """
+    Turns the compact rows returned by search_jira_issues into index documents. Row values are
+    cut short, so these rank below jira_documents built from the full issue.
+    """
+    columns = search_result.get('columns') or []
+    documents = []
+    for row in search_result.get('rows') or []:
+        values = dict(zip(columns, row))
+        key = values.get('key')
+        if not key:
+            continue
+        doc = {"key": key, "summary": values.get('summary') or ''}
+        for label, field in (("status", 'status'), ("type", 'issuetype')):
+            if values.get(field):
+                doc[label] = values[field]
+        text = _jira_text(key, values.get('summary') or '', str(values.get('description') or '').strip())
+        documents.append({"id": f"jira:{key}", "source": "jira", "scope": key.split('-')[0],
+                          "text": text, "fidelity": FIDELITY_ROW, "doc": doc})
+    return documents
+
+def miro_documents(board_id, items):
+    """
+    Turns Miro board items into index documents; items without visible text are skipped.
+    """
+    documents = []
+    for item in items:
+        text = item_text(item)
+        if not text or not item.get('id'):
+            continue
+        doc = {"board_id": board_id, **compact_item(item)}
+        parent_id = (item.get('parent') or {}).get('id')
+        if parent_id:
+            doc["frame_id"] = parent_id
+        documents.append({"id": f"miro:{board_id}:{item['id']}", "source": "miro", "scope": board_id,
+                          "text": f"{item.get('type', '')}: {text}", "doc": doc})
+    return documents
+
+semantic_index = SemanticIndex(SEMANTIC_INDEX_DIR, default_backend())
+register_metrics("semantic_index", semantic_index.metrics)
+atexit.register(semantic_index.flush)
+
+# A single worker keeps index writes serialized and lets tool calls return before embedding finishes;
+# jobs run in the submitter's context so their embedding usage is charged to the right user and tool
+_sync_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="semantic-index")
+
+def sync_board(board_id, items, user_id):
+    """
+    Indexes every item of a fully fetched Miro board and drops items deleted from it.
+    """
+    documents = miro_documents(board_id, items)
+    embedded = semantic_index.upsert(documents, user_id)
+    semantic_index.remove_missing("miro", board_id, {document["id"] for document in documents})
+    return embedded
+
+def _write_in_worker(fn, *args):
+    """
+    Runs an index write on the sync worker and returns an awaitable for its result.
+    """
+    return asyncio.wrap_future(_sync_executor.submit(contextvars.copy_context().run, fn, *args))
+
+def _run_sync(fn, *args):
+    try:
+        fn(*args)
+    except Exception as e:
+        logger.error(f"Background semantic index sync failed: {e}")
+
+def index_board_in_background(board_id, items, user_id):
+    if user_id:
+        _sync_executor.submit(contextvars.copy_context().run, _run_sync, sync_board, board_id, list(items), user_id)
+
+def index_tool_output(function_name, output, user_id):
+    """
+    Queues the Jira issues contained in a tool output for indexing.
+    """
+    if not user_id or not isinstance(output, dict):
+        return
+    if function_name == 'get_jiraissue' and isinstance(output.get('issue_details'), dict):
+        documents = jira_documents([output['issue_details']])
+    elif function_name == 'get_issues_for_epic':
+        documents = jira_documents(output.get('ChildIssues'))
+    elif function_name == 'search_jira_issues':
+        documents = jira_row_documents(output)
+    else:
+        return
+    if documents:
+        _sync_executor.submit(contextvars.copy_context().run, _run_sync, semantic_index.upsert, documents, user_id)
+
+@profiled("semantic_search")
+async def semantic_search(user_id, query, source=None, board_id=None, jql=None, top_k=SEMANTIC_DEFAULT_TOP_K, miro_token=None, jira_token=None):
+    """
+    Returns the indexed Jira issues and Miro items most similar to the query.
+
+    A board_id or jql first brings that board or those issues into the index (embedding only
+    what changed) and restricts the search to them; otherwise everything the user fetched
+    earlier is searched.
+
+    Args:
+        user_id (str): The Slack user searching.
+        query (str): Natural-language description of what to find.
+        source (str): Optional "jira" or "miro" to search only one source.
+        board_id (str): Optional Miro board to sync and search.
+        jql (str): Optional JQL query whose issues are synced and searched.
+        top_k (int): The number of results to return.
+
+    Returns:
+        dict: The results, most similar first, each with its similarity score.
+    """
+    if not query:
+        return {"status": "error", "message": "A query is required."}
+    top_k = max(1, min(int(top_k or SEMANTIC_DEFAULT_TOP_K), SEMANTIC_MAX_TOP_K))
+    scopes = []
+
+    if board_id and source != "jira":
+        index, board_content = await get_board_index(board_id, miro_token)
+        if index is None:
+            return board_content
+        await _write_in_worker(sync_board, board_id, list(index.by_id.values()), user_id)
+        scopes.append(lambda entry: entry["source"] == "miro" and entry["scope"] == board_id)
+
+    if jql and source != "miro":
+        result = await search_jira_issues(jira_token, jql, SEMANTIC_JIRA_FIELDS, SEMANTIC_JQL_MAX_RESULTS)
+        if "rows" not in result:
+            return result
+        documents = jira_row_documents(result)
+        await _write_in_worker(semantic_index.upsert, documents, user_id)
+        issue_ids = {document["id"] for document in documents}
+        scopes.append(lambda entry: entry["id"] in issue_ids)
+
+    def include(entry):
+        if source and entry["source"] != source:
+            return False
+        return not scopes or any(scope(entry) for scope in scopes)
+
+    query_vector = (await asyncio.to_thread(semantic_index.backend.embed, [query]))[0]
+    hits = semantic_index.search(query_vector, user_id, top_k, include)
+    if not hits:
+        return {"status": "error", "message": "Nothing indexed to search yet. Pass a board_id or a jql query to index content first."}
+    return {
+        "query": query,
+        "results": [{"score": round(score, 3), "source": entry["source"], **entry["doc"]} for score, entry in hits]
+    }
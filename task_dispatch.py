@@ -0,0 +1,352 @@
+import datetime
+import hmac
+import json
+import os
+import re
+import threading
+import time
+from firebase_admin import firestore
+from metrics import register_metrics
+from upstream_governor import TokenBucket
+from logger_config import setup_logger
+
+logger = setup_logger()
+
+# "thread" processes messages on a background thread after the ack (needs always-on CPU on Cloud Run);
+# "cloud_tasks" and "local" enqueue them to TASK_ROUTE so they are processed inside a request
+TASK_DISPATCH_MODE = os.environ.get("TASK_DISPATCH_MODE", "thread")
+TASK_ROUTE = "/tasks/process-message"
+# The whole message pipeline (assistant run, tools, replies) runs inside the task request, so every
+# timeout on its path must be longer than one message takes:
+# - TASK_DISPATCH_DEADLINE_SECONDS: how long Cloud Tasks waits for the route (15s to 1800s) before it
+#   counts the attempt as failed and retries.
+# - Cloud Run's request timeout (--timeout in cloudbuild.yaml, 660s) and the gunicorn worker timeout
+#   (GUNICORN_TIMEOUT in gunicorn.conf.py, 660s) must exceed the deadline so neither cuts a task short.
+# - TASK_LEASE_SECONDS must exceed it too, so a retry never starts while the first delivery still runs.
+TASK_DISPATCH_DEADLINE_SECONDS = int(os.environ.get("TASK_DISPATCH_DEADLINE_SECONDS", 600))
+TASKS_PROJECT = os.environ.get("TASKS_PROJECT") or os.environ.get("GOOGLE_CLOUD_PROJECT")
+TASKS_LOCATION = os.environ.get("TASKS_LOCATION", "us-central1")
+TASKS_QUEUE = os.environ.get("TASKS_QUEUE", "slackbot-messages")
+# Public URL of TASK_ROUTE on this service, e.g. https://slackbot-service-xyz.a.run.app/tasks/process-message
+TASKS_TARGET_URL = os.environ.get("TASKS_TARGET_URL")
+TASKS_SERVICE_ACCOUNT = os.environ.get("TASKS_SERVICE_ACCOUNT")
+# Shared secret the task route requires in TASK_SECRET_HEADER (Authorization carries the OIDC token).
+# Without it, the route only accepts OIDC tokens issued to TASKS_SERVICE_ACCOUNT for TASKS_TARGET_URL.
+TASK_SECRET_HEADER = "X-Task-Secret"
+TASKS_SECRET = os.environ.get("TASKS_SECRET")
+# Apply TASK_DISPATCH_RATE and TASK_MAX_ATTEMPTS to the Cloud Tasks queue at startup
+TASKS_CONFIGURE_QUEUE = os.environ.get("TASKS_CONFIGURE_QUEUE", "false").lower() == "true"
+TASK_DISPATCH_RATE = float(os.environ.get("TASK_DISPATCH_RATE", 5))
+TASK_MAX_ATTEMPTS = int(os.environ.get("TASK_MAX_ATTEMPTS", 5))
+TASK_MAX_CONCURRENT = int(os.environ.get("TASK_MAX_CONCURRENT", 8))
+# A task claimed by a delivery that has not finished within this long may be claimed again
+TASK_LEASE_SECONDS = float(os.environ.get("TASK_LEASE_SECONDS", TASK_DISPATCH_DEADLINE_SECONDS + 60))
+TASK_DEDUP_TTL_SECONDS = 3600
+TASK_RETRY_BASE_SECONDS = 1.0
+TASK_COLLECTION = 'dispatched_tasks'
+
+_TASK_NAME_PATTERN = re.compile(r"[^A-Za-z0-9_-]")
+
+@firestore.transactional
+def _claim_in_transaction(transaction, task_ref, lease_seconds):
+    snapshot = task_ref.get(transaction=transaction)
+    task = snapshot.to_dict() if snapshot.exists else {}
+    now = time.time()
+    if task.get('state') == 'done':
+        return 'done'
+    if task.get('state') == 'processing' and task.get('expires_at', 0) > now:
+        return 'in_progress'
+    transaction.set(task_ref, {'state': 'processing', 'expires_at': now + lease_seconds, 'attempts': task.get('attempts', 0) + 1})
+    return 'claimed'
+
+class TaskDeduplicator:
+    """
+    Makes task deliveries effectively once: a delivery claims the task ID before processing and
+    marks it done afterwards. Duplicate deliveries of finished tasks, and deliveries racing an
+    unfinished one, are skipped. With a Firestore client the claims are shared by every instance;
+    without one they are local to the process.
+    """
+
+    def __init__(self, db=None, lease_seconds=TASK_LEASE_SECONDS):
+        self.db = db
+        self.lease_seconds = lease_seconds
+        self._lock = threading.Lock()
+        self._local = {}
+
+    def claim(self, task_id):
+        """
+        Returns "claimed", "done" or "in_progress".
+        """
+        if self.db:
+            task_ref = self.db.collection(TASK_COLLECTION).document(task_id)
+            return _claim_in_transaction(self.db.transaction(), task_ref, self.lease_seconds)
+        now = time.time()
+        with self._lock:
+            for expired in [key for key, (_, expires_at) in self._local.items() if expires_at <= now]:
+                del self._local[expired]
+            state, _ = self._local.get(task_id, (None, 0))
+            if state == 'done':
+                return 'done'
+            if state == 'processing':
+                return 'in_progress'
+            self._local[task_id] = ('processing', now + self.lease_seconds)
+            return 'claimed'
+
+    def finish(self, task_id, succeeded):
+        """
+        Marks the task done, or releases the claim so a retry can process it.
+        """
+        if self.db:
+            task_ref = self.db.collection(TASK_COLLECTION).document(task_id)
+            if succeeded:
+                task_ref.set({'state': 'done', 'expires_at': time.time() + TASK_DEDUP_TTL_SECONDS}, merge=True)
+            else:
+                task_ref.set({'state': 'failed', 'expires_at': 0}, merge=True)
+            return
+        with self._lock:
+            if succeeded:
+                self._local[task_id] = ('done', time.time() + TASK_DEDUP_TTL_SECONDS)
+            else:
+                self._local.pop(task_id, None)
+
+def verify_task_request(headers):
+    """
+    Checks that a request to the task route was sent by our queue: it must carry TASKS_SECRET, or,
+    when no secret is configured, a Google-signed OIDC token for TASKS_SERVICE_ACCOUNT whose
+    audience is TASKS_TARGET_URL. Requests are refused when neither is configured.
+    """
+    if TASKS_SECRET:
+        return hmac.compare_digest(headers.get(TASK_SECRET_HEADER, ''), TASKS_SECRET)
+    if not (TASKS_SERVICE_ACCOUNT and TASKS_TARGET_URL):
+        return False
+    authorization = headers.get('Authorization', '')
+    if not authorization.startswith('Bearer '):
+        return False
+    # Optional dependency (installed with the Google Cloud clients), only needed for OIDC-authenticated tasks
+    from google.oauth2 import id_token
+    from google.auth.transport import requests as google_requests
+    try:
+        claims = id_token.verify_oauth2_token(authorization[len('Bearer '):], google_requests.Request(), audience=TASKS_TARGET_URL)
+    except ValueError as e:
+        logger.warning(f"Rejected task request with an invalid OIDC token: {e}")
+        return False
+    return claims.get('email') == TASKS_SERVICE_ACCOUNT and claims.get('email_verified', False)
+
+def task_name(task_id):
+    """
+    Cloud Tasks names allow letters, digits, hyphens and underscores only.
+    """
+    return _TASK_NAME_PATTERN.sub("_", str(task_id))[:500]
+
+class ThreadDispatcher:
+    """
+    Processes each task on a new background thread right away; the behaviour before task dispatch existed.
+    """
+
+    def __init__(self, handler, stats):
+        self.handler = handler
+        self.stats = stats
+
+    def enqueue(self, task_id, payload):
+        self.stats["enqueued"] += 1
+        threading.Thread(target=self.handler, args=(payload,)).start()
+        return True
+
+class LocalTaskQueue:
+    """
+    In-process stand-in for Cloud Tasks, for tests and local runs: tasks are deduplicated by name,
+    released at TASK_DISPATCH_RATE, delivered concurrently (up to TASK_MAX_CONCURRENT) through the
+    same code path as the task route, and retried with exponential backoff on failure.
+    """
+
+    def __init__(self, deliver, stats, rate=TASK_DISPATCH_RATE, max_attempts=TASK_MAX_ATTEMPTS):
+        self.deliver = deliver
+        self.stats = stats
+        self.max_attempts = max_attempts
+        self.bucket = TokenBucket(rate, max(int(rate), 1))
+        self.slots = threading.BoundedSemaphore(TASK_MAX_CONCURRENT)
+        self._ready = []
+        self._names = {}
+        self._lock = threading.Condition()
+        threading.Thread(target=self._dispatch_loop, name="local-task-queue", daemon=True).start()
+
+    def enqueue(self, task_id, payload):
+        name = task_name(task_id)
+        now = time.time()
+        with self._lock:
+            for expired in [key for key, expires_at in self._names.items() if expires_at <= now]:
+                del self._names[expired]
+            if name in self._names:
+                self.stats["duplicates"] += 1
+                return False
+            self._names[name] = now + TASK_DEDUP_TTL_SECONDS
+            self._ready.append((payload, 1))
+            self.stats["enqueued"] += 1
+            self._lock.notify()
+        return True
+
+    def _requeue(self, payload, attempt):
+        with self._lock:
+            self._ready.append((payload, attempt))
+            self._lock.notify()
+
+    def _dispatch_loop(self):
+        while True:
+            with self._lock:
+                while not self._ready:
+                    self._lock.wait()
+                payload, attempt = self._ready.pop(0)
+            wait = self.bucket.reserve()
+            while wait:
+                time.sleep(wait)
+                wait = self.bucket.reserve()
+            self.slots.acquire()
+            threading.Thread(target=self._deliver, args=(payload, attempt), daemon=True).start()
+
+    def _deliver(self, payload, attempt):
+        try:
+            status = self.deliver(payload)
+        except Exception as e:
+            logger.error(f"Local task delivery failed: {e}")
+            status = 500
+        finally:
+            self.slots.release()
+        if status < 400:
+            return
+        if attempt >= self.max_attempts:
+            logger.error(f"Dropping task {payload.get('task_id')} after {attempt} attempts.")
+            self.stats["dropped"] += 1
+            return
+        self.stats["retried"] += 1
+        delay = TASK_RETRY_BASE_SECONDS * 2 ** (attempt - 1)
+        threading.Timer(delay, self._requeue, args=(payload, attempt + 1)).start()
+
+class CloudTasksDispatcher:
+    """
+    Enqueues tasks as authenticated HTTP requests to TASKS_TARGET_URL on a Cloud Tasks queue.
+    Task names are derived from the task ID, so Cloud Tasks rejects duplicates for us; the
+    queue's rate limits and retry policy control dispatch rate and retries.
+    """
+
+    def __init__(self, stats):
+        # Optional dependency, only needed in cloud_tasks mode
+        from google.cloud import tasks_v2
+        from google.api_core.exceptions import AlreadyExists
+        self.tasks_v2 = tasks_v2
+        self.already_exists = AlreadyExists
+        self.stats = stats
+        self.client = tasks_v2.CloudTasksClient()
+        self.parent = self.client.queue_path(TASKS_PROJECT, TASKS_LOCATION, TASKS_QUEUE)
+        if not TASKS_TARGET_URL:
+            raise ValueError("TASKS_TARGET_URL must be set when TASK_DISPATCH_MODE is cloud_tasks.")
+        if not (TASKS_SECRET or TASKS_SERVICE_ACCOUNT):
+            # The task route runs the assistant as whichever user the payload names; it must be authenticated
+            raise ValueError("TASKS_SECRET or TASKS_SERVICE_ACCOUNT must be set when TASK_DISPATCH_MODE is cloud_tasks.")
+        if TASKS_CONFIGURE_QUEUE:
+            self.configure_queue()
+
+    def configure_queue(self):
+        queue = {
+            "name": self.parent,
+            "rate_limits": {"max_dispatches_per_second": TASK_DISPATCH_RATE, "max_concurrent_dispatches": TASK_MAX_CONCURRENT},
+            "retry_config": {"max_attempts": TASK_MAX_ATTEMPTS},
+        }
+        try:
+            self.client.update_queue(queue=queue, update_mask={"paths": ["rate_limits", "retry_config.max_attempts"]})
+            logger.info(f"Configured task queue {TASKS_QUEUE}: {TASK_DISPATCH_RATE}/s, {TASK_MAX_ATTEMPTS} attempts.")
+        except Exception as e:
+            logger.error(f"Failed to configure task queue {TASKS_QUEUE}: {e}")
+
+    def enqueue(self, task_id, payload):
+        headers = {"Content-Type": "application/json"}
+        if TASKS_SECRET:
+            headers[TASK_SECRET_HEADER] = TASKS_SECRET
+        http_request = {
+            "http_method": self.tasks_v2.HttpMethod.POST,
+            "url": TASKS_TARGET_URL,
+            "headers": headers,
+            "body": json.dumps(payload).encode('utf-8'),
+        }
+        if TASKS_SERVICE_ACCOUNT:
+            http_request["oidc_token"] = {"service_account_email": TASKS_SERVICE_ACCOUNT, "audience": TASKS_TARGET_URL}
+        task = {
+            "name": self.client.task_path(TASKS_PROJECT, TASKS_LOCATION, TASKS_QUEUE, task_name(task_id)),
+            "http_request": http_request,
+            "dispatch_deadline": datetime.timedelta(seconds=TASK_DISPATCH_DEADLINE_SECONDS),
+        }
+        try:
+            self.client.create_task(parent=self.parent, task=task)
+        except self.already_exists:
+            self.stats["duplicates"] += 1
+            logger.info(f"Task {task_id} was already enqueued; skipping the duplicate.")
+            return False
+        self.stats["enqueued"] += 1
+        return True
+
+class TaskDispatch:
+    """
+    Hands post-ack work to the configured dispatcher, and runs delivered tasks (from the task
+    route or the local queue) with deduplication.
+    """
+
+    def __init__(self, handler, mode=TASK_DISPATCH_MODE, db=None):
+        self.handler = handler
+        self.mode = mode
+        self.stats = {"enqueued": 0, "duplicates": 0, "processed": 0, "skipped_done": 0, "in_progress": 0, "failed": 0, "retried": 0, "dropped": 0}
+        self.deduplicator = TaskDeduplicator(db)
+        if mode == "cloud_tasks":
+            self.dispatcher = CloudTasksDispatcher(self.stats)
+        elif mode == "local":
+            self.dispatcher = LocalTaskQueue(self.run, self.stats)
+        else:
+            self.dispatcher = ThreadDispatcher(handler, self.stats)
+
+    def enqueue(self, task_id, payload):
+        """
+        Enqueues a task; returns False if a task with the same ID was already enqueued.
+        """
+        return self.dispatcher.enqueue(task_id, {**payload, "task_id": task_id})
+
+    def run(self, payload):
+        """
+        Processes a delivered task. Returns the HTTP status for the delivery: 200 when done, already
+        done or being processed by another delivery (retrying would only use up attempts), and 500
+        on failure, so the queue retries.
+        """
+        task_id = payload.get("task_id")
+        state = self.deduplicator.claim(task_id) if task_id else "claimed"
+        if state == "done":
+            self.stats["skipped_done"] += 1
+            logger.info(f"Task {task_id} was already processed; skipping.")
+            return 200
+        if state == "in_progress":
+            self.stats["in_progress"] += 1
+            logger.info(f"Task {task_id} is being processed by another delivery; skipping.")
+            return 200
+        try:
+            self.handler(payload)
+        except Exception as e:
+            logger.error(f"Task {task_id} failed: {e}")
+            self.stats["failed"] += 1
+            if task_id:
+                self.deduplicator.finish(task_id, False)
+            return 500
+        if task_id:
+            self.deduplicator.finish(task_id, True)
+        self.stats["processed"] += 1
+        return 200
+
+    def metrics(self):
+        return {"mode": self.mode, **self.stats}
+
+def create_task_dispatch(handler):
+    """
+    Builds the process-wide TaskDispatch for TASK_DISPATCH_MODE; Cloud Tasks deliveries can land
+    on any instance, so their deduplication is shared through Firestore.
+    """
+    db = None
+    if TASK_DISPATCH_MODE == "cloud_tasks":
+        from shared_resources import db
+    task_dispatch = TaskDispatch(handler, db=db)
+    register_metrics("task_dispatch", task_dispatch.metrics)
+    return task_dispatch
@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+
+# Keep the modules under test offline: no Firestore usage writes, and a local embedding backend and index dir
+os.environ.setdefault("USAGE_FIRESTORE_ENABLED", "false")
+os.environ.setdefault("SEMANTIC_EMBEDDING_BACKEND", "hashing")
+os.environ.setdefault("SEMANTIC_INDEX_DIR", tempfile.mkdtemp(prefix="semantic-index-"))
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
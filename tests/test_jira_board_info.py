@@ -0,0 +1,67 @@
+import asyncio
+
+import jira_board_info
+
+class FakeResponse:
+    status_code = 204
+    text = ""
+
+def _capture_requests(monkeypatch):
+    sent = []
+
+    def fake_request(method, url, idempotent=None, **kwargs):
+        sent.append((method, kwargs["json"]))
+        return FakeResponse()
+
+    monkeypatch.setattr(jira_board_info, "jira_request", fake_request)
+    return sent
+
+def test_update_sends_only_the_given_fields(monkeypatch):
+    sent = _capture_requests(monkeypatch)
+    assert jira_board_info.update_issue_summary_and_description("token", "PROJ-1", summary="New title")
+    assert jira_board_info.update_issue_summary_and_description("token", "PROJ-1", description="New body")
+    assert sent == [("PUT", {"fields": {"summary": "New title"}}), ("PUT", {"fields": {"description": "New body"}})]
+
+def test_update_without_fields_sends_nothing(monkeypatch):
+    sent = _capture_requests(monkeypatch)
+    assert not jira_board_info.update_issue_summary_and_description("token", "PROJ-1")
+    assert sent == []
+
+def _issues(start, count):
+    return [{"key": f"PROJ-{n}", "fields": {"summary": f"Issue {n}"}} for n in range(start, start + count)]
+
+def _fake_search(monkeypatch, total):
+    requests_seen = []
+
+    async def fetch(session, url, headers, payload):
+        requests_seen.append((url.rsplit("/rest/api/2/", 1)[1], payload))
+        if url.endswith("/search/jql"):
+            start = int(payload.get("nextPageToken") or 0)
+            count = min(payload["maxResults"], total - start)
+            end = start + count
+            return {"issues": _issues(start, count), "nextPageToken": str(end) if end < total else None, "isLast": end >= total}
+        count = min(payload["maxResults"], total - payload["startAt"])
+        return {"issues": _issues(payload["startAt"], count), "total": total, "maxResults": payload["maxResults"]}
+
+    monkeypatch.setattr(jira_board_info, "_fetch_search_page", fetch)
+    monkeypatch.setattr(jira_board_info, "SEARCH_PAGE_SIZE", 10)
+    return requests_seen
+
+def test_start_at_paging_fetches_every_page(monkeypatch):
+    seen = _fake_search(monkeypatch, total=25)
+    result = asyncio.run(jira_board_info.search_jira_issues("token", "project = PROJ", ["summary"], 100))
+    assert [row[0] for row in result["rows"]] == [f"PROJ-{n}" for n in range(25)]
+    assert (result["total"], result["truncated"]) == (25, False)
+    assert {path for path, _ in seen} == {"search"}
+
+def test_token_paging_follows_next_page_token(monkeypatch):
+    seen = _fake_search(monkeypatch, total=25)
+    monkeypatch.setattr(jira_board_info, "JIRA_SEARCH_PAGING", "token")
+    result = asyncio.run(jira_board_info.search_jira_issues("token", "project = PROJ", ["summary"], 100))
+    assert [row[0] for row in result["rows"]] == [f"PROJ-{n}" for n in range(25)]
+    assert (result["total"], result["truncated"]) == (25, False)
+    assert [payload.get("nextPageToken") for _, payload in seen] == [None, "10", "20"]
+
+    result = asyncio.run(jira_board_info.search_jira_issues("token", "project = PROJ", ["summary"], 15))
+    assert len(result["rows"]) == 15
+    assert (result["total"], result["truncated"]) == (None, True)
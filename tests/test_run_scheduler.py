@@ -0,0 +1,156 @@
+import asyncio
+
+import pytest
+
+import run_scheduler
+from run_scheduler import COALESCED_RESPONSE, ThreadRunScheduler
+
+THREAD = "thread_1"
+
+class FakeRuns:
+    """run_batch stand-in: records each run and finishes it when the test releases it."""
+
+    def __init__(self, honour_cancel=True):
+        self.honour_cancel = honour_cancel
+        self.batches = []
+        self.started = asyncio.Event()
+        self.gates = []
+
+    async def run_batch(self, thread_id, queries, should_cancel):
+        gate = asyncio.Event()
+        self.batches.append(list(queries))
+        self.gates.append(gate)
+        self.started.set()
+        while not gate.is_set():
+            if self.honour_cancel and should_cancel():
+                return None
+            await asyncio.sleep(0.001)
+        return {"text": [f"reply to {queries[-1] if queries else self.batches[0][-1]}"], "in_memory_files": []}
+
+    async def wait_for_run(self, count):
+        while len(self.batches) < count:
+            await asyncio.sleep(0.001)
+
+    def finish(self, index):
+        self.gates[index].set()
+
+class FakeLeases:
+    def __init__(self, forwarded=()):
+        self.acquired = []
+        self.released = []
+        self.requeued = []
+        self.published = {}
+        self.forwarded = list(forwarded)
+        self.on_lost = None
+
+    def try_acquire(self, thread_id):
+        self.acquired.append(thread_id)
+        return True
+
+    def start_heartbeat(self, thread_id, on_pending=None, on_lost=None):
+        self.on_lost = on_lost
+
+    def claim_pending(self, thread_id):
+        claimed, self.forwarded = self.forwarded, []
+        return claimed
+
+    def requeue(self, thread_id, message_ids):
+        self.requeued.append(list(message_ids))
+
+    def publish_result(self, thread_id, message_id, response):
+        self.published[message_id] = response
+
+    def release(self, thread_id):
+        self.released.append(thread_id)
+
+def test_queued_messages_supersede_and_coalesce():
+    async def scenario():
+        scheduler, runs = ThreadRunScheduler(), FakeRuns()
+        first = asyncio.create_task(scheduler.submit(THREAD, "a", runs.run_batch))
+        await runs.wait_for_run(1)
+        second = asyncio.create_task(scheduler.submit(THREAD, "b", runs.run_batch))
+        third = asyncio.create_task(scheduler.submit(THREAD, "c", runs.run_batch))
+        # The first run is cancelled once b is queued; the follow-up run answers everything at once
+        await runs.wait_for_run(2)
+        await asyncio.sleep(0.01)
+        runs.finish(len(runs.batches) - 1)
+        return scheduler, runs, await asyncio.gather(first, second, third)
+
+    scheduler, runs, (a, b, c) = asyncio.run(scenario())
+    assert runs.batches[0] == ["a"]
+    assert runs.batches[-1] == ["b", "c"]
+    assert a == b == COALESCED_RESPONSE
+    assert c["text"] == ["reply to c"]
+    assert scheduler.stats["superseded"] >= 1
+    assert scheduler.stats["coalesced"] == 2
+    assert not scheduler._states
+
+def test_driver_returns_once_its_message_is_answered():
+    async def scenario():
+        scheduler, runs = ThreadRunScheduler(), FakeRuns(honour_cancel=False)
+        first = asyncio.create_task(scheduler.submit(THREAD, "a", runs.run_batch))
+        await runs.wait_for_run(1)
+        second = asyncio.create_task(scheduler.submit(THREAD, "b", runs.run_batch))
+        await asyncio.sleep(0.01)
+        runs.finish(0)
+        a = await asyncio.wait_for(first, timeout=1)
+        # b's run is driven by b's caller and is still going when a's caller gets its reply
+        await runs.wait_for_run(2)
+        assert not second.done()
+        runs.finish(1)
+        return a, await second
+
+    a, b = asyncio.run(scenario())
+    assert a["text"] == ["reply to a"]
+    assert b["text"] == ["reply to b"]
+
+def test_failed_run_fails_every_message_in_it():
+    async def failing(thread_id, queries, should_cancel):
+        raise RuntimeError("upstream down")
+
+    async def scenario():
+        return await ThreadRunScheduler().submit(THREAD, "a", failing)
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(scenario())
+
+def test_lost_lease_cancels_the_run_and_reruns_after_winning_it_back(monkeypatch):
+    monkeypatch.setattr(run_scheduler, "REMOTE_POLL_SECONDS", 0.001)
+
+    async def scenario():
+        leases, runs = FakeLeases(), FakeRuns()
+        scheduler = ThreadRunScheduler(leases=leases)
+        task = asyncio.create_task(scheduler.submit(THREAD, "a", runs.run_batch))
+        await runs.wait_for_run(1)
+        leases.on_lost()
+        await runs.wait_for_run(2)
+        runs.finish(1)
+        return scheduler, leases, runs, await task
+
+    scheduler, leases, runs, reply = asyncio.run(scenario())
+    assert reply["text"] == ["reply to a"]
+    # The message is already on the thread, so the second run adds nothing new
+    assert runs.batches == [["a"], []]
+    assert scheduler.stats["leases_lost"] == 1
+    assert leases.acquired == [THREAD, THREAD]
+    assert leases.released == [THREAD]
+
+def test_lost_lease_requeues_claimed_forwarded_messages(monkeypatch):
+    monkeypatch.setattr(run_scheduler, "REMOTE_POLL_SECONDS", 0.001)
+
+    async def scenario():
+        leases, runs = FakeLeases(forwarded=[("m1", "remote")]), FakeRuns()
+        scheduler = ThreadRunScheduler(leases=leases)
+        task = asyncio.create_task(scheduler.submit(THREAD, "a", runs.run_batch))
+        await runs.wait_for_run(1)
+        leases.on_lost()
+        await runs.wait_for_run(2)
+        runs.finish(1)
+        return leases, runs, await task
+
+    leases, runs, reply = asyncio.run(scenario())
+    assert runs.batches[0] == ["remote", "a"]
+    # The new lease holder answers m1; we only answer our own message
+    assert leases.requeued == [["m1"]]
+    assert "m1" not in leases.published
+    assert reply["text"] == ["reply to a"]
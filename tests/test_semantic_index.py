@@ -0,0 +1,77 @@
+import asyncio
+import threading
+
+import semantic_index as si
+from semantic_index import HashingEmbeddingBackend, SemanticIndex, jira_documents, jira_row_documents
+
+USER = "U1"
+
+def _issue(key, summary, description):
+    return {"key": key, "fields": {"summary": summary, "description": description, "status": {"name": "To Do"}}}
+
+def _rows(*rows, columns=("key", "summary", "status")):
+    return {"columns": list(columns), "rows": [list(row) for row in rows]}
+
+def _index(tmp_path, monkeypatch, interval=0):
+    monkeypatch.setattr(si, "SEMANTIC_PERSIST_INTERVAL_SECONDS", interval)
+    return SemanticIndex(str(tmp_path), HashingEmbeddingBackend())
+
+def test_issue_and_search_row_build_the_same_text():
+    issue = jira_documents([_issue("PROJ-1", "Login fails", None)])[0]
+    row = jira_row_documents(_rows(("PROJ-1", "Login fails", "To Do")))[0]
+    assert issue["text"] == row["text"]
+
+def test_search_row_does_not_replace_the_full_issue(tmp_path, monkeypatch):
+    index = _index(tmp_path, monkeypatch)
+    long_description = "Steps to reproduce the crash on the login page. " * 10
+    assert index.upsert(jira_documents([_issue("PROJ-1", "Login fails", long_description)]), USER) == 1
+    row = _rows(("PROJ-1", "Login fails", "In Progress", long_description[:200]), columns=("key", "summary", "status", "description"))
+
+    assert index.upsert(jira_row_documents(row), "U2") == 0
+    entry = index.rows[index.row_of["jira:PROJ-1"]]
+    assert entry["fidelity"] == si.FIDELITY_FULL
+    assert entry["users"] == {USER, "U2"}
+    assert entry["doc"]["status"] == "In Progress"
+    # The full issue still re-embeds over a row-only document
+    index.upsert(jira_row_documents(_rows(("PROJ-2", "Logout fails", "To Do"))), USER)
+    assert index.upsert(jira_documents([_issue("PROJ-2", "Logout fails", "More detail")]), USER) == 1
+
+def test_search_is_limited_to_documents_the_user_fetched(tmp_path, monkeypatch):
+    index = _index(tmp_path, monkeypatch)
+    index.upsert(jira_documents([_issue("PROJ-1", "Login fails on mobile", "")]), USER)
+    index.upsert(jira_documents([_issue("PROJ-2", "Billing export is slow", "")]), "U2")
+    query = index.backend.embed(["login fails"])[0]
+    assert [entry["id"] for _, entry in index.search(query, USER)] == ["jira:PROJ-1"]
+    assert [entry["id"] for _, entry in index.search(query, "U2")] == ["jira:PROJ-2"]
+
+def test_writes_within_the_interval_are_persisted_once_flushed(tmp_path, monkeypatch):
+    index = _index(tmp_path, monkeypatch, interval=60)
+    index.upsert(jira_documents([_issue("PROJ-1", "First", "")]), USER)
+    index.upsert(jira_documents([_issue("PROJ-2", "Second", "")]), USER)
+    index.upsert(jira_documents([_issue("PROJ-3", "Third", "")]), USER)
+    assert index.stats["persists"] == 1
+    index.flush()
+    assert index.stats["persists"] == 2
+
+    reloaded = SemanticIndex(str(tmp_path), HashingEmbeddingBackend())
+    assert set(reloaded.row_of) == {"jira:PROJ-1", "jira:PROJ-2", "jira:PROJ-3"}
+    assert reloaded.rows[reloaded.row_of["jira:PROJ-2"]]["users"] == {USER}
+
+def test_semantic_search_writes_through_the_sync_worker(tmp_path, monkeypatch):
+    index = _index(tmp_path, monkeypatch)
+    monkeypatch.setattr(si, "semantic_index", index)
+    writers = []
+    original_upsert = index.upsert
+
+    def upsert(documents, user_id):
+        writers.append(threading.current_thread().name)
+        return original_upsert(documents, user_id)
+
+    async def search_jira_issues(token, jql, fields, max_results):
+        return _rows(("PROJ-1", "Login fails", "To Do"))
+
+    monkeypatch.setattr(index, "upsert", upsert)
+    monkeypatch.setattr(si, "search_jira_issues", search_jira_issues)
+    result = asyncio.run(si.semantic_search(USER, "login", jql="project = PROJ", jira_token="token"))
+    assert [hit["key"] for hit in result["results"]] == ["PROJ-1"]
+    assert writers and all(name.startswith("semantic-index") for name in writers)
@@ -0,0 +1,25 @@
+from task_dispatch import TaskDispatch
+
+def test_delivery_racing_an_unfinished_one_succeeds_without_rerunning():
+    calls = []
+    dispatch = TaskDispatch(calls.append, mode="thread")
+    assert dispatch.deduplicator.claim("task-1") == "claimed"
+
+    assert dispatch.run({"task_id": "task-1"}) == 200
+    assert calls == []
+    assert dispatch.stats["in_progress"] == 1
+
+def test_finished_task_is_not_rerun_and_failed_task_is_retried():
+    calls = []
+
+    def handler(payload):
+        calls.append(payload["task_id"])
+        if payload.get("fail"):
+            raise RuntimeError("boom")
+
+    dispatch = TaskDispatch(handler, mode="thread")
+    assert dispatch.run({"task_id": "ok"}) == 200
+    assert dispatch.run({"task_id": "ok"}) == 200
+    assert dispatch.run({"task_id": "bad", "fail": True}) == 500
+    assert dispatch.run({"task_id": "bad"}) == 200
+    assert calls == ["ok", "bad", "bad"]
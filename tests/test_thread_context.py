@@ -0,0 +1,59 @@
+import asyncio
+from types import SimpleNamespace
+
+import thread_context
+from thread_context import ThreadContextManager
+
+def _message(number):
+    role = "user" if number % 2 else "assistant"
+    text = SimpleNamespace(type="text", text=SimpleNamespace(value=f"message {number}"))
+    return SimpleNamespace(id=f"msg_{number}", role=role, content=[text])
+
+class FakeMessages:
+    def __init__(self, count):
+        # Newest first, as order="desc" returns them
+        self.messages = [_message(number) for number in range(count, 0, -1)]
+        self.calls = []
+
+    async def list(self, thread_id, order, limit, after=None):
+        self.calls.append(after)
+        start = 0 if after is None else [message.id for message in self.messages].index(after) + 1
+        data = self.messages[start:start + limit]
+        return SimpleNamespace(data=data, has_more=start + limit < len(self.messages))
+
+class FakeClient:
+    def __init__(self, count):
+        self.seed = None
+        self.transcript = None
+        messages = FakeMessages(count)
+
+        async def create_thread(messages):
+            self.seed = messages
+            return SimpleNamespace(id="thread_new")
+
+        async def create_completion(model, messages, **kwargs):
+            self.transcript = messages[-1]["content"]
+            usage = SimpleNamespace(prompt_tokens=1, completion_tokens=1, total_tokens=2)
+            return SimpleNamespace(usage=usage, choices=[SimpleNamespace(message=SimpleNamespace(content="summary"))])
+
+        self.beta = SimpleNamespace(threads=SimpleNamespace(messages=messages, create=create_thread))
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=create_completion))
+
+def test_rollover_reads_every_page_of_the_thread(monkeypatch):
+    monkeypatch.setattr(thread_context, "MESSAGES_PAGE_SIZE", 10)
+    client = FakeClient(25)
+    manager = ThreadContextManager(client)
+
+    assert asyncio.run(manager.rollover("thread_old")) == "thread_new"
+    assert client.beta.threads.messages.calls == [None, "msg_16", "msg_6"]
+    # The oldest message reaches the summary and the newest ones are carried over verbatim, in order
+    assert client.transcript.startswith("User: message 1\n")
+    kept = thread_context.ROLLOVER_KEEP_MESSAGES
+    assert [message["content"] for message in client.seed[1:]] == [f"message {n}" for n in range(26 - kept, 26)]
+
+def test_summary_transcript_keeps_only_the_most_recent_text(monkeypatch):
+    monkeypatch.setattr(thread_context, "SUMMARY_TRANSCRIPT_MAX_CHARS", 50)
+    client = FakeClient(30)
+    asyncio.run(ThreadContextManager(client).rollover("thread_old"))
+    assert len(client.transcript) == 50
+    assert client.transcript.endswith(f"message {30 - thread_context.ROLLOVER_KEEP_MESSAGES}")
@@ -0,0 +1,71 @@
+import asyncio
+import time
+
+import pytest
+
+from upstream_governor import CircuitOpenError, UpstreamGovernor
+
+HOST = "upstream.test"
+LIMITS = {HOST: {"rate": 1000.0, "burst": 1000, "concurrency": 4}}
+
+def _half_open_governor():
+    upstream = UpstreamGovernor(LIMITS)
+    breaker = upstream.host(HOST).breaker
+    breaker.failures = breaker.failure_threshold
+    breaker.opened_at = time.monotonic() - breaker.reset_seconds
+    assert breaker.state == "half_open"
+    return upstream, breaker
+
+def test_cancelled_async_probe_reopens_breaker():
+    upstream, breaker = _half_open_governor()
+
+    async def hang():
+        await asyncio.sleep(60)
+
+    async def probe():
+        await asyncio.wait_for(upstream.call_async(HOST, hang), timeout=0.05)
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(probe())
+
+    assert not breaker.trial_in_flight
+    assert breaker.state == "open"
+    assert upstream.host(HOST).slots.in_use == 0
+
+    # Once the reset period passes again, a new probe is let through and can close the breaker
+    breaker.opened_at = time.monotonic() - breaker.reset_seconds
+
+    async def ok():
+        return "ok"
+
+    assert asyncio.run(upstream.call_async(HOST, ok)) == "ok"
+    assert breaker.state == "closed"
+
+def test_interrupted_sync_probe_reopens_breaker():
+    upstream, breaker = _half_open_governor()
+
+    def interrupted():
+        raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        upstream.call(HOST, interrupted)
+
+    assert not breaker.trial_in_flight
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpenError):
+        upstream.call(HOST, lambda: "ok")
+
+def test_cancelled_call_on_closed_breaker_is_not_a_failure():
+    upstream = UpstreamGovernor(LIMITS)
+    breaker = upstream.host(HOST).breaker
+
+    async def hang():
+        await asyncio.sleep(60)
+
+    async def cancelled():
+        await asyncio.wait_for(upstream.call_async(HOST, hang), timeout=0.05)
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(cancelled())
+    assert breaker.failures == 0
+    assert breaker.state == "closed"
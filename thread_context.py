@@ -0,0 +1,154 @@
+import os
+import threading
+import time
+from upstream_governor import call_openai
+from usage_accounting import usage_ledger
+from logger_config import setup_logger
+
+logger = setup_logger()
+
+# Estimated thread size (tokens) above which runs only read the most recent messages
+THREAD_TRUNCATE_TOKENS = int(os.environ.get("THREAD_TRUNCATE_TOKENS", 40000))
+# Estimated thread size above which the conversation moves to a fresh, summarized thread
+THREAD_ROLLOVER_TOKENS = int(os.environ.get("THREAD_ROLLOVER_TOKENS", 80000))
+# Truncated runs lose older context silently; after this many the thread is summarized instead
+THREAD_ROLLOVER_AFTER_TRUNCATED_RUNS = int(os.environ.get("THREAD_ROLLOVER_AFTER_TRUNCATED_RUNS", 5))
+TRUNCATION_LAST_MESSAGES = int(os.environ.get("THREAD_TRUNCATION_LAST_MESSAGES", 20))
+# Most recent messages carried verbatim into the new thread; everything older is summarized
+ROLLOVER_KEEP_MESSAGES = int(os.environ.get("THREAD_ROLLOVER_KEEP_MESSAGES", 6))
+# A failed rollover is retried after this long, doubling with each consecutive failure
+ROLLOVER_RETRY_SECONDS = float(os.environ.get("THREAD_ROLLOVER_RETRY_SECONDS", 300))
+ROLLOVER_RETRY_MAX_SECONDS = 6 * 3600
+SUMMARY_MODEL = os.environ.get("THREAD_SUMMARY_MODEL", "gpt-4o-mini")
+SUMMARY_TRANSCRIPT_MAX_CHARS = 60000
+MESSAGES_PAGE_SIZE = 100
+
+SUMMARY_PROMPT = ("Summarize this conversation between a user and an assistant that works with Jira and Miro. "
+                  "Keep issue keys, board IDs, decisions, open questions and anything the user asked to remember. "
+                  "Be concise; the summary replaces the transcript.")
+
+class _ThreadUsage:
+    def __init__(self):
+        self.estimated_tokens = 0
+        self.truncated_runs = 0
+        self.rollover_failures = 0
+        self.retry_rollover_at = 0.0
+
+class ThreadContextManager:
+    """
+    Keeps conversation threads bounded. Thread size is estimated from each run's usage; past
+    THREAD_TRUNCATE_TOKENS runs get a last_messages truncation strategy, and past
+    THREAD_ROLLOVER_TOKENS (or after several truncated runs) the older turns are summarized into
+    the seed of a fresh thread.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self._lock = threading.Lock()
+        self._threads = {}
+        self.stats = {"truncated_runs": 0, "rollovers": 0, "rollover_failures": 0}
+
+    def record_usage(self, thread_id, usage, model_steps=1):
+        """
+        Updates the size estimate from a finished run. A run's prompt_tokens add up every model step
+        (one per tool round trip), so the per-step average approximates what the thread holds.
+        """
+        if not usage:
+            return
+        prompt_tokens = getattr(usage, 'prompt_tokens', 0) or 0
+        completion_tokens = getattr(usage, 'completion_tokens', 0) or 0
+        with self._lock:
+            entry = self._threads.setdefault(thread_id, _ThreadUsage())
+            entry.estimated_tokens = prompt_tokens // max(model_steps, 1) + completion_tokens
+        logger.debug(f"Thread {thread_id} is now ~{entry.estimated_tokens} tokens.")
+
+    def run_options(self, thread_id):
+        """
+        Extra arguments for runs.create on this thread.
+        """
+        with self._lock:
+            entry = self._threads.get(thread_id)
+            if not entry or entry.estimated_tokens < THREAD_TRUNCATE_TOKENS:
+                return {}
+            entry.truncated_runs += 1
+            self.stats["truncated_runs"] += 1
+        return {"truncation_strategy": {"type": "last_messages", "last_messages": TRUNCATION_LAST_MESSAGES}}
+
+    def needs_rollover(self, thread_id):
+        with self._lock:
+            entry = self._threads.get(thread_id)
+            if not entry or time.monotonic() < entry.retry_rollover_at:
+                return False
+            return entry.estimated_tokens >= THREAD_ROLLOVER_TOKENS or entry.truncated_runs >= THREAD_ROLLOVER_AFTER_TRUNCATED_RUNS
+
+    async def _summarize(self, messages):
+        transcript = "\n".join(f"{role.capitalize()}: {text}" for role, text in messages)
+        if len(transcript) > SUMMARY_TRANSCRIPT_MAX_CHARS:
+            # Keep the most recent part; the oldest turns matter least
+            transcript = transcript[-SUMMARY_TRANSCRIPT_MAX_CHARS:]
+        response = await call_openai(
+            self.client.chat.completions.create,
+            idempotent=True,
+            model=SUMMARY_MODEL,
+            messages=[
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {"role": "user", "content": transcript}
+            ]
+        )
+        usage_ledger.record(SUMMARY_MODEL, response.usage, tool="thread_summary")
+        return response.choices[0].message.content
+
+    async def _list_messages(self, thread_id):
+        """
+        Returns every text message of the thread, oldest first, as (role, text) pairs.
+        """
+        data, after = [], None
+        while True:
+            kwargs = {"after": after} if after else {}
+            page = await call_openai(self.client.beta.threads.messages.list, thread_id=thread_id, order="desc", limit=MESSAGES_PAGE_SIZE, **kwargs)
+            data.extend(page.data)
+            if not page.has_more or not page.data:
+                break
+            after = page.data[-1].id
+        messages = []
+        for message in reversed(data):
+            text = "\n".join(content.text.value for content in message.content if content.type == "text")
+            if text:
+                messages.append((message.role, text))
+        return messages
+
+    async def rollover(self, thread_id):
+        """
+        Creates a fresh thread seeded with a summary of the old thread's earlier turns plus its most
+        recent messages verbatim. Returns the new thread ID, or the old one if the rollover failed.
+        """
+        try:
+            messages = await self._list_messages(thread_id)
+            older, recent = messages[:-ROLLOVER_KEEP_MESSAGES], messages[-ROLLOVER_KEEP_MESSAGES:]
+            seed = []
+            if older:
+                summary = await self._summarize(older)
+                seed.append({"role": "user", "content": f"[Summary of the earlier conversation]\n{summary}"})
+            seed.extend({"role": role, "content": text} for role, text in recent)
+
+            new_thread = await call_openai(self.client.beta.threads.create, messages=seed)
+        except Exception as e:
+            with self._lock:
+                self.stats["rollover_failures"] += 1
+                # Back off so every run on an oversized thread does not pay for another summary attempt
+                entry = self._threads.setdefault(thread_id, _ThreadUsage())
+                entry.rollover_failures += 1
+                retry_in = min(ROLLOVER_RETRY_SECONDS * 2 ** (entry.rollover_failures - 1), ROLLOVER_RETRY_MAX_SECONDS)
+                entry.retry_rollover_at = time.monotonic() + retry_in
+            logger.error(f"Failed to roll over thread {thread_id}; keeping it and retrying in {retry_in:.0f}s: {e}")
+            return thread_id
+
+        with self._lock:
+            self._threads.pop(thread_id, None)
+            self.stats["rollovers"] += 1
+        logger.info(f"Rolled thread {thread_id} over to {new_thread.id} ({len(older)} messages summarized, {len(recent)} kept).")
+        return new_thread.id
+
+    def metrics(self):
+        with self._lock:
+            return {**self.stats, "tracked_threads": len(self._threads)}
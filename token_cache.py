@@ -0,0 +1,69 @@
+import os
+import threading
+import time
+from shared_resources import logger, db
+
+# How long a user's token document is served from memory. Misses are cached briefly only: a cached
+# document lacking a service the caller needs is re-read once that service's miss is older than
+# TOKEN_CACHE_MISS_TTL_SECONDS, so a user who just authenticated (possibly through another instance)
+# is picked up soon, without a user who only connected one service costing a read per lookup.
+TOKEN_CACHE_TTL_SECONDS = float(os.environ.get("TOKEN_CACHE_TTL_SECONDS", 300))
+TOKEN_CACHE_MISS_TTL_SECONDS = float(os.environ.get("TOKEN_CACHE_MISS_TTL_SECONDS", 15))
+
+_user_tokens = {}
+# (user_id, service) -> when the last read that found no token for the service stops counting
+_service_misses = {}
+_user_tokens_lock = threading.Lock()
+
+def _has_tokens(tokens, services):
+    return all((tokens.get(service) or {}).get('access_token') for service in services)
+
+def _known_missing(user_id, services, now):
+    return all(_service_misses.get((user_id, service), 0) > now for service in services)
+
+def _forget_misses(user_id):
+    for key in [key for key in _service_misses if key[0] == user_id]:
+        del _service_misses[key]
+
+def get_user_tokens(user_id, required_services=()):
+    """
+    Returns the user's token document (service -> {access_token, refresh_token}), reading Firestore
+    only when the cached copy is missing or stale, or lacks a token for one of required_services
+    that was not already found missing within TOKEN_CACHE_MISS_TTL_SECONDS.
+    Returns None if the read fails.
+    """
+    now = time.time()
+    with _user_tokens_lock:
+        cached = _user_tokens.get(user_id)
+        if cached and cached[0] > now:
+            missing = [service for service in required_services if not _has_tokens(cached[1], (service,))]
+            if _known_missing(user_id, missing, now):
+                return cached[1]
+
+    try:
+        user_doc = db.collection(u'users').document(user_id).get()
+    except Exception as e:
+        logger.error(f"Failed to retrieve tokens for user {user_id}: {str(e)}")
+        return None
+    tokens = user_doc.to_dict() if user_doc.exists else {}
+    ttl = TOKEN_CACHE_TTL_SECONDS if tokens else TOKEN_CACHE_MISS_TTL_SECONDS
+    with _user_tokens_lock:
+        _user_tokens[user_id] = (now + ttl, tokens)
+        for service in required_services:
+            if not _has_tokens(tokens, (service,)):
+                _service_misses[(user_id, service)] = now + TOKEN_CACHE_MISS_TTL_SECONDS
+    return tokens
+
+def update_cached_tokens(user_id, tokens):
+    """
+    Replaces the cached document after this instance wrote new tokens (e.g. in an OAuth callback),
+    dropping the user's cached misses.
+    """
+    with _user_tokens_lock:
+        _user_tokens[user_id] = (time.time() + TOKEN_CACHE_TTL_SECONDS, tokens)
+        _forget_misses(user_id)
+
+def invalidate_user_tokens(user_id):
+    with _user_tokens_lock:
+        _user_tokens.pop(user_id, None)
+        _forget_misses(user_id)
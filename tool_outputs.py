@@ -0,0 +1,192 @@
+import json
+import os
+from jira_board_info import format_jira_issue, format_linked_issues
+from logger_config import setup_logger
+from profiling import profiled
+
+logger = setup_logger()
+
+# Budget for a single tool output submitted to the assistant. Roughly 4 bytes per token.
+TOOL_OUTPUT_MAX_BYTES = int(os.environ.get("TOOL_OUTPUT_MAX_BYTES", 12000))
+BYTES_PER_TOKEN = 4
+# Room taken by the {"result": ..., "elided": {...}} wrapper around partial outputs, counts included
+ELISION_WRAPPER_BYTES = len(json.dumps({"result": None, "elided": {"strings_truncated": 10 ** 9, "items_dropped": 10 ** 9}})) - len("null")
+
+# Extra issue fields kept alongside format_jira_issue's summary/description/type/status
+ISSUE_EXTRA_FIELDS = {
+    "Assignee": ('assignee', 'displayName'),
+    "Reporter": ('reporter', 'displayName'),
+    "Priority": ('priority', 'name'),
+    "Parent": ('parent', 'key'),
+}
+
+def adf_to_text(node):
+    """
+    Flattens an Atlassian Document Format node (or a plain string) into plain text.
+    """
+    if node is None:
+        return ""
+    if isinstance(node, str):
+        return node
+    if isinstance(node, list):
+        return "".join(adf_to_text(child) for child in node)
+    if not isinstance(node, dict):
+        return str(node)
+
+    node_type = node.get('type')
+    if node_type == 'text':
+        return node.get('text', '')
+    if node_type == 'hardBreak':
+        return "\n"
+    if node_type in ('mention', 'emoji'):
+        return node.get('attrs', {}).get('text', '')
+    if node_type == 'inlineCard':
+        return node.get('attrs', {}).get('url', '')
+
+    text = adf_to_text(node.get('content', []))
+    if node_type == 'listItem':
+        return f"- {text.strip()}\n"
+    if node_type in ('paragraph', 'heading', 'codeBlock', 'blockquote', 'rule'):
+        return f"{text.strip()}\n"
+    if node_type == 'tableRow':
+        return " | ".join(adf_to_text(cell).strip() for cell in node.get('content', [])) + "\n"
+    return text
+
+def _project_issue(raw_issue):
+    if not raw_issue:
+        return raw_issue
+    fields = raw_issue.get('fields', {})
+    issue = {"Key": raw_issue.get('key')}
+    issue.update(format_jira_issue(raw_issue))
+    issue["Description"] = adf_to_text(fields.get('description')).strip() or 'No description provided'
+    for label, (field, attr) in ISSUE_EXTRA_FIELDS.items():
+        value = fields.get(field)
+        if isinstance(value, dict) and value.get(attr):
+            issue[label] = value[attr]
+    if fields.get('labels'):
+        issue["Labels"] = fields['labels']
+    return issue
+
+def _project_get_jiraissue(output):
+    if not isinstance(output, dict) or 'issue_details' not in output:
+        return output
+    return {"issue_details": _project_issue(output['issue_details'])}
+
+def _project_get_issues_for_epic(output):
+    if not isinstance(output, dict) or 'ChildIssues' not in output:
+        return output
+    formatted = format_linked_issues(output)
+    for issue in formatted["ChildIssues"]:
+        issue["Description"] = adf_to_text(issue.get("Description")).strip()
+    raw_children = {issue.get('key'): issue.get('fields', {}) for issue in output.get("ChildIssues") or []}
+    for issue in formatted["ChildIssues"]:
+        fields = raw_children.get(issue["Key"], {})
+        for label, (field, attr) in ISSUE_EXTRA_FIELDS.items():
+            value = fields.get(field)
+            if isinstance(value, dict) and value.get(attr):
+                issue[label] = value[attr]
+        if isinstance(fields.get('status'), dict):
+            issue["Status"] = fields['status'].get('name')
+    epic = formatted.get("EpicDetails") or {}
+    if epic.get("Description") is not None:
+        epic = dict(epic, Description=adf_to_text(epic["Description"]).strip())
+    formatted["EpicDetails"] = epic
+    return formatted
+
+def _project_create_new_jira_issue(output):
+    if isinstance(output, dict) and 'key' in output:
+        return {"id": output.get('id'), "key": output.get('key')}
+    return output
+
+# Per-tool output schemas. Tools without an entry are passed through and only budgeted.
+TOOL_PROJECTIONS = {
+    "get_jiraissue": _project_get_jiraissue,
+    "get_issues_for_epic": _project_get_issues_for_epic,
+    "create_new_jira_issue": _project_create_new_jira_issue,
+}
+
+def _size(value):
+    return len(json.dumps(value, default=str).encode('utf-8'))
+
+def _truncate_strings(value, max_chars, stats):
+    if isinstance(value, str):
+        if len(value) > max_chars:
+            stats["strings_truncated"] += 1
+            return value[:max_chars] + "…"
+        return value
+    if isinstance(value, dict):
+        return {key: _truncate_strings(item, max_chars, stats) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_truncate_strings(item, max_chars, stats) for item in value]
+    return value
+
+def _trim_lists(value, max_items, stats):
+    if isinstance(value, dict):
+        return {key: _trim_lists(item, max_items, stats) for key, item in value.items()}
+    if isinstance(value, list):
+        if len(value) > max_items:
+            stats["items_dropped"] += len(value) - max_items
+            value = value[:max_items]
+        return [_trim_lists(item, max_items, stats) for item in value]
+    return value
+
+def fit_to_budget(value, max_bytes=TOOL_OUTPUT_MAX_BYTES):
+    """
+    Shrinks a JSON-serializable value until it fits in max_bytes by first shortening long
+    strings and then dropping the tail of long lists.
+
+    Returns:
+        tuple: The fitted value and a dict counting truncated strings and dropped list items.
+    """
+    stats = {"strings_truncated": 0, "items_dropped": 0}
+    max_chars = 2000
+    while _size(value) > max_bytes and max_chars >= 100:
+        value = _truncate_strings(value, max_chars, stats)
+        max_chars //= 2
+    max_items = 200
+    while _size(value) > max_bytes and max_items >= 1:
+        value = _trim_lists(value, max_items, stats)
+        max_items //= 2
+    if _size(value) > max_bytes:
+        # Nothing structural left to trim (e.g. one huge string); cut the serialized form
+        serialized = json.dumps(value, default=str)
+        value = serialized[:max_bytes // 2] + "…"
+        stats["strings_truncated"] += 1
+    return value, stats
+
+@profiled("project_tool_output")
+def project_tool_output(function_name, output, max_bytes=TOOL_OUTPUT_MAX_BYTES, projection=None):
+    """
+    Applies the tool's output schema (projection, or its TOOL_PROJECTIONS entry) and the size
+    budget, and serializes the result for submit_tool_outputs.
+
+    Returns:
+        tuple: The JSON string to submit and a report of original and projected sizes.
+    """
+    original_bytes = _size(output)
+    projection = projection or TOOL_PROJECTIONS.get(function_name)
+    projected = output
+    if projection:
+        try:
+            projected = projection(output)
+        except Exception as e:
+            logger.error(f"Failed to project output of {function_name}, submitting it unprojected: {e}")
+    fitted, stats = fit_to_budget(projected, max_bytes)
+    if stats["strings_truncated"] or stats["items_dropped"]:
+        # Partial outputs get wrapped below; fit them again leaving room for the wrapper
+        fitted, stats = fit_to_budget(projected, max_bytes - ELISION_WRAPPER_BYTES)
+    projected = fitted
+    projected_bytes = _size(projected)
+
+    report = {
+        "original_bytes": original_bytes,
+        "projected_bytes": projected_bytes,
+        "elided_bytes": max(original_bytes - projected_bytes, 0),
+        "approx_tokens_saved": max(original_bytes - projected_bytes, 0) // BYTES_PER_TOKEN,
+        **stats
+    }
+    if stats["strings_truncated"] or stats["items_dropped"]:
+        # Tell the model the data is partial so it can ask for a narrower query
+        projected = {"result": projected, "elided": stats}
+    logger.debug(f"Projected {function_name} output from {original_bytes} to {projected_bytes} bytes.")
+    return json.dumps(projected, default=str), report
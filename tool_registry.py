@@ -0,0 +1,367 @@
+import asyncio
+import concurrent.futures
+import contextvars
+import os
+import threading
+import time
+from collections import defaultdict
+from shared_resources import slack_app, logger
+from token_cache import get_user_tokens
+from metrics import register_metrics
+from upstream_governor import FairSlots, POLL_SECONDS
+from usage_accounting import current_tool
+from tool_outputs import TOOL_PROJECTIONS, TOOL_OUTPUT_MAX_BYTES, project_tool_output
+from miro_data_assistant import analyze_miro_board_data
+from miro_board_index import get_miro_frame_content, get_board_index
+from semantic_index import semantic_search, index_tool_output, index_board_in_background
+from jira_board_info import retrieve_jira_issue, update_issue_summary_and_description, get_issues_for_epic, create_new_jira_issue, search_jira_issues
+from profiling import profiled
+
+SERVICE_NAMES = {"miro": "Miro", "jira": "Jira"}
+# Threads for blocking tool handlers, kept apart from the default executor so calls that outlive
+# their timeout cannot starve other to_thread work (credentials, leases)
+TOOL_WORKER_THREADS = int(os.environ.get("TOOL_WORKER_THREADS", 32))
+
+# JSON Schema types accepted for each declared argument type
+_ARGUMENT_TYPES = {
+    "string": str,
+    "integer": int,
+    "number": (int, float),
+    "boolean": bool,
+    "array": list,
+    "object": dict,
+}
+
+class ToolContext:
+    """
+    What a tool handler gets besides its arguments: the calling user and the access tokens of
+    the services the tool declared.
+    """
+
+    def __init__(self, user_id, tokens):
+        self.user_id = user_id
+        self.tokens = tokens
+
+class Tool:
+    """
+    A function the assistant can call.
+
+    Args:
+        name (str): The function name the assistant uses.
+        handler (callable): handler(context, **arguments); coroutine functions are awaited,
+            plain functions run in a worker thread.
+        parameters (dict): JSON Schema of the arguments, as declared to the assistant.
+        services (tuple or callable): Services whose tokens are required, or a function of the
+            arguments returning them.
+        timeout (float): Seconds before the call is abandoned and reported to the model as timed out.
+            A blocking handler keeps running (and holding its slot) until its own request timeouts end it.
+        concurrency (int): Calls of this tool allowed in flight across the process.
+        projection (callable): Output schema applied before the size budget (see tool_outputs).
+    """
+
+    def __init__(self, name, handler, parameters, services=(), timeout=30, concurrency=4, projection=None, max_output_bytes=TOOL_OUTPUT_MAX_BYTES):
+        self.name = name
+        self.handler = handler
+        self.parameters = parameters
+        self.services = services
+        self.timeout = timeout
+        self.projection = projection
+        self.max_output_bytes = max_output_bytes
+        self.is_async = asyncio.iscoroutinefunction(handler)
+        self.slots = FairSlots(concurrency)
+
+    def required_services(self, arguments):
+        return self.services(arguments) if callable(self.services) else self.services
+
+    def validate(self, arguments):
+        """
+        Returns the declared arguments and a list of problems with them; the list is empty if they
+        match the schema. Undeclared arguments are dropped rather than rejected.
+        """
+        if not isinstance(arguments, dict):
+            return {}, ["arguments must be a JSON object"]
+        properties = self.parameters.get("properties", {})
+        ignored = [name for name in arguments if name not in properties]
+        if ignored:
+            logger.debug(f"Ignoring undeclared arguments for {self.name}: {ignored}")
+        arguments = {name: value for name, value in arguments.items() if name in properties}
+        problems = [f"missing required argument '{name}'" for name in self.parameters.get("required", []) if arguments.get(name) is None]
+        for name, value in arguments.items():
+            expected = _ARGUMENT_TYPES.get(properties[name].get("type"))
+            if value is not None and expected and (not isinstance(value, expected) or (expected is int and isinstance(value, bool))):
+                problems.append(f"argument '{name}' must be of type {properties[name]['type']}")
+        return arguments, problems
+
+    def definition(self):
+        """
+        The OpenAI function tool definition, for keeping the assistant's configuration in sync.
+        """
+        return {"type": "function", "function": {"name": self.name, "parameters": self.parameters}}
+
+class ToolRegistry:
+    """
+    Declared tools plus the dispatcher the run loop calls for each tool call: it validates the
+    arguments, fetches only the credentials the tool needs, waits for one of the tool's
+    concurrency slots, enforces its timeout and records per-tool latency and error counts.
+    """
+
+    def __init__(self):
+        self.tools = {}
+        self._lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=TOOL_WORKER_THREADS, thread_name_prefix="tool")
+        self.stats = defaultdict(lambda: {"calls": 0, "errors": 0, "timeouts": 0, "invalid": 0, "timed_calls": 0, "total_ms": 0.0, "max_ms": 0.0})
+
+    def register(self, tool):
+        self.tools[tool.name] = tool
+        return tool
+
+    def _record(self, name, outcome, elapsed_ms=None):
+        with self._lock:
+            stats = self.stats[name]
+            stats["calls"] += 1
+            if outcome != "ok":
+                stats[outcome] += 1
+            if elapsed_ms is not None:
+                stats["timed_calls"] += 1
+                stats["total_ms"] += elapsed_ms
+                stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+
+    def _credentials(self, tool, arguments, user_id):
+        """
+        Returns the tokens for the tool's services, or the name of the first service the user has not authenticated with.
+        """
+        services = tool.required_services(arguments)
+        if not services:
+            return {}, None
+        user_tokens = get_user_tokens(user_id, required_services=services) or {}
+        tokens = {}
+        for service in services:
+            token = (user_tokens.get(service) or {}).get('access_token')
+            if not token:
+                return None, service
+            tokens[service] = token
+        return tokens, None
+
+    async def _acquire_slot(self, tool, user_id):
+        tool.slots.wait(user_id, 1)
+        try:
+            while not tool.slots.try_acquire(user_id):
+                await asyncio.sleep(POLL_SECONDS)
+        finally:
+            tool.slots.wait(user_id, -1)
+
+    @profiled("tool_dispatch")
+    async def dispatch(self, name, arguments, user_id):
+        """
+        Runs a tool call and returns its raw output; failures are returned as error dicts for the model.
+        """
+        tool = self.tools.get(name)
+        if tool is None:
+            self._record(name, "invalid")
+            return {"status": "error", "message": "Function not recognized"}
+
+        arguments, problems = tool.validate(arguments)
+        if problems:
+            self._record(name, "invalid")
+            return {"status": "error", "message": f"Invalid arguments for {name}: {'; '.join(problems)}."}
+
+        tokens, missing_service = await asyncio.to_thread(self._credentials, tool, arguments, user_id)
+        if missing_service:
+            service_name = SERVICE_NAMES.get(missing_service, missing_service)
+            logger.info(f"No {service_name} access token found. Prompting user to authenticate with {service_name}.")
+            slack_app.client.chat_postMessage(
+                channel=user_id,
+                text=f"Please authenticate with {service_name} to continue. Click on the button in the Home tab."
+            )
+            self._record(name, "invalid")
+            return {"status": "error", "message": f"{service_name} authentication required."}
+
+        context = ToolContext(user_id, tokens)
+        await self._acquire_slot(tool, user_id)
+        started = time.perf_counter()
+        # Model calls made by the tool (e.g. board analysis, embeddings) are charged to it
+        tool_token = current_tool.set(name)
+        release_slot = True
+        try:
+            if tool.is_async:
+                call = tool.handler(context, **arguments)
+            else:
+                # A timed-out blocking call keeps its worker thread until it returns; the run moves on,
+                # but the slot is only freed when the thread does, so the concurrency cap still holds
+                worker = self._executor.submit(contextvars.copy_context().run, tool.handler, context, **arguments)
+                release_slot = False
+                worker.add_done_callback(lambda _: tool.slots.release(user_id))
+                call = asyncio.wrap_future(worker)
+            output = await asyncio.wait_for(call, tool.timeout)
+            outcome = "ok"
+        except asyncio.TimeoutError:
+            logger.error(f"Tool {name} timed out after {tool.timeout}s.")
+            output = {"status": "error", "message": f"{name} timed out after {tool.timeout} seconds."}
+            outcome = "timeouts"
+        except Exception as e:
+            # Report the failure to the model instead of abandoning the run
+            logger.error(f"Tool {name} failed: {e}")
+            output = {"status": "error", "message": str(e)}
+            outcome = "errors"
+        finally:
+            current_tool.reset(tool_token)
+            if release_slot:
+                tool.slots.release(user_id)
+        self._record(name, outcome, (time.perf_counter() - started) * 1000)
+        return output
+
+    def project(self, name, output):
+        """
+        Serializes a tool output for submit_tool_outputs using the tool's projection and size budget.
+        """
+        tool = self.tools.get(name)
+        if tool is None:
+            return project_tool_output(name, output)
+        return project_tool_output(name, output, tool.max_output_bytes, projection=tool.projection)
+
+    def definitions(self):
+        return [tool.definition() for tool in self.tools.values()]
+
+    def metrics(self):
+        with self._lock:
+            snapshot = {name: dict(stats) for name, stats in self.stats.items()}
+        for name, stats in snapshot.items():
+            timed, total_ms = stats.pop("timed_calls"), stats.pop("total_ms")
+            stats["avg_ms"] = round(total_ms / timed, 1) if timed else 0.0
+            stats["max_ms"] = round(stats["max_ms"], 1)
+            tool = self.tools.get(name)
+            if tool:
+                stats["in_flight"] = tool.slots.in_use
+        return snapshot
+
+async def _get_miro_board_content(context, board_id):
+    return await analyze_miro_board_data(board_id, context.tokens['miro'])
+
+async def _get_miro_frame_content(context, board_id, frame_title=None, area=None, item_types=None):
+    frame_content = await get_miro_frame_content(board_id, context.tokens['miro'], frame_title=frame_title, area=area, item_types=item_types)
+    # The board index was just built (or cached); bring the whole board into the semantic index
+    board_index, _ = await get_board_index(board_id, context.tokens['miro'])
+    if board_index:
+        index_board_in_background(board_id, board_index.by_id.values(), context.user_id)
+    return frame_content
+
+def _get_jiraissue(context, issue_id):
+    output = retrieve_jira_issue(issue_id, context.tokens['jira'])
+    index_tool_output('get_jiraissue', output, context.user_id)
+    return output
+
+def _update_jiraissue(context, issue_id, summary=None, description=None):
+    if summary is None and description is None:
+        return {"status": "error", "message": "Invalid arguments for update_jiraissue: provide 'summary', 'description' or both."}
+    return update_issue_summary_and_description(context.tokens['jira'], issue_id, summary, description)
+
+def _get_issues_for_epic(context, epic_id):
+    output = get_issues_for_epic(context.tokens['jira'], epic_id)
+    index_tool_output('get_issues_for_epic', output, context.user_id)
+    return output
+
+def _create_new_jira_issue(context, summary, description, project_id, issue_type_id):
+    return create_new_jira_issue(context.tokens['jira'], summary, description, project_id, issue_type_id)
+
+async def _search_jira_issues(context, jql, fields=None, max_results=200):
+    output = await search_jira_issues(context.tokens['jira'], jql, fields, max_results)
+    index_tool_output('search_jira_issues', output, context.user_id)
+    return output
+
+async def _semantic_search(context, query, source=None, board_id=None, jql=None, top_k=None):
+    return await semantic_search(
+        context.user_id, query, source=source, board_id=board_id, jql=jql, top_k=top_k,
+        miro_token=context.tokens.get('miro'), jira_token=context.tokens.get('jira')
+    )
+
+def _semantic_search_services(arguments):
+    services = []
+    if arguments.get("board_id"):
+        services.append("miro")
+    if arguments.get("jql"):
+        services.append("jira")
+    return services
+
+registry = ToolRegistry()
+register_metrics("tools", registry.metrics)
+
+registry.register(Tool(
+    "get_miro_board_content", _get_miro_board_content,
+    {"type": "object", "properties": {"board_id": {"type": "string"}}, "required": ["board_id"]},
+    services=("miro",), timeout=120, concurrency=4
+))
+registry.register(Tool(
+    "get_miro_frame_content", _get_miro_frame_content,
+    {
+        "type": "object",
+        "properties": {
+            "board_id": {"type": "string"},
+            "frame_title": {"type": "string"},
+            "area": {"type": "object"},
+            "item_types": {"type": "array", "items": {"type": "string"}}
+        },
+        "required": ["board_id"]
+    },
+    services=("miro",), timeout=60, concurrency=8
+))
+registry.register(Tool(
+    "get_jiraissue", _get_jiraissue,
+    {"type": "object", "properties": {"issue_id": {"type": "string"}}, "required": ["issue_id"]},
+    services=("jira",), timeout=20, concurrency=8, projection=TOOL_PROJECTIONS["get_jiraissue"]
+))
+registry.register(Tool(
+    "update_jiraissue", _update_jiraissue,
+    {
+        "type": "object",
+        "properties": {"issue_id": {"type": "string"}, "summary": {"type": "string"}, "description": {"type": "string"}},
+        "required": ["issue_id"]
+    },
+    services=("jira",), timeout=20, concurrency=4
+))
+registry.register(Tool(
+    "get_issues_for_epic", _get_issues_for_epic,
+    {"type": "object", "properties": {"epic_id": {"type": "string"}}, "required": ["epic_id"]},
+    services=("jira",), timeout=30, concurrency=4, projection=TOOL_PROJECTIONS["get_issues_for_epic"]
+))
+registry.register(Tool(
+    "create_new_jira_issue", _create_new_jira_issue,
+    {
+        "type": "object",
+        "properties": {
+            "summary": {"type": "string"},
+            "description": {"type": "string"},
+            "project_id": {"type": "string"},
+            "issue_type_id": {"type": "string"}
+        },
+        "required": ["summary", "description", "project_id", "issue_type_id"]
+    },
+    services=("jira",), timeout=20, concurrency=2, projection=TOOL_PROJECTIONS["create_new_jira_issue"]
+))
+registry.register(Tool(
+    "search_jira_issues", _search_jira_issues,
+    {
+        "type": "object",
+        "properties": {
+            "jql": {"type": "string"},
+            "fields": {"type": "array", "items": {"type": "string"}},
+            "max_results": {"type": "integer"}
+        },
+        "required": ["jql"]
+    },
+    services=("jira",), timeout=60, concurrency=4
+))
+registry.register(Tool(
+    "semantic_search", _semantic_search,
+    {
+        "type": "object",
+        "properties": {
+            "query": {"type": "string"},
+            "source": {"type": "string", "enum": ["jira", "miro"]},
+            "board_id": {"type": "string"},
+            "jql": {"type": "string"},
+            "top_k": {"type": "integer"}
+        },
+        "required": ["query"]
+    },
+    services=_semantic_search_services, timeout=120, concurrency=4
+))
@@ -0,0 +1,419 @@
+import asyncio
+import contextvars
+import email.utils
+import os
+import random
+import threading
+import time
+from collections import defaultdict
+from metrics import register_metrics
+from logger_config import setup_logger
+from profiling import profiled
+
+logger = setup_logger()
+
+JIRA_HOST = "api.atlassian.com"
+MIRO_HOST = "api.miro.com"
+OPENAI_HOST = "api.openai.com"
+
+# Requests per second, burst size and concurrent requests allowed per upstream host
+UPSTREAM_LIMITS = {
+    JIRA_HOST: {"rate": 10.0, "burst": 20, "concurrency": 8},
+    MIRO_HOST: {"rate": 8.0, "burst": 16, "concurrency": 6},
+    OPENAI_HOST: {"rate": 20.0, "burst": 40, "concurrency": 16},
+}
+DEFAULT_LIMITS = {"rate": 5.0, "burst": 10, "concurrency": 4}
+
+# Largest share of a host's request rate a single user may consume
+USER_RATE_SHARE = float(os.environ.get("UPSTREAM_USER_RATE_SHARE", 0.5))
+MAX_RETRIES = int(os.environ.get("UPSTREAM_MAX_RETRIES", 4))
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 30.0
+# Blocking calls hold a request worker while they back off; a longer Retry-After ends the retries instead
+SYNC_BACKOFF_MAX_SECONDS = float(os.environ.get("UPSTREAM_SYNC_BACKOFF_MAX_SECONDS", 5))
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get("UPSTREAM_BREAKER_FAILURES", 5))
+BREAKER_RESET_SECONDS = float(os.environ.get("UPSTREAM_BREAKER_RESET_SECONDS", 30))
+POLL_SECONDS = 0.02
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+# OpenAI client methods that only read (or, like cancel, are safe to repeat); anything else may create state
+IDEMPOTENT_OPENAI_METHODS = {"retrieve", "list", "content", "cancel"}
+
+# The Slack user on whose behalf upstream calls are made; set once per message and inherited by tasks
+upstream_user = contextvars.ContextVar("upstream_user", default=None)
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream whose circuit breaker is open."""
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Takes a token if one is available. Returns 0, or the seconds to wait before trying again.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+class FairSlots:
+    """
+    Concurrency limit that hands free slots to the waiting user with the fewest requests in flight,
+    so one user's burst cannot hold every slot while others wait.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_use = 0
+        self.in_flight = defaultdict(int)
+        self.waiting = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def try_acquire(self, user):
+        with self._lock:
+            if self.in_use >= self.limit:
+                return False
+            mine = self.in_flight.get(user, 0)
+            if any(count and self.in_flight.get(other, 0) < mine for other, count in self.waiting.items() if other != user):
+                return False
+            self.in_use += 1
+            self.in_flight[user] += 1
+            return True
+
+    def wait(self, user, delta):
+        with self._lock:
+            self.waiting[user] += delta
+            if not self.waiting[user]:
+                del self.waiting[user]
+
+    def release(self, user):
+        with self._lock:
+            self.in_use -= 1
+            self.in_flight[user] -= 1
+            if not self.in_flight[user]:
+                del self.in_flight[user]
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_seconds=BREAKER_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if time.monotonic() - self.opened_at >= self.reset_seconds else "open"
+
+    def allow(self):
+        """
+        Returns "closed" or "trial" if the call may go ahead (a trial is the single probe let through
+        a half-open breaker), else None.
+        """
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return "closed"
+            if state == "half_open" and not self.trial_in_flight:
+                # Let a single trial request through to probe whether the upstream recovered
+                self.trial_in_flight = True
+                return "trial"
+            return None
+
+    def abandon_trial(self):
+        """
+        Called when a probe ends without an outcome (e.g. it was cancelled). It counts as a failure,
+        so the breaker reopens and lets a new probe through after reset_seconds instead of waiting
+        forever on a trial that will never report back.
+        """
+        self.record_failure()
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.trial_in_flight = False
+            if self.failures >= self.failure_threshold or self.opened_at is not None:
+                self.opened_at = time.monotonic()
+
+class HostGovernor:
+    def __init__(self, host, rate, burst, concurrency):
+        self.host = host
+        self.rate = rate
+        self.bucket = TokenBucket(rate, burst)
+        self.slots = FairSlots(concurrency)
+        self.breaker = CircuitBreaker()
+        self.user_buckets = {}
+        self._lock = threading.Lock()
+        self.stats = defaultdict(int)
+
+    def _user_bucket(self, user):
+        with self._lock:
+            bucket = self.user_buckets.get(user)
+            if bucket is None:
+                bucket = self.user_buckets[user] = TokenBucket(max(self.rate * USER_RATE_SHARE, 0.1), max(int(self.bucket.burst * USER_RATE_SHARE), 1))
+            return bucket
+
+    def check_breaker(self):
+        """
+        Raises CircuitOpenError if the breaker rejects the call; returns True if the call is the half-open probe.
+        """
+        allowed = self.breaker.allow()
+        if not allowed:
+            with self._lock:
+                self.stats["rejected"] += 1
+            raise CircuitOpenError(f"Circuit open for {self.host}; not calling it for now.")
+        return allowed == "trial"
+
+    def reserve_tokens(self, user, holding):
+        """
+        Takes the user's and then the host's rate token. Returns 0 once both are held, otherwise the
+        seconds to wait; tokens already taken are kept in `holding` across attempts.
+        """
+        for name, bucket in (("user", self._user_bucket(user)), ("host", self.bucket)):
+            if name in holding:
+                continue
+            wait = bucket.reserve()
+            if wait:
+                return wait
+            holding.add(name)
+        return 0
+
+    def metrics(self):
+        return {
+            **self.stats,
+            "circuit": self.breaker.state,
+            "consecutive_failures": self.breaker.failures,
+            "in_flight": self.slots.in_use,
+            "in_flight_by_user": dict(self.slots.in_flight),
+            "waiting_by_user": dict(self.slots.waiting),
+            "tokens": round(self.bucket.tokens, 2),
+        }
+
+def _status_and_headers(outcome):
+    """
+    Pulls an HTTP status and headers off a requests/aiohttp response, or off an aiohttp/OpenAI exception.
+    """
+    status = getattr(outcome, 'status_code', None) or getattr(outcome, 'status', None)
+    headers = getattr(outcome, 'headers', None)
+    response = getattr(outcome, 'response', None)
+    if headers is None and response is not None:
+        headers = getattr(response, 'headers', None)
+    if status is None and response is not None:
+        status = getattr(response, 'status_code', None)
+    return (status if isinstance(status, int) else None), (headers or {})
+
+def _retry_after_seconds(headers):
+    value = headers.get('Retry-After') or headers.get('retry-after')
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+def _is_connection_error(exc):
+    name = type(exc).__name__
+    return isinstance(exc, (ConnectionError, TimeoutError, asyncio.TimeoutError)) or name in (
+        'ConnectionError', 'Timeout', 'ReadTimeout', 'ConnectTimeout',
+        'ClientConnectionError', 'ClientConnectorError', 'ServerDisconnectedError', 'ServerTimeoutError',
+        'APIConnectionError', 'APITimeoutError'
+    )
+
+class UpstreamGovernor:
+    """
+    Shared admission control for outbound HTTP: per-host token buckets and concurrency slots,
+    per-user rate shares and fair slot hand-out, circuit breakers, and retries with exponential
+    backoff and full jitter that honour Retry-After.
+    """
+
+    def __init__(self, limits=None):
+        self.limits = limits or UPSTREAM_LIMITS
+        self.hosts = {}
+        self._lock = threading.Lock()
+
+    def host(self, host):
+        with self._lock:
+            governor = self.hosts.get(host)
+            if governor is None:
+                governor = self.hosts[host] = HostGovernor(host, **self.limits.get(host, DEFAULT_LIMITS))
+            return governor
+
+    def _backoff(self, attempt, headers, max_delay):
+        """
+        Returns the jittered backoff, at least Retry-After; None if Retry-After asks for longer than max_delay.
+        """
+        delay = random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+        retry_after = _retry_after_seconds(headers)
+        if retry_after is not None and retry_after > max_delay:
+            return None
+        return min(max(delay, retry_after or 0), max_delay)
+
+    def _classify(self, governor, outcome, is_exception, idempotent):
+        """
+        Records the outcome on the breaker. Returns the response headers if the call should be retried, else None.
+
+        A 429 means the request was not processed, so it is always retried; server errors and
+        connection failures may have happened after the upstream acted on it, so they are only
+        retried for idempotent calls.
+        """
+        status, headers = _status_and_headers(outcome)
+        if status == 429:
+            # Throttling means the upstream is up; it counts against the rate, not the breaker
+            governor.breaker.record_success()
+            governor.stats["throttled"] += 1
+            return headers
+        if status in RETRYABLE_STATUSES or (is_exception and status is None and _is_connection_error(outcome)):
+            governor.breaker.record_failure()
+            governor.stats["failures"] += 1
+            if idempotent:
+                return headers
+            governor.stats["unsafe_not_retried"] += 1
+            return None
+        governor.breaker.record_success()
+        return None
+
+    def call(self, host, fn, idempotent=False):
+        """
+        Runs a blocking call (e.g. a requests call) under the host's limits, retrying throttled
+        calls, and transient failures of idempotent ones. Returns the last response once retries
+        are exhausted. Backoff is capped at SYNC_BACKOFF_MAX_SECONDS since it blocks the caller's thread.
+        """
+        governor = self.host(host)
+        user = upstream_user.get()
+        for attempt in range(MAX_RETRIES + 1):
+            is_trial = governor.check_breaker()
+            admission = self._admission(governor, user)
+            try:
+                for wait in admission:
+                    time.sleep(wait)
+                try:
+                    outcome, is_exception = fn(), False
+                except Exception as e:
+                    outcome, is_exception = e, True
+                finally:
+                    governor.slots.release(user)
+            except BaseException:
+                # Interrupted without an outcome; never leave the breaker waiting on this probe
+                admission.close()
+                if is_trial:
+                    governor.breaker.abandon_trial()
+                raise
+
+            delay = self._retry_delay(governor, host, attempt, outcome, is_exception, idempotent, SYNC_BACKOFF_MAX_SECONDS)
+            if delay is None:
+                if is_exception:
+                    raise outcome
+                return outcome
+            time.sleep(delay)
+
+    async def call_async(self, host, fn, idempotent=False):
+        """
+        Async counterpart of call; fn returns an awaitable (e.g. an OpenAI or aiohttp call).
+        """
+        governor = self.host(host)
+        user = upstream_user.get()
+        for attempt in range(MAX_RETRIES + 1):
+            is_trial = governor.check_breaker()
+            admission = self._admission(governor, user)
+            try:
+                for wait in admission:
+                    await asyncio.sleep(wait)
+                try:
+                    outcome, is_exception = await fn(), False
+                except Exception as e:
+                    outcome, is_exception = e, True
+                finally:
+                    governor.slots.release(user)
+            except BaseException:
+                # Cancelled (e.g. by a tool timeout) without an outcome; never leave the breaker waiting on this probe
+                admission.close()
+                if is_trial:
+                    governor.breaker.abandon_trial()
+                raise
+
+            delay = self._retry_delay(governor, host, attempt, outcome, is_exception, idempotent, BACKOFF_MAX_SECONDS * 4)
+            if delay is None:
+                if is_exception:
+                    raise outcome
+                return outcome
+            await asyncio.sleep(delay)
+
+    def _admission(self, governor, user):
+        """
+        Yields how long to wait until the caller holds a concurrency slot and its rate tokens.
+        The caller sleeps (blocking or async) between steps and must release the slot afterwards.
+        """
+        governor.slots.wait(user, 1)
+        try:
+            while not governor.slots.try_acquire(user):
+                yield POLL_SECONDS
+        finally:
+            governor.slots.wait(user, -1)
+        holding = set()
+        try:
+            while True:
+                wait = governor.reserve_tokens(user, holding)
+                if not wait:
+                    break
+                yield wait
+        except GeneratorExit:
+            # The caller was cancelled while waiting for rate tokens; give the slot back
+            governor.slots.release(user)
+            raise
+        governor.stats["requests"] += 1
+
+    def _retry_delay(self, governor, host, attempt, outcome, is_exception, idempotent, max_delay):
+        retry_headers = self._classify(governor, outcome, is_exception, idempotent)
+        if retry_headers is None or attempt == MAX_RETRIES:
+            return None
+        delay = self._backoff(attempt, retry_headers, max_delay)
+        if delay is None:
+            logger.warning(f"Upstream {host} asked to retry after more than {max_delay:.0f}s; giving up on the call.")
+            return None
+        governor.stats["retries"] += 1
+        logger.warning(f"Upstream {host} call failed (attempt {attempt + 1}); retrying in {delay:.2f}s.")
+        return delay
+
+    def metrics(self):
+        with self._lock:
+            hosts = dict(self.hosts)
+        return {host: governor.metrics() for host, governor in hosts.items()}
+
+# Process-wide governor shared by the Jira, Miro and OpenAI call paths
+upstream = UpstreamGovernor()
+register_metrics("upstream", upstream.metrics)
+
+@profiled("openai")
+async def call_openai(method, *args, idempotent=None, **kwargs):
+    """
+    Calls an AsyncOpenAI client method under the OpenAI host limits.
+
+    Reads (IDEMPOTENT_OPENAI_METHODS) are retried on transient failures; other methods only on
+    429, unless the caller passes idempotent=True for a call without side effects (e.g. a completion).
+    """
+    if idempotent is None:
+        idempotent = getattr(method, '__name__', None) in IDEMPOTENT_OPENAI_METHODS
+    return await upstream.call_async(OPENAI_HOST, lambda: method(*args, **kwargs), idempotent=idempotent)
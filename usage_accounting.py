@@ -0,0 +1,233 @@
+import contextvars
+import datetime
+import os
+import threading
+from collections import defaultdict
+from firebase_admin import firestore
+from metrics import register_metrics
+from upstream_governor import upstream_user
+from logger_config import setup_logger
+
+logger = setup_logger()
+
+USAGE_FIRESTORE_ENABLED = os.environ.get("USAGE_FIRESTORE_ENABLED", "true").lower() == "true"
+USAGE_FLUSH_SECONDS = float(os.environ.get("USAGE_FLUSH_SECONDS", 60))
+USAGE_COLLECTION = 'usage_daily'
+# Spend allowed per Slack user per UTC day, in USD; 0 disables budgets
+USER_DAILY_BUDGET_USD = float(os.environ.get("USER_DAILY_BUDGET_USD", 0))
+# Share of the budget after which requests move to the fallback model
+BUDGET_SOFT_LIMIT_RATIO = float(os.environ.get("BUDGET_SOFT_LIMIT_RATIO", 0.8))
+BUDGET_FALLBACK_MODEL = os.environ.get("BUDGET_FALLBACK_MODEL", "gpt-4o-mini")
+# Once the budget is spent, runs also only read this many recent thread messages
+BUDGET_TRUNCATION_LAST_MESSAGES = int(os.environ.get("BUDGET_TRUNCATION_LAST_MESSAGES", 6))
+METRICS_TOP_CONVERSATIONS = 20
+
+# USD per million input and output tokens; models are matched by longest prefix
+MODEL_PRICES = {
+    "gpt-4-turbo": (10.0, 30.0),
+    "gpt-4o-mini": (0.15, 0.6),
+    "gpt-4o": (2.5, 10.0),
+    "gpt-4": (30.0, 60.0),
+    "gpt-3.5-turbo": (0.5, 1.5),
+    "text-embedding-3-small": (0.02, 0.0),
+    "text-embedding-3-large": (0.13, 0.0),
+}
+# Unknown models are priced like the most expensive model in use, so budgets err on the safe side
+DEFAULT_PRICE = (10.0, 30.0)
+
+# The conversation and tool a request's model calls are charged to; set by the assistant pipeline and tool dispatch
+current_conversation = contextvars.ContextVar("usage_conversation", default=None)
+current_tool = contextvars.ContextVar("usage_tool", default=None)
+
+DIMENSIONS = ("user", "conversation", "tool", "model")
+
+def model_price(model):
+    matches = [prefix for prefix in MODEL_PRICES if (model or "").startswith(prefix)]
+    return MODEL_PRICES[max(matches, key=len)] if matches else DEFAULT_PRICE
+
+def usage_cost(model, prompt_tokens, completion_tokens):
+    input_price, output_price = model_price(model)
+    return (prompt_tokens * input_price + completion_tokens * output_price) / 1_000_000
+
+def _today():
+    return datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d")
+
+def _new_totals():
+    return {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "cost_usd": 0.0}
+
+class UsageLedger:
+    """
+    Aggregates model token usage and cost per day by user, conversation, tool and model.
+    Totals are kept in memory and the increments since the last flush are added to Firestore
+    (usage_daily/{day}/{dimension}/{key}) every USAGE_FLUSH_SECONDS.
+
+    Daily budgets are per instance plus whatever other instances had flushed when the user's
+    first request of the day reached this one, so they are approximate across instances.
+    """
+
+    def __init__(self, db=None):
+        self.db = db
+        self._lock = threading.Lock()
+        self.totals = defaultdict(_new_totals)
+        self.pending = defaultdict(_new_totals)
+        self.remote_baseline = {}
+        self.stats = {"degraded_requests": 0, "exhausted_requests": 0, "flushes": 0, "flush_failures": 0}
+        self._flusher = None
+        self._stop = threading.Event()
+
+    def record(self, model, usage, tool=None):
+        """
+        Charges a completion, run or embedding usage object to the current user, conversation and tool.
+        """
+        if not usage:
+            return
+        prompt_tokens = getattr(usage, 'prompt_tokens', 0) or 0
+        completion_tokens = getattr(usage, 'completion_tokens', 0) or 0
+        cost = usage_cost(model, prompt_tokens, completion_tokens)
+        day = _today()
+        keys = {
+            "user": upstream_user.get() or "unknown",
+            "conversation": current_conversation.get() or upstream_user.get() or "unknown",
+            "tool": tool or current_tool.get() or "assistant",
+            "model": model or "unknown",
+        }
+        with self._lock:
+            for dimension, key in keys.items():
+                for table in (self.totals, self.pending):
+                    entry = table[(day, dimension, key)]
+                    entry["calls"] += 1
+                    entry["prompt_tokens"] += prompt_tokens
+                    entry["completion_tokens"] += completion_tokens
+                    entry["cost_usd"] += cost
+        logger.debug(f"Usage: {keys['tool']} on {model} for {keys['user']}: {prompt_tokens}+{completion_tokens} tokens, ${cost:.4f}.")
+        self._ensure_flusher()
+
+    def _remote_spend(self, day, user_id):
+        key = (day, user_id)
+        if key in self.remote_baseline:
+            return self.remote_baseline[key]
+        spend = 0.0
+        if self.db and USAGE_FIRESTORE_ENABLED:
+            try:
+                doc = self.db.collection(USAGE_COLLECTION).document(day).collection("user").document(user_id).get()
+                spend = (doc.to_dict() or {}).get("cost_usd", 0.0) if doc.exists else 0.0
+            except Exception as e:
+                logger.warning(f"Failed to read today's usage for user {user_id}; budgeting on local usage only: {e}")
+        with self._lock:
+            # Only what was flushed before this instance spent anything for the user today is remote
+            local = self.totals.get((day, "user", user_id), {}).get("cost_usd", 0.0) - self.pending.get((day, "user", user_id), {}).get("cost_usd", 0.0)
+            self.remote_baseline[key] = max(spend - local, 0.0)
+            return self.remote_baseline[key]
+
+    def spent_today(self, user_id):
+        day = _today()
+        remote = self._remote_spend(day, user_id)
+        with self._lock:
+            return remote + self.totals.get((day, "user", user_id), {}).get("cost_usd", 0.0)
+
+    def budget_state(self, user_id):
+        """
+        Returns "ok", "degraded" (past the soft limit) or "exhausted" for the user's daily budget.
+        """
+        if USER_DAILY_BUDGET_USD <= 0 or not user_id:
+            return "ok"
+        spent = self.spent_today(user_id)
+        if spent >= USER_DAILY_BUDGET_USD:
+            state = "exhausted"
+        elif spent >= USER_DAILY_BUDGET_USD * BUDGET_SOFT_LIMIT_RATIO:
+            state = "degraded"
+        else:
+            return "ok"
+        with self._lock:
+            self.stats[f"{state}_requests"] += 1
+        logger.info(f"User {user_id} has spent ${spent:.2f} of ${USER_DAILY_BUDGET_USD:.2f} today; budget is {state}.")
+        return state
+
+    def apply_budget(self, user_id, model, run_options=None):
+        """
+        Degrades a request instead of refusing it: past the soft limit it moves to
+        BUDGET_FALLBACK_MODEL, and once the budget is spent runs also only see the most recent
+        messages of the thread.
+
+        Returns:
+            tuple: The model and run options to use.
+        """
+        run_options = dict(run_options or {})
+        state = self.budget_state(user_id)
+        if state == "ok":
+            return model, run_options
+        if state == "exhausted":
+            run_options["truncation_strategy"] = {"type": "last_messages", "last_messages": BUDGET_TRUNCATION_LAST_MESSAGES}
+        return BUDGET_FALLBACK_MODEL, run_options
+
+    def _ensure_flusher(self):
+        if self._flusher or not self.db or not USAGE_FIRESTORE_ENABLED:
+            return
+        with self._lock:
+            if self._flusher:
+                return
+            self._flusher = threading.Thread(target=self._flush_loop, name="usage-flush", daemon=True)
+        self._flusher.start()
+
+    def _flush_loop(self):
+        while not self._stop.wait(USAGE_FLUSH_SECONDS):
+            self.flush()
+
+    def flush(self):
+        """
+        Adds the increments recorded since the last flush to Firestore, and drops totals of past days.
+        """
+        with self._lock:
+            pending, self.pending = self.pending, defaultdict(_new_totals)
+            today = _today()
+            for key in [key for key in self.totals if key[0] != today]:
+                del self.totals[key]
+            for key in [key for key in self.remote_baseline if key[0] != today]:
+                del self.remote_baseline[key]
+        if not pending or not self.db:
+            return
+        try:
+            items = list(pending.items())
+            # Firestore batches hold at most 500 writes
+            for start in range(0, len(items), 500):
+                batch = self.db.batch()
+                for (day, dimension, key), entry in items[start:start + 500]:
+                    doc_ref = self.db.collection(USAGE_COLLECTION).document(day).collection(dimension).document(key)
+                    batch.set(doc_ref, {field: firestore.Increment(value) for field, value in entry.items()}, merge=True)
+                batch.commit()
+            self.stats["flushes"] += 1
+        except Exception as e:
+            logger.error(f"Failed to flush usage to Firestore; keeping it for the next flush: {e}")
+            self.stats["flush_failures"] += 1
+            with self._lock:
+                for key, entry in pending.items():
+                    target = self.pending[key]
+                    for field, value in entry.items():
+                        target[field] += value
+
+    def metrics(self):
+        day = _today()
+        with self._lock:
+            by_dimension = {dimension: {} for dimension in DIMENSIONS}
+            for (entry_day, dimension, key), entry in self.totals.items():
+                if entry_day == day:
+                    by_dimension[dimension][key] = {**entry, "cost_usd": round(entry["cost_usd"], 4)}
+            stats = dict(self.stats)
+        conversations = sorted(by_dimension["conversation"].items(), key=lambda item: item[1]["cost_usd"], reverse=True)
+        return {
+            "day": day,
+            "users": by_dimension["user"],
+            "tools": by_dimension["tool"],
+            "models": by_dimension["model"],
+            "top_conversations": dict(conversations[:METRICS_TOP_CONVERSATIONS]),
+            "conversation_count": len(conversations),
+            "daily_budget_usd": USER_DAILY_BUDGET_USD,
+            **stats
+        }
+
+if USAGE_FIRESTORE_ENABLED:
+    from shared_resources import db
+    usage_ledger = UsageLedger(db=db)
+else:
+    usage_ledger = UsageLedger()
+register_metrics("usage", usage_ledger.metrics)